@@ -0,0 +1,379 @@
+"""Benchmarks for the EBS Direct upload hot path.
+
+    upload-ami-benchmark allocations --size-mib 1024
+
+measures how many bytes the per-block read/hash path allocates per GiB
+of image, comparing the old fresh-bytes-per-block reader with the
+buffer-pooled one.  The pool's buffers are allocated once per upload,
+not per block, so they are reported apart as ``pool_mib``.
+
+    upload-ami-benchmark upload --workers 8,64,adaptive --size-mib 256,1024 \
+        --zero-ratio 0,0.5 --latency 0.02 --throttle-rate 0.01
+
+runs :func:`.snapshot_uploader.upload_snapshot` against a local
+:class:`.fake_ebs.FakeEbsServer` for every combination and reports MiB/s
+and CPU seconds per GiB of image, so regressions in the hot path show up
+without an AWS account.  With ``--verify-sample 1`` every upload is also
+read back and verified, and the verification throughput is reported.
+
+    upload-ami-benchmark startup --budget-ms 250
+
+times ``amis --help`` and the commands' ``--help`` in fresh
+interpreters, reports the slowest imports of each and fails if any of
+them takes longer than the budget to start or loads boto3 or botocore.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import itertools
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+from .block_source import BLOCK_SIZE, READ_MODES, BufferPool, RawFileSource
+from .fake_ebs import FakeEbsServer
+from .snapshot_uploader import upload_snapshot
+
+GIB = 1024**3
+MIB = 1024**2
+
+
+def _legacy_block(fd: int, index: int, file_size: int) -> str:
+    """The per-block path before buffer pooling: pread, pad, hash."""
+    offset = index * BLOCK_SIZE
+    data = os.pread(fd, min(BLOCK_SIZE, file_size - offset), offset)
+    if len(data) < BLOCK_SIZE:
+        data += b"\x00" * (BLOCK_SIZE - len(data))
+    return base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+
+
+def _pooled_block(source: RawFileSource, pool: BufferPool, index: int) -> str:
+    buffer = pool.acquire()
+    try:
+        source.read_block_into(index, buffer)
+        digest = hashlib.sha256(buffer).digest()
+    finally:
+        pool.release(buffer)
+    return base64.b64encode(digest).decode("ascii")
+
+
+def _measure(block_count: int, process: Callable[[int], str]) -> dict[str, float]:
+    """Run *process* over all blocks, once traced and once timed."""
+    tracemalloc.start()
+    allocated = 0
+    for index in range(block_count):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        process(index)
+        allocated += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    for index in range(block_count):
+        process(index)
+    elapsed = time.perf_counter() - t0
+
+    gib = block_count * BLOCK_SIZE / GIB
+    return {
+        "allocated_mib_per_gib": allocated / MIB / gib,
+        "mib_per_s": block_count * BLOCK_SIZE / MIB / elapsed,
+    }
+
+
+def allocations(size_mib: int) -> dict[str, dict[str, float]]:
+    """Compare per-block allocations of the legacy and pooled read paths.
+
+    The pool is filled before measuring, so that its buffer does not
+    count against a small image as if it were allocated per block.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "image.raw"
+        with open(path, "wb") as f:
+            for _ in range(size_mib):
+                f.write(os.urandom(MIB))
+            f.write(os.urandom(BLOCK_SIZE // 3))  # Partial last block.
+        with RawFileSource(path) as source:
+            pool = BufferPool(1)
+            pool.release(pool.acquire())
+            return {
+                "legacy": _measure(
+                    source.block_count,
+                    lambda i: _legacy_block(source.fd, i, source.size),
+                ),
+                "pooled": {
+                    **_measure(
+                        source.block_count,
+                        lambda i: _pooled_block(source, pool, i),
+                    ),
+                    "pool_mib": pool.count * BLOCK_SIZE / MIB,
+                },
+            }
+
+
+def _write_image(path: Path, size_mib: int, zero_ratio: float) -> None:
+    """Write an image whose blocks are random data or, at *zero_ratio*, zeros.
+
+    Zero blocks are written out rather than left as holes, so they still
+    go through the read and zero-detection path.
+    """
+    rng = random.Random(0)
+    with open(path, "wb") as f:
+        for _ in range(size_mib * MIB // BLOCK_SIZE):
+            if rng.random() < zero_ratio:
+                f.write(bytes(BLOCK_SIZE))
+            else:
+                f.write(os.urandom(BLOCK_SIZE))
+
+
+def upload(
+    workers: list[int | None],
+    sizes_mib: list[int],
+    zero_ratios: list[float],
+    verify_sample: float = 0.0,
+    read_mode: str = "cached",
+    **faults: Any,
+) -> list[dict[str, Any]]:
+    """Sweep upload_snapshot against a fake EBS Direct endpoint.
+
+    *faults* are passed to :class:`.fake_ebs.FaultConfig`.  A worker
+    count of None selects adaptive concurrency.  *verify_sample* is
+    passed to upload_snapshot as *verify*; MiB/s then includes the
+    verification.  *read_mode* is passed to upload_snapshot.
+    """
+    results = []
+    with (
+        tempfile.TemporaryDirectory() as tmp,
+        FakeEbsServer(**faults) as server,
+        server.environment(),
+    ):
+        metrics_dir = Path(tmp) / "metrics"
+        for size_mib, zero_ratio in itertools.product(sizes_mib, zero_ratios):
+            image = Path(tmp) / f"{size_mib}-{zero_ratio}.raw"
+            _write_image(image, size_mib, zero_ratio)
+            for count in workers:
+                t0 = time.perf_counter()
+                cpu0 = time.process_time()
+                snapshot_id = upload_snapshot(
+                    image,
+                    region="us-east-1",
+                    workers=count,
+                    metrics_dir=metrics_dir,
+                    verify=verify_sample,
+                    read_mode=read_mode,
+                )
+                cpu = time.process_time() - cpu0
+                elapsed = time.perf_counter() - t0
+                report = json.loads((metrics_dir / f"{snapshot_id}.json").read_text())
+                results.append(
+                    {
+                        "workers": "adaptive" if count is None else count,
+                        "size_mib": size_mib,
+                        "zero_ratio": zero_ratio,
+                        "read_mode": read_mode,
+                        "mib_per_s": size_mib / elapsed,
+                        "cpu_s_per_gib": cpu / (size_mib * MIB / GIB),
+                        "blocks_sent": report["blocks_sent"],
+                        "retries": report["retries"],
+                        "concurrency_limit": report["concurrency_limit"],
+                        "concurrency_peak": report["concurrency_peak"],
+                        "verify_mib_per_s": report.get("verify_mib_per_second"),
+                    }
+                )
+            image.unlink()
+    return results
+
+
+# Commands whose cold start `startup` measures, as arguments to amis.
+STARTUP_COMMANDS = [
+    ["--help"],
+    ["upload-ami", "--help"],
+    ["smoke-test", "--help"],
+    ["delete-deprecated-images", "--help"],
+    ["delete-images-by-name", "--help"],
+    ["delete-orphaned-snapshots", "--help"],
+    ["describe-images", "--help"],
+    ["nuke", "--help"],
+    ["inventory", "--help"],
+    ["request-public-ami-quota-increase", "--help"],
+    ["enable-regions", "--help"],
+    ["disable-image-block-public-access", "--help"],
+]
+
+# Packages that ``--help`` must not import.
+LAZY_PACKAGES = ("boto3", "botocore")
+
+_LOADED_PACKAGES = """
+import json, sys
+from upload_ami import cli
+try:
+    cli.main(sys.argv[1:])
+except SystemExit:
+    pass
+print(json.dumps(sorted({m.split(".")[0] for m in sys.modules})))
+"""
+
+
+def _loaded_packages(args: list[str]) -> list[str]:
+    """Which of LAZY_PACKAGES ``amis *args`` imports."""
+    proc = subprocess.run(
+        [sys.executable, "-c", _LOADED_PACKAGES, *args],
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    loaded = json.loads(proc.stdout.splitlines()[-1])
+    return [package for package in LAZY_PACKAGES if package in loaded]
+
+
+def _slowest_imports(args: list[str], count: int) -> list[tuple[str, float]]:
+    """The *count* top-level imports of ``amis *args`` taking longest."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "upload_ami.cli", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    imports = []
+    for line in proc.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        # Nested imports are indented; their time is in their parent's.
+        if name.startswith(" ") and not name.startswith("  "):
+            imports.append((name.strip(), int(fields[1]) / 1000))
+    return sorted(imports, key=lambda i: -i[1])[:count]
+
+
+def startup(runs: int, budget_ms: float) -> dict[str, dict[str, Any]]:
+    """Time each of STARTUP_COMMANDS; the best of *runs* cold starts.
+
+    Also records which of LAZY_PACKAGES each of them imports.
+    """
+    results = {}
+    # Installed scripts may find this package through paths they add
+    # themselves rather than through the interpreter's defaults.
+    os.environ["PYTHONPATH"] = os.pathsep.join(sys.path)
+    for args in STARTUP_COMMANDS:
+        times = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-m", "upload_ami.cli", *args],
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            times.append((time.perf_counter() - t0) * 1000)
+        results[" ".join(["amis", *args])] = {
+            "ms": min(times),
+            "within_budget": min(times) <= budget_ms,
+            "loads": _loaded_packages(args),
+            "slowest_imports_ms": dict(_slowest_imports(args, 5)),
+        }
+    return results
+
+
+def _workers(value: str) -> list[int | None]:
+    return [None if w == "adaptive" else int(w) for w in value.split(",")]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    alloc = subparsers.add_parser(
+        "allocations", help="Bytes allocated per GiB by the block read path"
+    )
+    alloc.add_argument("--size-mib", type=int, default=256)
+    up = subparsers.add_parser(
+        "upload", help="MiB/s and CPU per GiB of uploads to a fake EBS endpoint"
+    )
+    up.add_argument(
+        "--workers",
+        type=_workers,
+        default=_workers("8,32,128,adaptive"),
+        help="Comma-separated worker counts; 'adaptive' for the AIMD controller",
+    )
+    up.add_argument(
+        "--size-mib",
+        type=lambda v: [int(s) for s in v.split(",")],
+        default=[256],
+        help="Comma-separated image sizes",
+    )
+    up.add_argument(
+        "--zero-ratio",
+        type=lambda v: [float(s) for s in v.split(",")],
+        default=[0.0, 0.5],
+        help="Comma-separated fractions of zero blocks",
+    )
+    up.add_argument(
+        "--latency", type=float, default=0.02, help="Seconds per PutSnapshotBlock"
+    )
+    up.add_argument("--throttle-rate", type=float, default=0.0)
+    up.add_argument("--error-rate", type=float, default=0.0)
+    up.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="Do not check block checksums in the fake endpoint",
+    )
+    up.add_argument(
+        "--verify-sample",
+        type=float,
+        default=0.0,
+        help="Fraction of blocks to read back after each upload",
+    )
+    up.add_argument("--read-mode", choices=READ_MODES, default="cached")
+    start = subparsers.add_parser(
+        "startup", help="Cold start time of amis --help and the commands' --help"
+    )
+    start.add_argument("--runs", type=int, default=5)
+    start.add_argument(
+        "--budget-ms",
+        type=float,
+        default=250.0,
+        help="Fail if any command takes longer than this to start",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark == "allocations":
+        print(json.dumps(allocations(args.size_mib), indent=2))
+    elif args.benchmark == "upload":
+        results = upload(
+            args.workers,
+            args.size_mib,
+            args.zero_ratio,
+            args.verify_sample,
+            args.read_mode,
+            latency=args.latency,
+            throttle_rate=args.throttle_rate,
+            error_rate=args.error_rate,
+            verify=not args.no_verify,
+        )
+        print(json.dumps(results, indent=2))
+    elif args.benchmark == "startup":
+        timings = startup(args.runs, args.budget_ms)
+        print(json.dumps(timings, indent=2))
+        over = [name for name, t in timings.items() if not t["within_budget"]]
+        if over:
+            sys.exit(f"Over the {args.budget_ms} ms startup budget: {', '.join(over)}")
+        eager = [
+            f"{name} ({', '.join(t['loads'])})"
+            for name, t in timings.items()
+            if t["loads"]
+        ]
+        if eager:
+            sys.exit(f"Loaded at startup: {'; '.join(eager)}")
+
+
+if __name__ == "__main__":
+    main()
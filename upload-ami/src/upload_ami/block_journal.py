@@ -0,0 +1,81 @@
+"""Append-only journal of blocks written to a pending EBS snapshot.
+
+The first line holds the snapshot ID and the
+:func:`.block_manifest.image_fingerprint` of the image written to it;
+every following line is ``<block index> <sha256 hex>`` for a block that
+PutSnapshotBlock acknowledged.  A torn last line from a killed process
+is ignored.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class BlockJournal:
+    """Journal of acknowledged blocks for one snapshot.
+
+    If *path* already holds a journal for *snapshot_id* and the image
+    with *fingerprint*, its entries are loaded so the upload can resume;
+    a journal for any other snapshot or image is discarded.  If it was
+    for the same snapshot but another image, *stale* is set: the
+    snapshot holds blocks of that other image.
+    """
+
+    def __init__(self, path: Path, snapshot_id: str, fingerprint: str) -> None:
+        self.path = path
+        self.snapshot_id = snapshot_id
+        self.fingerprint = fingerprint
+        self.entries: dict[int, bytes] = {}
+        self.stale = False
+        self._lock = threading.Lock()
+
+        if self._load():
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            if self._torn:
+                os.write(self._fd, b"\n")
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.write(self._fd, f"{snapshot_id} {fingerprint}\n".encode())
+
+    def _load(self) -> bool:
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        self._torn = not data.endswith(b"\n")
+        lines = data.split(b"\n")
+        header = lines[0].decode(errors="replace").split(" ")
+        if header[0] != self.snapshot_id:
+            log.info("Discarding journal %s for another snapshot", self.path)
+            return False
+        if header[1:] != [self.fingerprint]:
+            log.warning("Discarding journal %s for another image", self.path)
+            self.stale = True
+            return False
+        for line in lines[1:]:
+            parts = line.split(b" ")
+            if len(parts) != 2 or len(parts[1]) != 64:
+                continue
+            try:
+                self.entries[int(parts[0])] = bytes.fromhex(parts[1].decode())
+            except ValueError:
+                continue
+        return True
+
+    def record(self, block_index: int, digest: bytes) -> None:
+        line = f"{block_index} {digest.hex()}\n".encode()
+        with self._lock:
+            os.write(self._fd, line)
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+    def remove(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
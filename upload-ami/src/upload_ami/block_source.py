@@ -0,0 +1,728 @@
+"""Disk images presented as sequences of 512 KiB EBS blocks.
+
+A block source yields the indices of the blocks that may hold data, in
+ascending order, together with the block contents when it has already
+read them.  Raw files are read lazily with pread from the upload workers;
+compressed files are decompressed as a stream by the scheduler thread,
+so decompression overlaps with the uploads and the raw image never has
+to be written to disk.
+
+VHD and qcow2 images are read natively: their allocation tables are
+parsed up front and only blocks backed by allocated clusters are read.
+
+Blocks are read into reusable buffers from a :class:`BufferPool`, which
+also caps the memory held by blocks in flight.  The buffers are
+bytearrays rather than memoryviews of an mmap because botocore only
+accepts bytes, bytearray or file objects as request bodies.
+
+Raw images can be read in one of :data:`READ_MODES`.  ``cached`` reads
+through the page cache like any other file.  ``readahead`` asks the
+kernel with posix_fadvise to read ahead of the blocks being scheduled
+and drops each block from the page cache once it has been read, so a
+large image does not evict everything else, e.g. the Nix store, from
+memory.  ``direct`` bypasses the page cache with O_DIRECT, reading into
+page-aligned scratch buffers.
+"""
+
+import errno
+import heapq
+import logging
+import lzma
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from pathlib import Path
+from typing import AbstractSet, BinaryIO, Iterator, Protocol, Self
+
+import zstandard
+
+log = logging.getLogger(__name__)
+
+BLOCK_SIZE = 512 * 1024  # Fixed by EBS Direct API.
+
+READ_MODES = ("cached", "readahead", "direct")
+# How far ahead of the scheduled blocks to hint readahead, and how far
+# the scheduled blocks may advance before hinting again.
+_READAHEAD = 32 * 1024 * 1024
+_READAHEAD_STEP = 8 * 1024 * 1024
+# Alignment of O_DIRECT offsets, lengths and buffers.
+_DIRECT_ALIGN = 4096
+
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+_ZERO_VIEW = memoryview(ZERO_BLOCK)
+
+_XZ_MAGIC = b"\xfd7zXZ\x00"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+_ZSTD_FRAME_HEADER_MAX = 18
+_QCOW2_MAGIC = b"QFI\xfb"
+_VHD_COOKIE = b"conectix"
+
+
+class _Stream(Protocol):
+    def read(self, size: int = -1, /) -> bytes: ...
+
+    def readinto(self, buffer: memoryview, /) -> int: ...
+
+    def close(self) -> None: ...
+
+
+class BufferPool:
+    """A bounded set of reusable BLOCK_SIZE buffers.
+
+    Buffers are allocated lazily, up to *count*.  :meth:`acquire` blocks
+    while all of them are in use.
+    """
+
+    def __init__(self, count: int) -> None:
+        self.count = count
+        self._slots = threading.Semaphore(count)
+        self._free: list[bytearray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> bytearray:
+        self._slots.acquire()
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return bytearray(BLOCK_SIZE)
+
+    def release(self, buffer: bytearray) -> None:
+        with self._lock:
+            self._free.append(buffer)
+        self._slots.release()
+
+
+class BlockSource:
+    """A disk image of *size* bytes, split into BLOCK_SIZE blocks."""
+
+    size: int
+
+    @property
+    def block_count(self) -> int:
+        return math.ceil(self.size / BLOCK_SIZE)
+
+    def blocks(
+        self,
+        include: AbstractSet[int] = frozenset(),
+        pool: BufferPool | None = None,
+    ) -> Iterator[tuple[int, bytes | bytearray | None]]:
+        """Yield ``(index, data)`` for blocks that may hold data.
+
+        Only indices below :attr:`block_count` are yielded.  Blocks known
+        to be all zeros are left out, unless their index is in *include*.
+        *data* is None if the block has not been read yet; call
+        :meth:`read_block_into` for it, possibly from another thread.
+        Sources that read blocks themselves take their buffers from
+        *pool*, and the caller must release them.
+        """
+        raise NotImplementedError
+
+    def read_block_into(self, index: int, buffer: bytearray) -> None:
+        """Fill *buffer* with the contents of block *index*."""
+        raise NotImplementedError
+
+    def read_block(self, index: int) -> bytes:
+        buffer = bytearray(BLOCK_SIZE)
+        self.read_block_into(index, buffer)
+        return bytes(buffer)
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        self.close()
+
+
+class RawFileSource(BlockSource):
+    """A raw image file, read with pread.
+
+    Holes in sparse files are found with SEEK_DATA/SEEK_HOLE so they are
+    not even read.  *mode* is one of :data:`READ_MODES`; where the
+    platform or filesystem does not support it, ``direct`` falls back to
+    ``readahead`` and ``readahead`` to ``cached``.
+    """
+
+    def __init__(
+        self, path: Path, size: int | None = None, mode: str = "cached"
+    ) -> None:
+        if mode not in READ_MODES:
+            raise ValueError(f"unknown read mode {mode!r}")
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size if size is None else size
+        self._direct_fd: int | None = None
+        self._scratch = threading.local()
+        if mode == "direct":
+            try:
+                self._direct_fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except (AttributeError, OSError) as exc:
+                log.warning("Cannot open %s with O_DIRECT: %s", path, exc)
+                mode = "readahead"
+        if mode == "readahead" and not hasattr(os, "posix_fadvise"):
+            mode = "cached"
+        if mode == "readahead":
+            os.posix_fadvise(self.fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        self.mode = mode
+
+    def close(self) -> None:
+        if self._direct_fd is not None:
+            os.close(self._direct_fd)
+        os.close(self.fd)
+
+    def blocks(
+        self,
+        include: AbstractSet[int] = frozenset(),
+        pool: BufferPool | None = None,
+    ) -> Iterator[tuple[int, bytes | bytearray | None]]:
+        included = sorted(i for i in include if i < self.block_count)
+        last = -1
+        hinted = 0
+        for idx in heapq.merge(self._data_blocks(), included):
+            if idx == last:
+                continue
+            ahead = idx * BLOCK_SIZE + _READAHEAD
+            if self.mode == "readahead" and ahead >= hinted + _READAHEAD_STEP:
+                start = max(idx * BLOCK_SIZE, hinted)
+                os.posix_fadvise(self.fd, start, ahead - start, os.POSIX_FADV_WILLNEED)
+                hinted = ahead
+            yield idx, None
+            last = idx
+
+    def _data_blocks(self) -> Iterator[int]:
+        """Yield the indices of blocks that overlap data regions of the file.
+
+        Falls back to yielding every block if the platform or filesystem
+        lacks SEEK_DATA/SEEK_HOLE.
+        """
+        seek_data = getattr(os, "SEEK_DATA", None)
+        seek_hole = getattr(os, "SEEK_HOLE", None)
+        if seek_data is None or seek_hole is None:
+            yield from range(self.block_count)
+            return
+
+        next_block = 0
+        offset = 0
+        while offset < self.size:
+            try:
+                data_start = os.lseek(self.fd, offset, seek_data)
+            except OSError as exc:
+                if exc.errno == errno.ENXIO:
+                    return  # No data after offset.
+                if next_block == 0:
+                    yield from range(self.block_count)
+                    return
+                raise
+            data_end = os.lseek(self.fd, data_start, seek_hole)
+            first = max(data_start // BLOCK_SIZE, next_block)
+            last = math.ceil(data_end / BLOCK_SIZE)
+            yield from range(first, last)
+            next_block = last
+            offset = last * BLOCK_SIZE
+
+    def read_block_into(self, index: int, buffer: bytearray) -> None:
+        """Read one block via preadv, zero-padding the last block."""
+        offset = index * BLOCK_SIZE
+        to_read = max(min(BLOCK_SIZE, self.size - offset), 0)
+        view = memoryview(buffer)
+        if to_read:
+            if self._direct_fd is not None:
+                got = self._read_direct_into(view[:to_read], offset)
+            else:
+                got = _pread_into(self.fd, view[:to_read], offset)
+            if got < to_read:
+                raise OSError(
+                    f"Short read at block {index}: expected {to_read}, got {got}"
+                )
+            if self.mode == "readahead":
+                os.posix_fadvise(self.fd, offset, to_read, os.POSIX_FADV_DONTNEED)
+        if to_read < BLOCK_SIZE:
+            view[to_read:] = _ZERO_VIEW[to_read:]
+
+    def _read_direct_into(self, view: memoryview, offset: int) -> int:
+        """Read with O_DIRECT through this thread's page-aligned scratch buffer.
+
+        The read is rounded up to the alignment O_DIRECT needs; only the
+        part that fits *view* is copied.
+        """
+        assert self._direct_fd is not None
+        scratch = getattr(self._scratch, "buffer", None)
+        if scratch is None:
+            # Anonymous mmaps are page-aligned, unlike bytearrays.
+            scratch = self._scratch.buffer = mmap.mmap(-1, BLOCK_SIZE)
+        length = -(-len(view) // _DIRECT_ALIGN) * _DIRECT_ALIGN
+        with memoryview(scratch) as aligned:
+            got = _pread_into(self._direct_fd, aligned[:length], offset)
+            got = min(got, len(view))
+            view[:got] = aligned[:got]
+        return got
+
+
+class StreamSource(BlockSource):
+    """A raw image decompressed on the fly from an xz or zstd file.
+
+    Blocks are produced in order by :meth:`blocks`; all-zero blocks are
+    dropped right after decompression.
+    """
+
+    def __init__(self, path: Path, stream: _Stream, size: int) -> None:
+        self.path = path
+        self.stream = stream
+        self.size = size
+
+    def close(self) -> None:
+        self.stream.close()
+
+    def blocks(
+        self,
+        include: AbstractSet[int] = frozenset(),
+        pool: BufferPool | None = None,
+    ) -> Iterator[tuple[int, bytes | bytearray | None]]:
+        buffer = None
+        try:
+            for idx in range(self.block_count):
+                if buffer is None:
+                    buffer = pool.acquire() if pool else bytearray(BLOCK_SIZE)
+                view = memoryview(buffer)
+                got = _read_full_into(self.stream, view)
+                expected = min(BLOCK_SIZE, self.size - idx * BLOCK_SIZE)
+                if got != expected:
+                    raise OSError(
+                        f"{self.path}: block {idx} decompressed to {got} bytes, "
+                        f"expected {expected}"
+                    )
+                if got < BLOCK_SIZE:
+                    view[got:] = _ZERO_VIEW[got:]
+                if buffer != ZERO_BLOCK:
+                    yield idx, buffer
+                    buffer = None
+                elif idx in include:
+                    yield idx, ZERO_BLOCK
+        finally:
+            if buffer is not None and pool:
+                pool.release(buffer)
+        if self.stream.read(1):
+            raise OSError(f"{self.path}: more data than the {self.size} bytes expected")
+
+    def read_block_into(self, index: int, buffer: bytearray) -> None:
+        raise TypeError("stream sources yield their data from blocks()")
+
+
+class ClusteredSource(BlockSource):
+    """Base for formats that map fixed-size clusters of the disk to the file.
+
+    Subclasses fill in :attr:`cluster_size` and implement
+    :meth:`_allocated_clusters` and :meth:`_read_cluster`.
+    """
+
+    cluster_size: int
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+    def _allocated_clusters(self) -> Iterator[int]:
+        """Yield the indices of clusters that may hold data, ascending."""
+        raise NotImplementedError
+
+    def _read_cluster_into(self, cluster: int, start: int, view: memoryview) -> bool:
+        """Read part of a cluster into *view*.
+
+        Returns False, leaving *view* untouched, if that part reads as zeros.
+        """
+        raise NotImplementedError
+
+    def _pread(self, length: int, offset: int) -> bytes:
+        data = os.pread(self.fd, length, offset)
+        if len(data) != length:
+            raise OSError(f"{self.path}: short read at offset {offset}")
+        return data
+
+    def _pread_into(self, view: memoryview, offset: int) -> None:
+        if _pread_into(self.fd, view, offset) != len(view):
+            raise OSError(f"{self.path}: short read at offset {offset}")
+
+    def _allocated_blocks(self) -> Iterator[int]:
+        last = -1
+        for cluster in self._allocated_clusters():
+            start = cluster * self.cluster_size
+            if start >= self.size:
+                return
+            end = min(start + self.cluster_size, self.size)
+            first = max(start // BLOCK_SIZE, last + 1)
+            last = math.ceil(end / BLOCK_SIZE) - 1
+            yield from range(first, last + 1)
+
+    def blocks(
+        self,
+        include: AbstractSet[int] = frozenset(),
+        pool: BufferPool | None = None,
+    ) -> Iterator[tuple[int, bytes | bytearray | None]]:
+        included = sorted(i for i in include if i < self.block_count)
+        last = -1
+        for idx in heapq.merge(self._allocated_blocks(), included):
+            if idx != last:
+                yield idx, None
+                last = idx
+
+    def read_block_into(self, index: int, buffer: bytearray) -> None:
+        view = memoryview(buffer)
+        offset = index * BLOCK_SIZE
+        end = min(offset + BLOCK_SIZE, self.size)
+        pos = offset
+        while pos < end:
+            cluster, start = divmod(pos, self.cluster_size)
+            length = min(self.cluster_size - start, end - pos)
+            part = view[pos - offset : pos - offset + length]
+            if not self._read_cluster_into(cluster, start, part):
+                part[:] = _ZERO_VIEW[:length]
+            pos += length
+        filled = pos - offset
+        if filled < BLOCK_SIZE:
+            view[filled:] = _ZERO_VIEW[filled:]
+
+
+class VhdSource(ClusteredSource):
+    """A dynamic VHD image, read through its block allocation table.
+
+    Sectors whose bit is clear in a block's sector bitmap read as zeros.
+    Differencing VHDs are not supported.
+    """
+
+    _UNALLOCATED = 0xFFFFFFFF
+
+    def __init__(self, path: Path, footer: bytes) -> None:
+        super().__init__(path)
+        try:
+            (data_offset,) = struct.unpack_from(">Q", footer, 16)
+            (self.size,) = struct.unpack_from(">Q", footer, 48)
+            (disk_type,) = struct.unpack_from(">I", footer, 60)
+            if disk_type != 3:
+                raise ValueError(f"{path}: unsupported VHD disk type {disk_type}")
+            header = self._pread(1024, data_offset)
+            if header[:8] != b"cxsparse":
+                raise ValueError(f"{path}: bad VHD dynamic disk header")
+            table_offset, _, entries, self.cluster_size = struct.unpack_from(
+                ">QIII", header, 16
+            )
+            self._bat = array("I", self._pread(4 * entries, table_offset))
+            if sys.byteorder == "little":
+                self._bat.byteswap()
+        except BaseException:
+            self.close()
+            raise
+        sectors = self.cluster_size // 512
+        self._bitmap_size = math.ceil(sectors / 8 / 512) * 512
+
+    def _allocated_clusters(self) -> Iterator[int]:
+        for cluster, sector in enumerate(self._bat):
+            if sector != self._UNALLOCATED:
+                yield cluster
+
+    def _read_cluster_into(self, cluster: int, start: int, view: memoryview) -> bool:
+        if cluster >= len(self._bat) or self._bat[cluster] == self._UNALLOCATED:
+            return False
+        length = len(view)
+        block_offset = self._bat[cluster] * 512
+        bitmap = self._pread(self._bitmap_size, block_offset)
+        self._pread_into(view, block_offset + self._bitmap_size + start)
+        first, last = start // 512, (start + length - 1) // 512
+        lo, hi = first >> 3, (last >> 3) + 1
+        if bitmap[lo:hi] == b"\xff" * (hi - lo):
+            return True
+        for s in range(first, last + 1):
+            if not bitmap[s >> 3] & (0x80 >> (s & 7)):
+                lo = max(s * 512 - start, 0)
+                hi = min((s + 1) * 512 - start, length)
+                view[lo:hi] = _ZERO_VIEW[: hi - lo]
+        return True
+
+
+class Qcow2Source(ClusteredSource):
+    """A qcow2 image, read through its L1/L2 tables.
+
+    Supports deflate and zstd compressed clusters and v3 zero clusters.
+    Images with a backing file, encryption, an external data file or
+    extended L2 entries are not supported.
+    """
+
+    _OFFSET_MASK = 0x00FFFFFFFFFFFE00
+    _COMPRESSED = 1 << 62
+    _ZERO = 1
+
+    def __init__(self, path: Path) -> None:
+        super().__init__(path)
+        try:
+            self._parse_header()
+        except BaseException:
+            self.close()
+            raise
+
+    def _parse_header(self) -> None:
+        header = self._pread(104, 0)
+        (
+            version,
+            backing_file_offset,
+            _,
+            cluster_bits,
+            self.size,
+            crypt_method,
+            l1_size,
+            l1_table_offset,
+        ) = struct.unpack_from(">IQIIQIIQ", header, 4)
+        if backing_file_offset != 0:
+            raise ValueError(f"{self.path}: qcow2 backing files are not supported")
+        if crypt_method != 0:
+            raise ValueError(f"{self.path}: encrypted qcow2 is not supported")
+        self.cluster_size = 1 << cluster_bits
+        self._compression = "deflate"
+        if version >= 3:
+            (incompatible,) = struct.unpack_from(">Q", header, 72)
+            (header_length,) = struct.unpack_from(">I", header, 100)
+            # Bit 0 (dirty) only affects refcounts, bit 3 selects the
+            # compression type.
+            if incompatible & ~0b1001:
+                raise ValueError(
+                    f"{self.path}: unsupported qcow2 features {incompatible:#x}"
+                )
+            if incompatible & 0b1000 and header_length > 104:
+                if self._pread(1, 104)[0] == 1:
+                    self._compression = "zstd"
+
+        # Flatten the L2 tables into one array of cluster descriptors.
+        entries_per_l2 = self.cluster_size // 8
+        clusters = math.ceil(self.size / self.cluster_size)
+        l1 = self._unpack_u64(self._pread(8 * l1_size, l1_table_offset))
+        self._l2 = array("Q", bytes(8 * clusters))
+        for i, entry in enumerate(l1):
+            l2_offset = entry & self._OFFSET_MASK
+            first = i * entries_per_l2
+            if l2_offset == 0 or first >= clusters:
+                continue
+            count = min(entries_per_l2, clusters - first)
+            self._l2[first : first + count] = self._unpack_u64(
+                self._pread(8 * count, l2_offset)
+            )
+        self._compressed_offset_bits = 62 - (cluster_bits - 8)
+
+    @staticmethod
+    def _unpack_u64(data: bytes) -> "array[int]":
+        values = array("Q", data)
+        if sys.byteorder == "little":
+            values.byteswap()
+        return values
+
+    def _is_allocated(self, entry: int) -> bool:
+        if entry & self._COMPRESSED:
+            return True
+        return entry & self._OFFSET_MASK != 0 and not entry & self._ZERO
+
+    def _allocated_clusters(self) -> Iterator[int]:
+        for cluster, entry in enumerate(self._l2):
+            if self._is_allocated(entry):
+                yield cluster
+
+    def _read_cluster_into(self, cluster: int, start: int, view: memoryview) -> bool:
+        entry = self._l2[cluster]
+        if not self._is_allocated(entry):
+            return False
+        length = len(view)
+        if not entry & self._COMPRESSED:
+            self._pread_into(view, (entry & self._OFFSET_MASK) + start)
+            return True
+
+        bits = self._compressed_offset_bits
+        host_offset = entry & ((1 << bits) - 1)
+        sectors = ((entry >> bits) & ((1 << (62 - bits)) - 1)) + 1
+        compressed_size = sectors * 512 - (host_offset & 511)
+        compressed = os.pread(self.fd, compressed_size, host_offset)
+        if self._compression == "zstd":
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(compressed)
+        else:
+            data = zlib.decompressobj(-12).decompress(compressed, self.cluster_size)
+        if len(data) < start + length:
+            raise OSError(f"{self.path}: bad compressed cluster {cluster}")
+        view[:] = memoryview(data)[start : start + length]
+        return True
+
+
+def open_block_source(path: str | Path, read_mode: str = "cached") -> BlockSource:
+    """Open a disk image, detecting its format by magic bytes.
+
+    Supports raw images, xz- or zstd-compressed raw images, fixed and
+    dynamic VHD, and qcow2.  *read_mode* is one of :data:`READ_MODES`;
+    it applies to raw images and fixed VHDs, other formats are always
+    read through the page cache.
+    """
+    if read_mode not in READ_MODES:
+        raise ValueError(f"unknown read mode {read_mode!r}")
+    path = Path(path)
+    with open(path, "rb") as f:
+        magic = f.read(len(_XZ_MAGIC))
+        file_size = f.seek(0, os.SEEK_END)
+        footer = b""
+        if file_size >= 512:
+            f.seek(file_size - 512)
+            footer = f.read(512)
+    if magic.startswith(_QCOW2_MAGIC):
+        return Qcow2Source(path)
+    if footer.startswith(_VHD_COOKIE):
+        (disk_type,) = struct.unpack_from(">I", footer, 60)
+        if disk_type == 2:  # Fixed: raw data followed by the footer.
+            (size,) = struct.unpack_from(">Q", footer, 48)
+            return RawFileSource(path, min(size, file_size - 512), read_mode)
+        return VhdSource(path, footer)
+    if magic.startswith(_XZ_MAGIC):
+        with open(path, "rb") as f:
+            size = _xz_uncompressed_size(f)
+        return StreamSource(path, lzma.open(path, "rb"), size)
+    if magic.startswith(_ZSTD_MAGIC):
+        f = open(path, "rb")
+        try:
+            size = _zstd_uncompressed_size(f)
+            f.seek(0)
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                f, read_across_frames=True, closefd=True
+            )
+        except BaseException:
+            f.close()
+            raise
+        return StreamSource(path, stream, size)
+    return RawFileSource(path, mode=read_mode)
+
+
+def _pread_into(fd: int, view: memoryview, offset: int) -> int:
+    """Read into *view* at *offset* without an intermediate bytes object."""
+    if hasattr(os, "preadv"):
+        return os.preadv(fd, [view], offset)
+    data = os.pread(fd, len(view), offset)
+    view[: len(data)] = data
+    return len(data)
+
+
+def _read_full_into(stream: _Stream, view: memoryview) -> int:
+    """Fill *view* from *stream* unless it ends first; return the bytes read."""
+    got = 0
+    while got < len(view):
+        n = stream.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def _xz_uncompressed_size(f: BinaryIO) -> int:
+    """Sum the uncompressed sizes recorded in the indexes of an xz file.
+
+    Walks the streams backwards from the end of the file, so nothing has
+    to be decompressed.
+    """
+    end = f.seek(0, os.SEEK_END)
+    total = 0
+    while end > 0:
+        f.seek(end - 4)
+        if f.read(4) == b"\x00\x00\x00\x00":  # Stream padding.
+            end -= 4
+            continue
+        f.seek(end - 12)
+        footer = f.read(12)
+        if footer[10:12] != b"YZ":
+            raise ValueError("not an xz file: bad stream footer")
+        index_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+        index_start = end - 12 - index_size
+        f.seek(index_start)
+        index = f.read(index_size)
+        if index[0] != 0:
+            raise ValueError("not an xz file: bad index indicator")
+        pos = 1
+        records, pos = _xz_varint(index, pos)
+        blocks_size = 0
+        for _ in range(records):
+            unpadded, pos = _xz_varint(index, pos)
+            uncompressed, pos = _xz_varint(index, pos)
+            blocks_size += (unpadded + 3) & ~3
+            total += uncompressed
+        end = index_start - blocks_size - 12
+    if end != 0:
+        raise ValueError("not an xz file: bad stream layout")
+    return total
+
+
+def _zstd_uncompressed_size(f: BinaryIO) -> int:
+    """Sum the content sizes recorded in the frame headers of a zstd file.
+
+    Walks the frames from the start of the file, skipping their blocks
+    by the sizes in the block headers, so nothing has to be
+    decompressed.  Files from ``zstd -T`` or ``pzstd`` have many frames.
+    Frames written by ``zstd`` reading from a pipe do not record their
+    size; then the whole file is decompressed once to count its bytes.
+    """
+    end = f.seek(0, os.SEEK_END)
+    pos = 0
+    total = 0
+    while pos < end:
+        f.seek(pos)
+        header = f.read(_ZSTD_FRAME_HEADER_MAX)
+        (magic,) = struct.unpack_from("<I", header)
+        if magic & 0xFFFFFFF0 == 0x184D2A50:  # Skippable frame.
+            (length,) = struct.unpack_from("<I", header, 4)
+            pos += 8 + length
+            continue
+        if header[:4] != _ZSTD_MAGIC:
+            raise ValueError(f"not a zstd file: bad magic at offset {pos}")
+        size = zstandard.frame_content_size(header)
+        if size < 0:
+            log.info("%s does not record its size, decompressing it to count", f.name)
+            return _zstd_decompressed_size(f)
+        total += size
+        has_checksum = zstandard.get_frame_parameters(header).has_checksum
+        pos += zstandard.frame_header_size(header)
+        while True:
+            f.seek(pos)
+            block = f.read(3)
+            if len(block) < 3:
+                raise ValueError("not a zstd file: truncated frame")
+            (value,) = struct.unpack("<I", block + b"\x00")
+            last, block_type, block_size = value & 1, (value >> 1) & 3, value >> 3
+            # An RLE block holds the one byte it repeats.
+            pos += 3 + (1 if block_type == 1 else block_size)
+            if last:
+                break
+        if has_checksum:
+            pos += 4
+    if pos != end:
+        raise ValueError("not a zstd file: truncated frame")
+    return total
+
+
+def _zstd_decompressed_size(f: BinaryIO) -> int:
+    """Count the bytes a zstd file decompresses to."""
+    f.seek(0)
+    reader = zstandard.ZstdDecompressor().stream_reader(
+        f, read_across_frames=True, closefd=False
+    )
+    buffer = memoryview(bytearray(BLOCK_SIZE))
+    total = 0
+    while n := reader.readinto(buffer):
+        total += n
+    return total
+
+
+def _xz_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    """Decode an xz multibyte integer at *pos*, returning (value, new pos)."""
+    value = 0
+    for i in range(9):
+        byte = buf[pos + i]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value, pos + i + 1
+    raise ValueError("not an xz file: bad multibyte integer")
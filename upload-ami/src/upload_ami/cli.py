@@ -0,0 +1,74 @@
+"""The ``amis`` command, which runs the other commands as subcommands::
+
+    amis upload-ami --image-info image.json ...
+    amis delete-deprecated-images --dry-run
+
+A subcommand's module is only imported once it is chosen, and the
+modules import boto3 only when they create their first client, so
+``amis --help`` and a subcommand's ``--help`` start without loading
+boto3 or botocore.  ``upload-ami-benchmark startup`` keeps it that way.
+"""
+
+import argparse
+import importlib
+import sys
+
+# Subcommand name -> (module, one-line description).
+COMMANDS = {
+    "upload-ami": ("upload_ami", "Upload a NixOS image and register it as an AMI"),
+    "smoke-test": ("smoke_test", "Boot an instance from an AMI and show its console"),
+    "describe-images": ("describe_images", "Print the public images of every region"),
+    "delete-deprecated-images": (
+        "delete_deprecated_images",
+        "Delete images whose deprecation time has passed",
+    ),
+    "delete-images-by-name": (
+        "delete_images_by_name",
+        "Delete images and snapshots matching a name",
+    ),
+    "delete-orphaned-snapshots": (
+        "delete_orphaned_snapshots",
+        "Delete snapshots that no image uses",
+    ),
+    "nuke": ("nuke", "Deregister images matching a name, without idempotency"),
+    "disable-image-block-public-access": (
+        "disable_image_block_public_access",
+        "Allow public images in every region",
+    ),
+    "enable-regions": ("enable_regions", "Opt in to every disabled region"),
+    "request-public-ami-quota-increase": (
+        "request_public_ami_quota_increase",
+        "Request a higher public AMI quota in every region",
+    ),
+    "inventory": (
+        "inventory",
+        "Refresh the local inventory of images and snapshots",
+    ),
+    "benchmark": ("benchmark", "Benchmark the upload path and startup time"),
+}
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="amis",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n"
+        + "\n".join(f"  {name:36}{help}" for name, (_, help) in COMMANDS.items())
+        + "\n\nRun 'amis COMMAND --help' for the options of a command.",
+    )
+    parser.add_argument(
+        "command", choices=COMMANDS, metavar="COMMAND", help="one of the commands below"
+    )
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    module_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(f".{module_name}", __package__)
+    # The subcommands parse sys.argv themselves; make their usage and
+    # errors read "amis COMMAND".
+    sys.argv = [f"amis {args.command}", *args.args]
+    module.main()
+
+
+if __name__ == "__main__":
+    main()
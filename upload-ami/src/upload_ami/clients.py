@@ -0,0 +1,92 @@
+"""Process-wide cache of boto3 clients.
+
+Creating a client loads its service model and starts a new connection
+pool, which adds up when every region, thread and call creates its own.
+:func:`client` returns one shared client per service, region and
+config; boto3 clients are thread-safe.  All clients are created from
+one session, so each service model is only loaded once, and
+:func:`prewarm` creates the clients for regions that are about to be
+used in the background.
+
+Clients that get per-use event handlers, like the EBS clients of
+uploads, should come from :func:`create` instead, so that the handlers
+do not outlive their use.
+
+boto3 is only imported once the first client is created, so that
+commands start quickly when they fail early or only print their help.
+"""
+
+import threading
+from typing import TYPE_CHECKING, Any, Iterable, cast
+
+if TYPE_CHECKING:
+    import boto3.session
+    from mypy_boto3_account import AccountClient
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_s3 import S3Client
+    from mypy_boto3_service_quotas import ServiceQuotasClient
+
+_lock = threading.Lock()
+_session: "boto3.session.Session | None" = None
+_clients: dict[tuple[str, str | None, str], Any] = {}
+
+
+def _create(service: str, region: str | None, config: dict[str, Any]) -> Any:
+    # boto3 sessions are not thread-safe, so callers hold _lock.
+    import boto3.session
+    import botocore.config
+
+    global _session
+    if _session is None:
+        _session = boto3.session.Session()
+    return _session.client(
+        service,  # type: ignore[call-overload]
+        region_name=region,
+        config=botocore.config.Config(**config) if config else None,
+    )
+
+
+def create(service: str, region: str | None = None, **config: Any) -> Any:
+    """Create a new client; *config* is passed to botocore's Config."""
+    with _lock:
+        return _create(service, region, config)
+
+
+def client(service: str, region: str | None = None, **config: Any) -> Any:
+    """Return the shared client for *service*, *region* and *config*.
+
+    A *region* of None is the default region of the environment.
+    """
+    key = (service, region, repr(sorted(config.items())))
+    with _lock:
+        shared = _clients.get(key)
+        if shared is None:
+            shared = _clients[key] = _create(service, region, config)
+        return shared
+
+
+def prewarm(service: str, regions: Iterable[str]) -> None:
+    """Create the shared clients for *regions* in a background thread."""
+    regions = list(regions)
+
+    def warm() -> None:
+        for region in regions:
+            client(service, region)
+
+    threading.Thread(target=warm, name=f"prewarm-{service}", daemon=True).start()
+
+
+def ec2(region: str | None = None) -> "EC2Client":
+    return cast("EC2Client", client("ec2", region))
+
+
+def s3(region: str | None = None) -> "S3Client":
+    return cast("S3Client", client("s3", region))
+
+
+def account() -> "AccountClient":
+    return cast("AccountClient", client("account"))
+
+
+def service_quotas(region: str | None = None) -> "ServiceQuotasClient":
+    return cast("ServiceQuotasClient", client("service-quotas", region))
@@ -0,0 +1,155 @@
+"""Adaptive limits on the number of concurrent requests."""
+
+import threading
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, Iterator
+
+if TYPE_CHECKING:
+    import botocore.client
+
+
+class AimdController:
+    """Additive-increase/multiplicative-decrease limit on concurrent requests.
+
+    The limit grows after every round of *limit* successful requests:
+    it doubles until the first congestion (slow start), then grows by one.
+    It is multiplied by *backoff* on congestion: a throttling or 5xx
+    response, or a round whose mean latency exceeds *latency_factor* times
+    the lowest round mean seen.  It decreases at most once per round,
+    so a burst of throttles does not collapse it, and requests started
+    before a decrease are not counted towards the next round.
+    """
+
+    def __init__(
+        self,
+        minimum: int,
+        maximum: int,
+        initial: int | None = None,
+        backoff: float = 0.5,
+        latency_factor: float = 3.0,
+    ) -> None:
+        if not 1 <= minimum <= maximum:
+            raise ValueError(f"invalid concurrency range {minimum}..{maximum}")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = min(max(initial or minimum, minimum), maximum)
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.peak = self.limit
+        self.congestion_events = 0
+        self._lock = threading.Lock()
+        self._slot_freed = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._base_latency: float | None = None
+        self._round_latency = 0.0
+        self._round_successes = 0
+        self._round_decreased = False
+        self._draining = 0
+        self._slow_start = True
+
+    def on_success(self, latency: float) -> None:
+        with self._lock:
+            if self._draining:
+                self._draining -= 1
+                return
+            self._round_latency += latency
+            self._round_successes += 1
+            if self._round_successes < self.limit:
+                return
+            mean = self._round_latency / self._round_successes
+            if self._base_latency is None or mean < self._base_latency:
+                self._base_latency = mean
+            if mean > self._base_latency * self.latency_factor:
+                self._decrease()
+            elif not self._round_decreased and self.limit < self.maximum:
+                if self._slow_start:
+                    self.limit = min(self.limit * 2, self.maximum)
+                else:
+                    self.limit += 1
+                self.peak = max(self.peak, self.limit)
+                self._slot_freed.notify_all()
+            self._round_latency = 0.0
+            self._round_successes = 0
+            self._round_decreased = False
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Hold one of *limit* request slots, waiting for one to be free."""
+        with self._lock:
+            while self._in_flight >= self.limit:
+                self._slot_freed.wait()
+            self._in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+                self._slot_freed.notify()
+
+    def on_congestion(self) -> None:
+        with self._lock:
+            self.congestion_events += 1
+            self._decrease()
+
+    def _decrease(self) -> None:
+        if self._round_decreased:
+            return
+        limit = max(self.minimum, int(self.limit * self.backoff))
+        self._draining = self.limit - limit
+        self.limit = limit
+        self._slow_start = False
+        self._round_decreased = True
+        self._round_latency = 0.0
+        self._round_successes = 0
+
+    def watch(self, client: "botocore.client.BaseClient", operation: str) -> None:
+        """Count throttled and server-side failures of *operation* as congestion."""
+        watch_attempts(client, operation, self._on_attempt)
+
+    def _on_attempt(self, outcome: str | None) -> None:
+        if outcome in ("throttled", "server"):
+            self.on_congestion()
+
+
+def watch_attempts(
+    client: "botocore.client.BaseClient",
+    operation: str,
+    callback: Callable[[str | None], None],
+) -> None:
+    """Call *callback* with the outcome of every attempt of *operation*.
+
+    The outcome is None for a success, ``"throttled"`` for a throttling
+    error, ``"server"`` for a 5xx or connection error and ``"client"``
+    for any other error.  Failed attempts are otherwise only visible as
+    botocore's internal retries.
+    """
+    service = client.meta.service_model.service_id.hyphenize()
+
+    def on_needs_retry(
+        response: tuple[object, dict[str, object]] | None = None,
+        caught_exception: Exception | None = None,
+        **kwargs: object,
+    ) -> None:
+        callback(_attempt_outcome(response, caught_exception))
+
+    client.meta.events.register(f"needs-retry.{service}.{operation}", on_needs_retry)
+
+
+def _attempt_outcome(
+    response: tuple[object, dict[str, object]] | None,
+    caught_exception: Exception | None,
+) -> str | None:
+    if caught_exception is not None:
+        return "server"
+    if response is None:
+        return None
+    status = getattr(response[0], "status_code", 200)
+    error = response[1].get("Error", {})
+    code = error.get("Code", "") if isinstance(error, dict) else ""
+    if status == 429 or "Throttl" in code:
+        return "throttled"
+    if status >= 500:
+        return "server"
+    if status >= 400:
+        return "client"
+    return None
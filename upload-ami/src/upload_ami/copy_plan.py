@@ -0,0 +1,117 @@
+"""Planning which region each cross-region image copy is made from.
+
+Copying an image from the source region to every other region at once
+makes the far-away copies share the source region's bandwidth.  A
+hub-and-spoke plan instead copies to one hub region per geographic area
+first and then fans out from each hub to the nearby regions.
+
+:func:`plan_copies` picks, area by area, whichever of the two finishes
+all copies soonest according to :func:`makespan`, a simulation with
+copies within an area costing NEAR_COST, copies between areas FAR_COST
+and at most *limit* copies running from any one region at once.
+"""
+
+import heapq
+from typing import Collection, Iterable, Mapping
+
+# Relative durations of a copy within a geographic area and between areas.
+NEAR_COST = 1.0
+FAR_COST = 3.0
+
+# Default number of copies running from one region at once.
+COPY_CONCURRENCY = 8
+
+# Hubs to prefer in each area, e.g. because they are well connected.
+_PREFERRED_HUBS = (
+    "us-east-1",
+    "eu-central-1",
+    "ap-southeast-1",
+    "ap-northeast-1",
+    "sa-east-1",
+    "me-central-1",
+    "af-south-1",
+)
+
+# Areas that do not follow from the region name's prefix.
+_AREAS = {"il": "me", "mx": "us", "ca": "us"}
+
+
+def area(region: str) -> str:
+    """Return the geographic area of *region*, e.g. ``eu`` for eu-west-1."""
+    prefix = region.split("-")[0]
+    return _AREAS.get(prefix, prefix)
+
+
+def _hub_rank(region: str) -> tuple[int, str]:
+    if region in _PREFERRED_HUBS:
+        return _PREFERRED_HUBS.index(region), region
+    return len(_PREFERRED_HUBS), region
+
+
+def copy_cost(source: str, target: str) -> float:
+    return NEAR_COST if area(source) == area(target) else FAR_COST
+
+
+def makespan(source: str, plan: Mapping[str, str], limit: int) -> float:
+    """Estimate when the last copy of *plan* finishes.
+
+    *plan* maps each target region to the region it is copied from,
+    which is *source* or another target.  Each region starts copies as
+    soon as it has the image, at most *limit* at a time, copies to
+    regions that are themselves copied from first.
+    """
+    children: dict[str, list[str]] = {}
+    for target, parent in plan.items():
+        children.setdefault(parent, []).append(target)
+    ready = {source: 0.0}
+    queue = [source]
+    while queue:
+        region = queue.pop()
+        slots = [ready[region]] * limit
+        order = sorted(
+            children.get(region, []),
+            key=lambda t: (t not in children, -copy_cost(region, t)),
+        )
+        for target in order:
+            start = heapq.heappop(slots)
+            ready[target] = start + copy_cost(region, target)
+            heapq.heappush(slots, ready[target])
+            queue.append(target)
+    if len(ready) != len(plan) + 1:
+        raise ValueError("copy plan does not lead from the source to every target")
+    return max(ready.values())
+
+
+def plan_copies(
+    source: str,
+    targets: Iterable[str],
+    limit: int = COPY_CONCURRENCY,
+    exclude_hubs: Collection[str] = (),
+) -> dict[str, str]:
+    """Map each target region to the region to copy the image from.
+
+    Starts with copying everything from *source* and makes an area's
+    hub the parent of the area's other targets wherever that lowers the
+    :func:`makespan`.  Regions in *exclude_hubs*, e.g. best-effort ones,
+    are never hubs.
+    """
+    targets = sorted(set(targets) - {source})
+    plan = {target: source for target in targets}
+    by_area: dict[str, list[str]] = {}
+    for target in targets:
+        if area(target) != area(source):
+            by_area.setdefault(area(target), []).append(target)
+    best = makespan(source, plan, limit)
+    for regions in by_area.values():
+        candidates = [r for r in regions if r not in exclude_hubs]
+        if len(regions) < 2 or not candidates:
+            continue
+        hub = min(candidates, key=_hub_rank)
+        trial = dict(plan)
+        for region in regions:
+            if region != hub:
+                trial[region] = hub
+        cost = makespan(source, trial, limit)
+        if cost < best:
+            plan, best = trial, cost
+    return plan
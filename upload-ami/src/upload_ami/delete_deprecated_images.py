@@ -1,67 +1,284 @@
+"""Garbage collection of deprecated images and their snapshots.
+
+Works in two phases.  :func:`plan_region` lists the images of a region
+once and picks those deprecated longer ago than the grace period; the
+plans of all regions together are a JSON document like::
+
+    {
+      "created_at": "2025-06-01T12:00:00+00:00",
+      "grace_period_days": 0,
+      "regions": {
+        "eu-west-1": [
+          {
+            "image_id": "ami-0123",
+            "name": "nixos/24.05...",
+            "deprecation_time": "2025-05-01T00:00:00+00:00",
+            "snapshot_ids": ["snap-0123"]
+          }
+        ]
+      }
+    }
+
+:func:`apply_region` then deregisters each planned image together with
+its snapshots in one DeregisterImage call, several images at once.  EC2
+keeps snapshots that another image still uses.  Snapshots left over by
+an earlier apply that was interrupted after deregistering are deleted
+one by one.
+
+--dry-run only plans, so it changes nothing and is done after one
+listing per region.  --plan-out writes the plan, and --plan applies a
+plan written earlier without planning again.  The planned images of a
+region are described again, a filter's worth per call, before deleting,
+and those that no longer qualify are kept.  Plans older than
+--max-plan-age are refused.  With --inventory, the
+images are looked up in the local inventory instead of listed.
+"""
+
 import logging
-import boto3
-from mypy_boto3_ec2 import EC2Client
 import argparse
-import botocore.exceptions
 import datetime
+import json
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from .inventory import (
+    MAX_FILTER_VALUES,
+    Inventory,
+    add_inventory_argument,
+    open_inventory,
+)
+from .regions import PER_REGION_CONCURRENCY, RegionExecutor, map_concurrently
+
+if TYPE_CHECKING:
+    import botocore.exceptions
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_ec2.type_defs import ImageTypeDef
 
 logger = logging.getLogger(__name__)
 
 
+def _images(ec2: "EC2Client", inventory: Inventory | None) -> list["ImageTypeDef"]:
+    if inventory is not None:
+        inventory.refresh(ec2)
+        return inventory.images(ec2.meta.region_name)
+    return [
+        image
+        for page in ec2.get_paginator("describe_images").paginate(Owners=["self"])
+        for image in page["Images"]
+    ]
+
+
+def _qualifies(image: "ImageTypeDef", cutoff: datetime.datetime) -> bool:
+    assert "Name" in image
+    if image["Name"].startswith("nixos/23.11"):
+        return True
+    if "DeprecationTime" not in image:
+        return False
+    return datetime.datetime.fromisoformat(image["DeprecationTime"]) <= cutoff
+
+
+def plan_region(
+    ec2: "EC2Client",
+    now: datetime.datetime,
+    grace_period_days: int = 0,
+    inventory: Inventory | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Return the images deprecated more than grace_period_days before now,
+    with their snapshots
+
+    Images of NixOS 23.11 are always included. Snapshots that an image
+    outside the plan also uses are left out.
+
+    With an inventory, takes the images from it after refreshing it.
+    """
+    cutoff = now - datetime.timedelta(days=grace_period_days)
+    planned: list[dict[str, Any]] = []
+    in_use: set[str] = set()
+    for image in _images(ec2, inventory):
+        assert "ImageId" in image
+        assert "Name" in image
+        snapshot_ids = [
+            mapping["Ebs"]["SnapshotId"]
+            for mapping in image.get("BlockDeviceMappings", [])
+            if "SnapshotId" in mapping.get("Ebs", {})
+        ]
+        deprecation_time = None
+        if "DeprecationTime" in image:
+            deprecation_time = datetime.datetime.fromisoformat(image["DeprecationTime"])
+        if _qualifies(image, cutoff):
+            planned.append(
+                {
+                    "image_id": image["ImageId"],
+                    "name": image["Name"],
+                    "deprecation_time": (
+                        deprecation_time.isoformat() if deprecation_time else None
+                    ),
+                    "snapshot_ids": snapshot_ids,
+                }
+            )
+        else:
+            in_use.update(snapshot_ids)
+    for entry in planned:
+        entry["snapshot_ids"] = [s for s in entry["snapshot_ids"] if s not in in_use]
+    return planned
+
+
+def _error_code(error: "botocore.exceptions.ClientError") -> str:
+    return error.response.get("Error", {}).get("Code", "")
+
+
+def _describe_images(
+    ec2: "EC2Client", image_ids: list[str]
+) -> dict[str, "ImageTypeDef"]:
+    described = {}
+    for i in range(0, len(image_ids), MAX_FILTER_VALUES):
+        # A filter rather than ImageIds, which fails if one is gone.
+        pages = ec2.get_paginator("describe_images").paginate(
+            Owners=["self"],
+            IncludeDeprecated=True,
+            IncludeDisabled=True,
+            Filters=[
+                {"Name": "image-id", "Values": image_ids[i : i + MAX_FILTER_VALUES]}
+            ],
+        )
+        for page in pages:
+            for image in page["Images"]:
+                assert "ImageId" in image
+                described[image["ImageId"]] = image
+    return described
+
+
+def apply_image(
+    ec2: "EC2Client",
+    image: dict[str, Any],
+    exists: bool = True,
+    inventory: Inventory | None = None,
+) -> None:
+    """
+    Deregister a planned image and delete its snapshots
+
+    If the image no longer exists, only the snapshots left over by an
+    earlier apply are deleted.
+
+    Idempotent: images and snapshots that are already gone are skipped.
+    They are forgotten in the inventory, if given.
+    """
+    import botocore.exceptions
+
+    region = ec2.meta.region_name
+    logger.info(
+        f"Deleting image {image['name']} : {image['image_id']}. DeprecationTime: {image['deprecation_time']}"
+    )
+    result = None
+    if exists:
+        try:
+            result = ec2.deregister_image(
+                ImageId=image["image_id"], DeleteAssociatedSnapshots=True
+            )
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) not in (
+                "InvalidAMIID.NotFound",
+                "InvalidAMIID.Unavailable",
+            ):
+                raise
+    if result is None:
+        remaining = image["snapshot_ids"]
+        kept = set()
+    else:
+        results = result.get("DeleteSnapshotResults", [])
+        # "skipped" snapshots are used by another image.
+        remaining = [
+            r["SnapshotId"]
+            for r in results
+            if "SnapshotId" in r and r.get("ReturnCode") not in ("success", "skipped")
+        ]
+        kept = {
+            r["SnapshotId"]
+            for r in results
+            if "SnapshotId" in r and r.get("ReturnCode") == "skipped"
+        }
+    if inventory is not None:
+        inventory.forget_image(region, image["image_id"])
+    for snapshot_id in remaining:
+        logger.info(f"Deleting snapshot {snapshot_id}")
+        try:
+            ec2.delete_snapshot(SnapshotId=snapshot_id)
+        except botocore.exceptions.ClientError as e:
+            if _error_code(e) == "InvalidSnapshot.InUse":
+                logger.info(f"Keeping snapshot {snapshot_id}, another image uses it")
+                kept.add(snapshot_id)
+            elif _error_code(e) != "InvalidSnapshot.NotFound":
+                raise
+    if inventory is not None:
+        for snapshot_id in image["snapshot_ids"]:
+            if snapshot_id not in kept:
+                inventory.forget_snapshot(region, snapshot_id)
+
+
+def apply_region(
+    ec2: "EC2Client",
+    images: list[dict[str, Any]],
+    cutoff: datetime.datetime,
+    concurrency: int = PER_REGION_CONCURRENCY,
+    inventory: Inventory | None = None,
+) -> None:
+    """
+    Delete the planned images of a region, up to concurrency at once
+
+    The images are described again first, and those no longer deprecated
+    at or before cutoff are kept, so that a stale plan deletes nothing it
+    would not plan now.
+    """
+    current = _describe_images(ec2, [image["image_id"] for image in images])
+    stale = {
+        image_id for image_id, image in current.items() if not _qualifies(image, cutoff)
+    }
+    for image in images:
+        if image["image_id"] in stale:
+            logger.warning(
+                f"Keeping image {image['name']} : {image['image_id']}, it is no longer deprecated before {cutoff.isoformat()}"
+            )
+    map_concurrently(
+        lambda image: apply_image(ec2, image, image["image_id"] in current, inventory),
+        [image for image in images if image["image_id"] not in stale],
+        concurrency,
+    )
+
+
+def plan_cutoff(plan: dict[str, Any]) -> datetime.datetime:
+    """
+    Return the deprecation time up to which plan deletes images
+    """
+    created_at = datetime.datetime.fromisoformat(plan["created_at"])
+    return created_at - datetime.timedelta(days=plan["grace_period_days"])
+
+
 def delete_deprecated_images(
-    ec2: EC2Client, dry_run: bool, grace_period_days: int = 0
+    ec2: "EC2Client",
+    dry_run: bool,
+    grace_period_days: int = 0,
+    concurrency: int = PER_REGION_CONCURRENCY,
+    inventory: Inventory | None = None,
 ) -> None:
     """
-    Delete an image by its name.
+    Delete the images whose deprecation time is more than
+    grace_period_days ago, and their snapshots
 
-    Name can be a filter
+    Plans and applies in one go; see plan_region and apply_region.
 
     Idempotent, unlike nuke
     """
-
-    images_paginator = ec2.get_paginator("describe_images")
-    images_iterator = images_paginator.paginate(Owners=["self"])
-    for pages in images_iterator:
-        for image in pages["Images"]:
-            assert "Name" in image
-            if image["Name"].startswith("nixos/23.11") or "DeprecationTime" in image:
-                # HACK: As python can not parse ISO8601 strings with
-                # milliseconds, but it **can** produce them, instead of parsing
-                # the datetime from the API, we format the current time as an
-                # ISO8601 string and compare the strings. This works because
-                # ISO8601 strings are lexicographically comparable.
-                current_time = datetime.datetime.isoformat(
-                    datetime.datetime.now()
-                    - datetime.timedelta(days=grace_period_days),
-                    timespec="milliseconds",
-                )
-                if (
-                    image["Name"].startswith("nixos/23.11")
-                    or current_time >= image["DeprecationTime"]
-                ):
-                    assert "ImageId" in image
-                    logger.info(
-                        f"Deleting image {image['Name']} : {image['ImageId']}. DeprecationTime: {image.get('DeprecationTime')}"
-                    )
-                    try:
-                        ec2.deregister_image(ImageId=image["ImageId"], DryRun=dry_run)
-                    except botocore.exceptions.ClientError as e:
-                        if "DryRunOperation" in str(e):
-                            logger.info(f"Would have deleted image {image['ImageId']}")
-                        else:
-                            raise
-                    assert "BlockDeviceMappings" in image
-                    assert "Ebs" in image["BlockDeviceMappings"][0]
-                    assert "SnapshotId" in image["BlockDeviceMappings"][0]["Ebs"]
-                    snapshot_id = image["BlockDeviceMappings"][0]["Ebs"]["SnapshotId"]
-                    logger.info(f"Deleting snapshot {snapshot_id}")
-                    try:
-                        ec2.delete_snapshot(SnapshotId=snapshot_id, DryRun=dry_run)
-                    except botocore.exceptions.ClientError as e:
-                        if "DryRunOperation" in str(e):
-                            logger.info(f"Would have deleted snapshot {snapshot_id}")
-                        else:
-                            raise
+    now = datetime.datetime.now(datetime.timezone.utc)
+    images = plan_region(ec2, now, grace_period_days, inventory)
+    cutoff = now - datetime.timedelta(days=grace_period_days)
+    if dry_run:
+        for image in images:
+            logger.info(
+                f"Would have deleted image {image['image_id']} and snapshots {image['snapshot_ids']}"
+            )
+        return
+    apply_region(ec2, images, cutoff, concurrency, inventory)
 
 
 def main() -> None:
@@ -84,24 +301,81 @@ def main() -> None:
         action="append",
         default=[],
     )
+    parser.add_argument(
+        "--plan-out",
+        type=Path,
+        metavar="FILE",
+        help="Write the plan of what to delete to FILE as JSON",
+    )
+    parser.add_argument(
+        "--plan",
+        type=Path,
+        metavar="FILE",
+        help="Delete what a plan written earlier with --plan-out lists, instead of planning again",
+    )
+    parser.add_argument(
+        "--max-plan-age",
+        type=float,
+        default=24,
+        metavar="HOURS",
+        help="Refuse to apply a --plan created longer ago than this (default: 24)",
+    )
+    add_inventory_argument(parser)
+    args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
+    executor = RegionExecutor(best_effort_regions=args.best_effort_region)
+    inventory = open_inventory(args)
 
-    args = parser.parse_args()
-    regions = ec2.describe_regions()["Regions"]
-    for region in regions:
-        assert "RegionName" in region
-        region_name = region["RegionName"]
-        ec2r = boto3.client("ec2", region_name=region_name)
-        logging.info(f"Checking region {region_name}")
-        try:
-            delete_deprecated_images(ec2r, args.dry_run, args.grace_period)
-        except Exception as e:
-            if region_name not in args.best_effort_region:
-                raise
-            logging.warning(
-                f"Deleting deprecated images in {region_name} failed (best-effort, ignoring): {e}"
+    if args.plan is not None:
+        plan = json.loads(args.plan.read_text())
+        age = datetime.datetime.now(
+            datetime.timezone.utc
+        ) - datetime.datetime.fromisoformat(plan["created_at"])
+        if age > datetime.timedelta(hours=args.max_plan_age):
+            parser.error(
+                f"{args.plan} was created {age} ago, more than --max-plan-age {args.max_plan_age:g} hours"
             )
+    else:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        plan = {
+            "created_at": now.isoformat(),
+            "grace_period_days": args.grace_period,
+            "regions": executor.run(
+                lambda region: plan_region(
+                    executor.ec2(region), now, args.grace_period, inventory
+                ),
+                executor.regions(),
+                "Planning deletion of deprecated images",
+            ),
+        }
+    if args.plan_out is not None:
+        args.plan_out.write_text(json.dumps(plan, indent=2) + "\n")
+
+    planned = {region: images for region, images in plan["regions"].items() if images}
+    logging.info(
+        f"Plan: {sum(len(images) for images in planned.values())} images"
+        f" and {sum(len(i['snapshot_ids']) for v in planned.values() for i in v)}"
+        f" snapshots in {len(planned)} regions"
+    )
+    if args.dry_run:
+        for region, images in planned.items():
+            for image in images:
+                logging.info(
+                    f"Would have deleted image {image['image_id']} in {region} and snapshots {image['snapshot_ids']}"
+                )
+        return
+    cutoff = plan_cutoff(plan)
+    executor.run(
+        lambda region: apply_region(
+            executor.ec2(region),
+            planned[region],
+            cutoff,
+            executor.per_region,
+            inventory,
+        ),
+        planned,
+        "Deleting deprecated images",
+    )
 
 
 if __name__ == "__main__":
@@ -1,39 +1,65 @@
 import logging
-import boto3
-from mypy_boto3_ec2 import EC2Client
 import argparse
-import botocore.exceptions
+from typing import TYPE_CHECKING
+
+from .inventory import Inventory, add_inventory_argument, open_inventory
+from .regions import PER_REGION_CONCURRENCY, RegionExecutor, map_concurrently
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_ec2.type_defs import SnapshotTypeDef
 
 logger = logging.getLogger(__name__)
 
 
-def delete_images_by_name(ec2: EC2Client, image_name: str, dry_run: bool) -> None:
+def delete_images_by_name(
+    ec2: "EC2Client",
+    image_name: str,
+    dry_run: bool,
+    concurrency: int = PER_REGION_CONCURRENCY,
+    inventory: Inventory | None = None,
+) -> None:
     """
     Delete an image by its name.
 
     Name can be a filter
 
+    Deletes up to concurrency snapshots and their images at once.
+
+    With an inventory, looks the snapshots and images up in it after
+    refreshing it, and forgets what it deletes.
+
     Idempotent, unlike nuke
     """
     logger.info(f"Deleting image by name {image_name}")
-    snapshots = ec2.describe_snapshots(
-        OwnerIds=["self"], Filters=[{"Name": "tag:Name", "Values": [image_name]}]
-    )
-    logger.info(f"Deleting {len(snapshots['Snapshots'])} snapshots")
+    region = ec2.meta.region_name
+    if inventory is None:
+        snapshots = ec2.describe_snapshots(
+            OwnerIds=["self"], Filters=[{"Name": "tag:Name", "Values": [image_name]}]
+        )["Snapshots"]
+    else:
+        inventory.refresh(ec2)
+        snapshots = inventory.snapshots(region, tags={"Name": image_name})
+    logger.info(f"Deleting {len(snapshots)} snapshots")
+
+    def delete(snapshot: "SnapshotTypeDef") -> None:
+        import botocore.exceptions
 
-    for snapshot in snapshots["Snapshots"]:
         assert "SnapshotId" in snapshot
-        images = ec2.describe_images(
-            Owners=["self"],
-            Filters=[
-                {
-                    "Name": "block-device-mapping.snapshot-id",
-                    "Values": [snapshot["SnapshotId"]],
-                }
-            ],
-        )
-        logger.info(f"Deleting {len(images['Images'])} images")
-        for image in images["Images"]:
+        if inventory is None:
+            images = ec2.describe_images(
+                Owners=["self"],
+                Filters=[
+                    {
+                        "Name": "block-device-mapping.snapshot-id",
+                        "Values": [snapshot["SnapshotId"]],
+                    }
+                ],
+            )["Images"]
+        else:
+            images = inventory.images(region, snapshot_id=snapshot["SnapshotId"])
+        logger.info(f"Deleting {len(images)} images")
+        for image in images:
             assert "ImageId" in image
             logger.info(f"Deregistering {image['ImageId']}")
             try:
@@ -41,6 +67,9 @@ def delete_images_by_name(ec2: EC2Client, image_name: str, dry_run: bool) -> Non
             except botocore.exceptions.ClientError as e:
                 if "DryRunOperation" not in str(e):
                     raise e
+            else:
+                if inventory is not None:
+                    inventory.forget_image(region, image["ImageId"])
 
         logger.info(f"Deleting {snapshot['SnapshotId']}")
         try:
@@ -48,6 +77,11 @@ def delete_images_by_name(ec2: EC2Client, image_name: str, dry_run: bool) -> Non
         except botocore.exceptions.ClientError as e:
             if "DryRunOperation" not in str(e):
                 raise e
+        else:
+            if inventory is not None:
+                inventory.forget_snapshot(region, snapshot["SnapshotId"])
+
+    map_concurrently(delete, snapshots, concurrency)
 
 
 def main() -> None:
@@ -64,18 +98,22 @@ def main() -> None:
         action="store_true",
         help="Do not actually delete anything, just log what would be deleted",
     )
-    logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
-
+    add_inventory_argument(parser)
     args = parser.parse_args()
-    regions = ec2.describe_regions()["Regions"]
-    for region in regions:
-        assert "RegionName" in region
-        ec2r = boto3.client("ec2", region_name=region["RegionName"])
-        logger.info(
-            f"Deleting image by name {args.image_name} in {region['RegionName']}"
-        )
-        delete_images_by_name(ec2r, args.image_name, args.dry_run)
+    logging.basicConfig(level=logging.INFO)
+    executor = RegionExecutor()
+    inventory = open_inventory(args)
+    executor.run(
+        lambda region: delete_images_by_name(
+            executor.ec2(region),
+            args.image_name,
+            args.dry_run,
+            executor.per_region,
+            inventory,
+        ),
+        executor.regions(),
+        f"Deleting image by name {args.image_name}",
+    )
 
 
 if __name__ == "__main__":
@@ -1,40 +1,94 @@
 import logging
-import boto3
-from mypy_boto3_ec2 import EC2Client
 import argparse
-import botocore.exceptions
+from typing import TYPE_CHECKING
 
+from .inventory import Inventory, add_inventory_argument, open_inventory
+from .regions import PER_REGION_CONCURRENCY, RegionExecutor, map_concurrently
 
-def delete_orphaned_snapshots(ec2: EC2Client, dry_run: bool) -> None:
-    snapshot_paginator = ec2.get_paginator("describe_snapshots")
-    snapshot_iterator = snapshot_paginator.paginate(
-        OwnerIds=["self"], Filters=[{"Name": "tag:ManagedBy", "Values": ["NixOS/amis"]}]
-    )
-    for pages in snapshot_iterator:
-        for snapshot in pages["Snapshots"]:
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+
+
+def referenced_snapshots(ec2: "EC2Client") -> set[str]:
+    """Return the snapshots used by any image owned by the account."""
+    referenced = set()
+    for page in ec2.get_paginator("describe_images").paginate(
+        Owners=["self"], IncludeDeprecated=True, IncludeDisabled=True
+    ):
+        for image in page["Images"]:
+            for mapping in image.get("BlockDeviceMappings", []):
+                snapshot_id = mapping.get("Ebs", {}).get("SnapshotId")
+                if snapshot_id is not None:
+                    referenced.add(snapshot_id)
+    return referenced
+
+
+def delete_orphaned_snapshots(
+    ec2: "EC2Client",
+    dry_run: bool,
+    concurrency: int = PER_REGION_CONCURRENCY,
+    inventory: Inventory | None = None,
+) -> None:
+    """
+    Delete the completed snapshots managed by NixOS/amis that no image uses
+
+    Lists the snapshots and then all images, and deletes the difference,
+    so the calls grow with the number of pages rather than snapshots.
+    Deletes up to concurrency snapshots at once.  Listing the snapshots first means that an image registered in
+    between is still seen.
+
+    With an inventory, takes both from it after refreshing it, and
+    forgets what it deletes.
+    """
+    region = ec2.meta.region_name
+    snapshot_ids = set()
+    if inventory is None:
+        for page in ec2.get_paginator("describe_snapshots").paginate(
+            OwnerIds=["self"],
+            Filters=[
+                {"Name": "tag:ManagedBy", "Values": ["NixOS/amis"]},
+                # Snapshots still being written have no image yet.
+                {"Name": "status", "Values": ["completed"]},
+            ],
+        ):
+            for snapshot in page["Snapshots"]:
+                assert "SnapshotId" in snapshot
+                snapshot_ids.add(snapshot["SnapshotId"])
+        referenced = referenced_snapshots(ec2)
+    else:
+        inventory.refresh(ec2)
+        for snapshot in inventory.snapshots(
+            region, tags={"ManagedBy": "NixOS/amis"}, state="completed"
+        ):
             assert "SnapshotId" in snapshot
-            snapshot_id = snapshot["SnapshotId"]
-            logging.info(f"Checking snapshot {snapshot_id}")
-            images = ec2.describe_images(
-                Filters=[
-                    {
-                        "Name": "block-device-mapping.snapshot-id",
-                        "Values": [snapshot_id],
-                    }
-                ],
-                MaxResults=6,
-            )
-            if len(images["Images"]) == 0:
-                logging.info(f"Deleting orphaned snapshot {snapshot_id}")
-                try:
-                    ec2.delete_snapshot(SnapshotId=snapshot_id, DryRun=dry_run)
-                except botocore.exceptions.ClientError as e:
-                    if "DryRunOperation" in str(e):
-                        logging.info(
-                            f"Would have deleted orphaned snapshot {snapshot_id}"
-                        )
-                    else:
-                        raise
+            snapshot_ids.add(snapshot["SnapshotId"])
+        referenced = inventory.referenced_snapshots(region)
+    orphaned = sorted(snapshot_ids - referenced)
+    logging.info(
+        f"{len(orphaned)} of {len(snapshot_ids)} snapshots are not used by any image"
+    )
+
+    def delete(snapshot_id: str) -> None:
+        import botocore.exceptions
+
+        logging.info(f"Deleting orphaned snapshot {snapshot_id}")
+        try:
+            ec2.delete_snapshot(SnapshotId=snapshot_id, DryRun=dry_run)
+        except botocore.exceptions.ClientError as e:
+            if "DryRunOperation" in str(e):
+                logging.info(f"Would have deleted orphaned snapshot {snapshot_id}")
+            elif e.response.get("Error", {}).get("Code") == "InvalidSnapshot.NotFound":
+                # Deleted since it was listed, e.g. a stale inventory entry.
+                logging.info(f"Orphaned snapshot {snapshot_id} is already gone")
+                if inventory is not None:
+                    inventory.forget_snapshot(region, snapshot_id)
+            else:
+                raise
+        else:
+            if inventory is not None:
+                inventory.forget_snapshot(region, snapshot_id)
+
+    map_concurrently(delete, orphaned, concurrency)
 
 
 def main() -> None:
@@ -44,12 +98,15 @@ def main() -> None:
         action="store_true",
         help="Do not actually delete anything, just log what would be deleted",
     )
-    logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
+    add_inventory_argument(parser)
     args = parser.parse_args()
-    regions = ec2.describe_regions()["Regions"]
-    for region in regions:
-        assert "RegionName" in region
-        ec2 = boto3.client("ec2", region_name=region["RegionName"])
-        logging.info(f"Checking region {region['RegionName']}")
-        delete_orphaned_snapshots(ec2, args.dry_run)
+    logging.basicConfig(level=logging.INFO)
+    executor = RegionExecutor()
+    inventory = open_inventory(args)
+    executor.run(
+        lambda region: delete_orphaned_snapshots(
+            executor.ec2(region), args.dry_run, executor.per_region, inventory
+        ),
+        executor.regions(),
+        "Deleting orphaned snapshots",
+    )
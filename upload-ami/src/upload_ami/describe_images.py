@@ -1,9 +1,10 @@
 import argparse
 import logging
-import boto3
 import json
+from typing import Any
 
-from mypy_boto3_ec2 import EC2Client
+from .inventory import add_inventory_argument, open_inventory
+from .regions import RegionExecutor
 
 
 def main() -> None:
@@ -14,32 +15,21 @@ def main() -> None:
         action="append",
         default=[],
     )
+    add_inventory_argument(parser)
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
-    regions = ec2.describe_regions()["Regions"]
-
-    images = {}
-
-    for region in regions:
-        assert "RegionName" in region
-        region_name = region["RegionName"]
-        ec2r = boto3.client("ec2", region_name=region_name)
-
-        try:
-            result = ec2r.describe_images(
-                Owners=["self"],
-                ExecutableUsers=["all"],
-            )
-        except Exception as e:
-            if region_name not in args.best_effort_region:
-                raise
-            logging.warning(
-                f"Describing images in {region_name} failed (best-effort, ignoring): {e}"
-            )
-            continue
-        images[region_name] = result
+    executor = RegionExecutor(best_effort_regions=args.best_effort_region)
+    inventory = open_inventory(args)
+
+    def describe(region: str) -> Any:
+        ec2 = executor.ec2(region)
+        if inventory is None:
+            return ec2.describe_images(Owners=["self"], ExecutableUsers=["all"])
+        inventory.refresh(ec2)
+        return {"Images": inventory.images(region, public=True)}
+
+    images = executor.run(describe, executor.regions(), "Describing images")
 
     print(json.dumps(images, indent=2))
 
@@ -1,22 +1,31 @@
-import boto3
+from . import clients
+import argparse
 import logging
 import time
 from concurrent.futures import ThreadPoolExecutor
-from mypy_boto3_ec2.type_defs import RegionTypeDef
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.type_defs import RegionTypeDef
 
 
 def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Disable image block public access in every region, so "
+        "that images can be made public, and wait until it has applied."
+    )
+    parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    ec2 = boto3.client("ec2")
+    ec2 = clients.ec2()
     regions = ec2.describe_regions()["Regions"]
 
-    def disable_image_block_public_access(region: RegionTypeDef) -> None:
+    def disable_image_block_public_access(region: "RegionTypeDef") -> None:
         assert "RegionName" in region
         logging.info(
             "disabling image block public access in %s. Can take some minutes to apply",
             region["RegionName"],
         )
-        ec2 = boto3.client("ec2", region_name=region["RegionName"])
+        ec2 = clients.ec2(region["RegionName"])
         ec2.disable_image_block_public_access()
 
         while True:
@@ -1,5 +1,5 @@
-import boto3
-from mypy_boto3_account import AccountClient
+from . import clients
+import argparse
 import logging
 
 
@@ -9,8 +9,13 @@ def main() -> None:
 
     Due to rate limiting, you might  need to run this multiple times.
     """
+    parser = argparse.ArgumentParser(
+        description="Enable all regions that are disabled. Due to rate limiting, "
+        "you might need to run this multiple times."
+    )
+    parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    account: AccountClient = boto3.client("account")
+    account = clients.account()
     pages = account.get_paginator("list_regions").paginate(
         RegionOptStatusContains=["DISABLED"]
     )
@@ -0,0 +1,325 @@
+"""Local stand-in for the EBS Direct APIs, for offline benchmarks.
+
+Implements StartSnapshot, PutSnapshotBlock, CompleteSnapshot,
+ListSnapshotBlocks and GetSnapshotBlock closely enough for
+:mod:`.snapshot_uploader`, with configurable per-request latency and
+injected throttling and server errors.  Block data is kept in memory
+so that uploads can be verified, so size benchmark images to fit.
+Client tokens are scoped to the region a request is signed for, so one
+server can stand in for several regions.  A snapshot started with a
+ParentSnapshotId begins with the blocks of that completed snapshot.
+
+The server runs in a child process so that its CPU time and the GIL do
+not skew measurements of the uploader::
+
+    with FakeEbsServer(latency=0.02, throttle_rate=0.01) as server:
+        with server.environment():
+            upload_snapshot(path, region="us-east-1")
+"""
+
+import base64
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Iterator, Self
+from urllib.parse import parse_qs, urlsplit
+
+from .block_source import BLOCK_SIZE
+
+_BLOCK = re.compile(r"/snapshots/([^/]+)/blocks/(\d+)$")
+_BLOCKS = re.compile(r"/snapshots/([^/]+)/blocks$")
+_COMPLETION = re.compile(r"/snapshots/completion/([^/]+)$")
+_CREDENTIAL_REGION = re.compile(r"Credential=[^/]+/[^/]+/([^/]+)/")
+
+
+@dataclass
+class FaultConfig:
+    """Latency and fault injection of a :class:`FakeEbsServer`.
+
+    *latency* is added to every PutSnapshotBlock and GetSnapshotBlock.
+    *throttle_rate* and *error_rate* are the fractions of these calls
+    answered with a ThrottlingException or an InternalServerException.
+    """
+
+    latency: float = 0.0
+    throttle_rate: float = 0.0
+    error_rate: float = 0.0
+    verify: bool = True
+
+
+@dataclass
+class _Snapshot:
+    volume_size: int
+    status: str = "pending"
+    # Blocks written to this snapshot, not inherited from its parent.
+    changed: set[int] = field(default_factory=set)
+
+
+class _State:
+    def __init__(self, faults: FaultConfig) -> None:
+        self.faults = faults
+        self.lock = threading.Lock()
+        self.snapshots: dict[str, _Snapshot] = {}
+        self.tokens: dict[tuple[str, str], str] = {}
+        self.blocks: dict[str, dict[int, tuple[bytes, bytes]]] = {}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _region(self) -> str:
+        match = _CREDENTIAL_REGION.search(self.headers.get("Authorization", ""))
+        return match.group(1) if match else ""
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send(
+        self, status: int, body: dict[str, Any], headers: dict[str, str] = {}
+    ) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, code: str, message: str) -> None:
+        self._send(
+            status,
+            {"__type": code, "message": message},
+            {"x-amzn-ErrorType": code},
+        )
+
+    def do_POST(self) -> None:
+        state = self.server.state
+        body = self._body()
+        path = urlsplit(self.path).path
+        if path == "/snapshots":
+            request = json.loads(body)
+            parent_id = request.get("ParentSnapshotId")
+            with state.lock:
+                token = (
+                    self._region(),
+                    request.get("ClientToken") or str(uuid.uuid4()),
+                )
+                snapshot_id = state.tokens.get(token)
+                if snapshot_id is None:
+                    blocks = {}
+                    if parent_id is not None:
+                        parent = state.snapshots.get(parent_id)
+                        if parent is None or parent.status != "completed":
+                            return self._error(
+                                400,
+                                "ValidationException",
+                                f"Parent {parent_id} is not a completed snapshot",
+                            )
+                        blocks = dict(state.blocks[parent_id])
+                    snapshot_id = "snap-" + uuid.uuid4().hex[:17]
+                    state.tokens[token] = snapshot_id
+                    state.snapshots[snapshot_id] = _Snapshot(request["VolumeSize"])
+                    state.blocks[snapshot_id] = blocks
+                snapshot = state.snapshots[snapshot_id]
+            self._send(
+                201,
+                {
+                    "SnapshotId": snapshot_id,
+                    "Status": snapshot.status,
+                    "VolumeSize": snapshot.volume_size,
+                    "BlockSize": BLOCK_SIZE,
+                },
+            )
+        elif match := _COMPLETION.match(path):
+            snapshot_id = match.group(1)
+            changed = int(self.headers["x-amz-ChangedBlocksCount"])
+            with state.lock:
+                if snapshot_id not in state.snapshots:
+                    return self._error(404, "ResourceNotFoundException", snapshot_id)
+                written = len(state.snapshots[snapshot_id].changed)
+                if changed != written:
+                    return self._error(
+                        400,
+                        "ValidationException",
+                        f"ChangedBlocksCount {changed} but {written} blocks written",
+                    )
+                state.snapshots[snapshot_id].status = "completed"
+            self._send(202, {"Status": "completed"})
+        else:
+            self._error(404, "ResourceNotFoundException", path)
+
+    def _inject_faults(self) -> bool:
+        """Delay the request and maybe fail it; return whether it failed."""
+        faults = self.server.state.faults
+        if faults.latency:
+            time.sleep(faults.latency)
+        roll = random.random()
+        if roll < faults.throttle_rate:
+            self._error(400, "ThrottlingException", "Rate exceeded")
+            return True
+        if roll < faults.throttle_rate + faults.error_rate:
+            self._error(500, "InternalServerException", "Injected error")
+            return True
+        return False
+
+    def do_PUT(self) -> None:
+        state = self.server.state
+        faults = state.faults
+        body = self._body()
+        match = _BLOCK.match(urlsplit(self.path).path)
+        if match is None:
+            return self._error(404, "ResourceNotFoundException", self.path)
+        snapshot_id, index = match.group(1), int(match.group(2))
+        if self._inject_faults():
+            return
+        checksum = self.headers["x-amz-Checksum"]
+        if len(body) != BLOCK_SIZE:
+            return self._error(400, "ValidationException", "Invalid block size")
+        digest = base64.b64decode(checksum)
+        if faults.verify and hashlib.sha256(body).digest() != digest:
+            return self._error(400, "ValidationException", "Checksum mismatch")
+        with state.lock:
+            snapshot = state.snapshots.get(snapshot_id)
+            if snapshot is None or snapshot.status != "pending":
+                return self._error(400, "ValidationException", "Not pending")
+            state.blocks[snapshot_id][index] = (digest, body)
+            snapshot.changed.add(index)
+        self._send(
+            201,
+            {},
+            {"x-amz-Checksum": checksum, "x-amz-Checksum-Algorithm": "SHA256"},
+        )
+
+    def do_GET(self) -> None:
+        state = self.server.state
+        url = urlsplit(self.path)
+        if match := _BLOCK.match(url.path):
+            return self._get_block(match.group(1), int(match.group(2)))
+        match = _BLOCKS.match(url.path)
+        if match is None:
+            return self._error(404, "ResourceNotFoundException", self.path)
+        snapshot_id = match.group(1)
+        query = parse_qs(url.query)
+        start = int(query.get("pageToken", query.get("startingBlockIndex", ["0"]))[0])
+        limit = int(query.get("maxResults", ["10000"])[0])
+        with state.lock:
+            if snapshot_id not in state.snapshots:
+                return self._error(404, "ResourceNotFoundException", snapshot_id)
+            indices = sorted(i for i in state.blocks[snapshot_id] if i >= start)
+            volume_size = state.snapshots[snapshot_id].volume_size
+        response: dict[str, Any] = {
+            "Blocks": [
+                {"BlockIndex": i, "BlockToken": f"{snapshot_id}:{i}"}
+                for i in indices[:limit]
+            ],
+            "BlockSize": BLOCK_SIZE,
+            "VolumeSize": volume_size,
+        }
+        if len(indices) > limit:
+            response["NextToken"] = str(indices[limit])
+        self._send(200, response)
+
+    def _get_block(self, snapshot_id: str, index: int) -> None:
+        state = self.server.state
+        if self._inject_faults():
+            return
+        with state.lock:
+            snapshot = state.snapshots.get(snapshot_id)
+            if snapshot is None or snapshot.status != "completed":
+                return self._error(404, "ResourceNotFoundException", snapshot_id)
+            block = state.blocks[snapshot_id].get(index)
+        if block is None:
+            return self._error(404, "ResourceNotFoundException", f"Block {index}")
+        digest, data = block
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("x-amz-Data-Length", str(len(data)))
+        self.send_header("x-amz-Checksum", base64.b64encode(digest).decode())
+        self.send_header("x-amz-Checksum-Algorithm", "SHA256")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, faults: FaultConfig) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.state = _State(faults)
+
+
+def _serve(faults: FaultConfig, conn: multiprocessing.connection.Connection) -> None:
+    server = _Server(faults)
+    conn.send(server.server_port)
+    server.serve_forever()
+
+
+class FakeEbsServer:
+    """A :class:`_Server` in a child process; use as a context manager."""
+
+    def __init__(self, **faults: Any) -> None:
+        self.faults = FaultConfig(**faults)
+        self.port = 0
+        self._process: multiprocessing.Process | None = None
+
+    @property
+    def endpoint_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> Self:
+        parent, child = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(
+            target=_serve, args=(self.faults, child), daemon=True
+        )
+        self._process.start()
+        self.port = parent.recv()
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    @contextmanager
+    def environment(self) -> Iterator[None]:
+        """Point boto3 clients created inside the block at this server.
+
+        Dummy credentials are set so that no real AWS account is used.
+        EC2 is pointed here too, so the uploader's cleanup after a failed
+        upload fails fast instead of reaching AWS.
+        """
+        overrides = {
+            "AWS_ENDPOINT_URL_EBS": self.endpoint_url,
+            "AWS_ENDPOINT_URL_EC2": self.endpoint_url,
+            "AWS_ACCESS_KEY_ID": "fake",
+            "AWS_SECRET_ACCESS_KEY": "fake",
+            "AWS_EC2_METADATA_DISABLED": "true",
+        }
+        saved = {key: os.environ.get(key) for key in overrides}
+        saved["AWS_SESSION_TOKEN"] = os.environ.pop("AWS_SESSION_TOKEN", None)
+        os.environ.update(overrides)
+        try:
+            yield
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
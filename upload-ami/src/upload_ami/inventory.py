@@ -0,0 +1,600 @@
+"""A local database of the images and snapshots in every region.
+
+The housekeeping commands and the images page each used to list every
+image and snapshot of every region again on each run.  With
+``--inventory`` they ask an SQLite database instead, by default
+``<state dir>/inventory.sqlite``, which holds the images and snapshots
+of the account with their tags, deprecation times and block device
+mappings, indexed for the lookups the commands make::
+
+    inventory = Inventory(default_path())
+    inventory.refresh(ec2)
+    images = inventory.images(ec2.meta.region_name, name="nixos/24.05*")
+
+Lookups return the dicts DescribeImages and DescribeSnapshots return,
+except that the times of snapshots are ISO 8601 strings.
+
+:meth:`Inventory.refresh` lists a region completely once its last
+complete listing is older than :data:`FULL_REFRESH_AFTER`.  Otherwise it
+only lists the images created since the day before the last refresh,
+using the creation-date filter, and the snapshots those images use.
+Images and snapshots deleted by others, and snapshots no image uses,
+show up with the next complete listing; the commands forget what they
+delete themselves right away.  A complete listing is committed a page at
+a time together with the token of the next page, so an interrupted one
+carries on where it stopped.
+
+``amis inventory`` refreshes all regions.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Mapping, cast
+
+from .regions import RegionExecutor
+from .state import default_state_dir
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+    from mypy_boto3_ec2.type_defs import ImageTypeDef, SnapshotTypeDef
+
+log = logging.getLogger(__name__)
+
+# Bump when the schema changes; the inventory is then rebuilt.
+VERSION = 1
+
+# Age of the last complete listing of a region that makes refresh list
+# the region completely again.
+FULL_REFRESH_AFTER = datetime.timedelta(days=1)
+# Beyond this, listing the images created since the last refresh by day
+# takes more filter values than a complete listing takes pages.
+MAX_INCREMENTAL_DAYS = 31
+PAGE_SIZE = 1000
+# Values per filter that EC2 accepts.
+MAX_FILTER_VALUES = 200
+
+SCHEMA = """
+CREATE TABLE images (
+    region TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT,
+    public INTEGER NOT NULL,
+    creation_date TEXT,
+    deprecation_time TEXT,
+    generation INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (region, image_id)
+);
+CREATE INDEX images_name ON images (region, name);
+CREATE TABLE snapshots (
+    region TEXT NOT NULL,
+    snapshot_id TEXT NOT NULL,
+    state TEXT,
+    start_time TEXT,
+    generation INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (region, snapshot_id)
+);
+CREATE TABLE block_device_mappings (
+    region TEXT NOT NULL,
+    image_id TEXT NOT NULL,
+    device_name TEXT,
+    snapshot_id TEXT NOT NULL
+);
+CREATE INDEX block_device_mappings_image ON block_device_mappings (region, image_id);
+CREATE INDEX block_device_mappings_snapshot ON block_device_mappings (region, snapshot_id);
+CREATE TABLE tags (
+    region TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (region, resource_id, key)
+);
+CREATE INDEX tags_value ON tags (region, key, value);
+-- One row per region and kind ("images" or "snapshots").  A complete
+-- listing gives everything it sees the next generation and then drops
+-- what still has an older one.  While it runs, listing is 1 and
+-- next_token is the token of the next page.
+CREATE TABLE refreshes (
+    region TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    generation INTEGER NOT NULL,
+    listing INTEGER NOT NULL,
+    next_token TEXT,
+    full_refreshed_at TEXT,
+    refreshed_at TEXT,
+    PRIMARY KEY (region, kind)
+);
+"""
+
+
+def default_path() -> Path:
+    return default_state_dir() / "inventory.sqlite"
+
+
+def add_inventory_argument(parser: argparse.ArgumentParser) -> None:
+    """Add the ``--inventory`` option of the commands that can use one."""
+    parser.add_argument(
+        "--inventory",
+        type=Path,
+        nargs="?",
+        const=default_path(),
+        metavar="FILE",
+        help=f"Look images and snapshots up in the inventory in FILE (default: {default_path()}), refreshed first, instead of listing them in every region",
+    )
+
+
+def open_inventory(args: argparse.Namespace) -> "Inventory | None":
+    return None if args.inventory is None else Inventory(args.inventory)
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _glob(pattern: str) -> str:
+    """Translate an EC2 filter value with * and ? wildcards to a GLOB."""
+    result = []
+    escaped = False
+    for char in pattern:
+        if escaped:
+            result.append(f"[{char}]" if char in "*?[" else char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == "[":
+            result.append("[[]")
+        else:
+            result.append(char)
+    if escaped:
+        result.append("\\")
+    return "".join(result)
+
+
+def _chunks(items: list[str], size: int) -> Iterable[list[str]]:
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+class Inventory:
+    """The inventory database in *path*; see the module docstring.
+
+    Thread-safe, so that regions can be refreshed and looked up at once.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            (version,) = self._db.execute("PRAGMA user_version").fetchone()
+            if version != VERSION:
+                if version != 0:
+                    log.info(f"Rebuilding inventory {path} of version {version}")
+                for table in (
+                    "images",
+                    "snapshots",
+                    "block_device_mappings",
+                    "tags",
+                    "refreshes",
+                ):
+                    self._db.execute(f"DROP TABLE IF EXISTS {table}")
+                self._db.executescript(SCHEMA)
+                self._db.execute(f"PRAGMA user_version = {VERSION}")
+
+    def close(self) -> None:
+        self._db.close()
+
+    def refresh(self, ec2: "EC2Client", full: bool | None = None) -> None:
+        """Bring the images and snapshots of the region of *ec2* up to date.
+
+        With *full* None, lists the region completely only if its last
+        complete listing is older than FULL_REFRESH_AFTER; with *full*
+        False, only if it never was.
+        """
+        region = ec2.meta.region_name
+        now = _now()
+        since = None
+        if not full:
+            since = self._since(region, now, full is None)
+        if since is None:
+            log.info(f"Listing all images and snapshots in {region}")
+            # Snapshots first, so that the image of a snapshot registered
+            # in between is seen and the snapshot does not look orphaned.
+            self._list_all(ec2, "snapshots")
+            self._list_all(ec2, "images")
+        else:
+            self._list_since(ec2, since)
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE refreshes SET refreshed_at = ? WHERE region = ?",
+                (now.isoformat(), region),
+            )
+
+    def _since(
+        self, region: str, now: datetime.datetime, check_age: bool
+    ) -> datetime.date | None:
+        """Return the day from which to list new images, or None to list all."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT full_refreshed_at, refreshed_at FROM refreshes WHERE region = ?",
+                (region,),
+            ).fetchall()
+        if len(rows) < 2 or any(full_at is None for full_at, _ in rows):
+            return None
+        oldest = min(datetime.datetime.fromisoformat(full_at) for full_at, _ in rows)
+        if check_age and now - oldest > FULL_REFRESH_AFTER:
+            return None
+        latest = max(
+            (datetime.datetime.fromisoformat(at) for _, at in rows if at), default=None
+        )
+        if latest is None:
+            # Listed completely, but interrupted before refreshed_at was set.
+            return None
+        # A day earlier, as images get published and deprecated after
+        # they are created.
+        since = latest.date() - datetime.timedelta(days=1)
+        if (now.date() - since).days > MAX_INCREMENTAL_DAYS:
+            return None
+        return since
+
+    def _list_all(self, ec2: "EC2Client", kind: str) -> None:
+        import botocore.exceptions
+
+        region = ec2.meta.region_name
+        started = _now()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT generation, listing, next_token FROM refreshes WHERE region = ? AND kind = ?",
+                (region, kind),
+            ).fetchone()
+            if row is not None and row[1] and row[2] is not None:
+                generation, _, token = row
+                log.info(f"Resuming the listing of {kind} in {region}")
+            elif row is not None:
+                generation = row[0] + 1
+                token = None
+                self._db.execute(
+                    "UPDATE refreshes SET generation = ?, listing = 1, next_token = NULL WHERE region = ? AND kind = ?",
+                    (generation, region, kind),
+                )
+            else:
+                generation = 1
+                token = None
+                self._db.execute(
+                    "INSERT INTO refreshes (region, kind, generation, listing) VALUES (?, ?, ?, 1)",
+                    (region, kind, generation),
+                )
+        resumed = token is not None
+        while True:
+            kwargs: dict[str, Any] = {"MaxResults": PAGE_SIZE}
+            if token is not None:
+                kwargs["NextToken"] = token
+            try:
+                if kind == "images":
+                    page: Any = ec2.describe_images(
+                        Owners=["self"],
+                        IncludeDeprecated=True,
+                        IncludeDisabled=True,
+                        **kwargs,
+                    )
+                    items = page["Images"]
+                else:
+                    page = ec2.describe_snapshots(OwnerIds=["self"], **kwargs)
+                    items = page["Snapshots"]
+            except botocore.exceptions.ClientError as e:
+                if not resumed:
+                    raise
+                # The token of an interrupted listing can expire.
+                log.info(f"Listing {kind} in {region} from the start: {e}")
+                resumed = False
+                token = None
+                continue
+            resumed = False
+            token = page.get("NextToken")
+            with self._lock, self._db:
+                for item in items:
+                    if kind == "images":
+                        self._put_image(region, item, generation)
+                    else:
+                        self._put_snapshot(region, item, generation)
+                self._db.execute(
+                    "UPDATE refreshes SET next_token = ? WHERE region = ? AND kind = ?",
+                    (token, region, kind),
+                )
+            if token is None:
+                break
+        with self._lock, self._db:
+            if kind == "images":
+                stale = self._db.execute(
+                    "SELECT image_id FROM images WHERE region = ? AND generation < ?",
+                    (region, generation),
+                ).fetchall()
+                for (image_id,) in stale:
+                    self._delete_image(region, image_id)
+            else:
+                stale = self._db.execute(
+                    "SELECT snapshot_id FROM snapshots WHERE region = ? AND generation < ?",
+                    (region, generation),
+                ).fetchall()
+                for (snapshot_id,) in stale:
+                    self._delete_snapshot(region, snapshot_id)
+            self._db.execute(
+                "UPDATE refreshes SET listing = 0, full_refreshed_at = ? WHERE region = ? AND kind = ?",
+                (started.isoformat(), region, kind),
+            )
+
+    def _list_since(self, ec2: "EC2Client", since: datetime.date) -> None:
+        region = ec2.meta.region_name
+        days = [
+            f"{since + datetime.timedelta(days=n)}*"
+            for n in range((_now().date() - since).days + 1)
+        ]
+        with self._lock:
+            generations = dict(
+                self._db.execute(
+                    "SELECT kind, generation FROM refreshes WHERE region = ?", (region,)
+                ).fetchall()
+            )
+        snapshot_ids = set()
+        for page in ec2.get_paginator("describe_images").paginate(
+            Owners=["self"],
+            IncludeDeprecated=True,
+            IncludeDisabled=True,
+            Filters=[{"Name": "creation-date", "Values": days}],
+        ):
+            with self._lock, self._db:
+                for image in page["Images"]:
+                    self._put_image(region, image, generations["images"])
+                    for mapping in image.get("BlockDeviceMappings", []):
+                        if "SnapshotId" in mapping.get("Ebs", {}):
+                            snapshot_ids.add(mapping["Ebs"]["SnapshotId"])
+        with self._lock:
+            known = {
+                snapshot_id
+                for (snapshot_id,) in self._db.execute(
+                    "SELECT snapshot_id FROM snapshots WHERE region = ?", (region,)
+                )
+            }
+        new = sorted(snapshot_ids - known)
+        log.info(
+            f"Listed the images created since {since} in {region}, {len(new)} new snapshots"
+        )
+        for chunk in _chunks(new, MAX_FILTER_VALUES):
+            # A filter rather than SnapshotIds, which fails if one is gone.
+            for snapshots in ec2.get_paginator("describe_snapshots").paginate(
+                OwnerIds=["self"], Filters=[{"Name": "snapshot-id", "Values": chunk}]
+            ):
+                with self._lock, self._db:
+                    for snapshot in snapshots["Snapshots"]:
+                        self._put_snapshot(region, snapshot, generations["snapshots"])
+
+    # The callers of the _put and _delete methods hold _lock and a transaction.
+
+    def _put_tags(self, region: str, resource_id: str, item: Any) -> None:
+        self._db.execute(
+            "DELETE FROM tags WHERE region = ? AND resource_id = ?",
+            (region, resource_id),
+        )
+        self._db.executemany(
+            "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)",
+            [
+                (region, resource_id, tag["Key"], tag["Value"])
+                for tag in item.get("Tags", [])
+                if "Key" in tag and "Value" in tag
+            ],
+        )
+
+    def _put_image(self, region: str, image: "ImageTypeDef", generation: int) -> None:
+        assert "ImageId" in image
+        image_id = image["ImageId"]
+        self._db.execute(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                region,
+                image_id,
+                image.get("Name", ""),
+                image.get("State"),
+                image.get("Public", False),
+                image.get("CreationDate"),
+                image.get("DeprecationTime"),
+                generation,
+                json.dumps(image, default=_json_default),
+            ),
+        )
+        self._db.execute(
+            "DELETE FROM block_device_mappings WHERE region = ? AND image_id = ?",
+            (region, image_id),
+        )
+        self._db.executemany(
+            "INSERT INTO block_device_mappings VALUES (?, ?, ?, ?)",
+            [
+                (
+                    region,
+                    image_id,
+                    mapping.get("DeviceName"),
+                    mapping["Ebs"]["SnapshotId"],
+                )
+                for mapping in image.get("BlockDeviceMappings", [])
+                if "SnapshotId" in mapping.get("Ebs", {})
+            ],
+        )
+        self._put_tags(region, image_id, image)
+
+    def _put_snapshot(
+        self, region: str, snapshot: "SnapshotTypeDef", generation: int
+    ) -> None:
+        assert "SnapshotId" in snapshot
+        start_time = snapshot.get("StartTime")
+        self._db.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                region,
+                snapshot["SnapshotId"],
+                snapshot.get("State"),
+                start_time.isoformat() if start_time is not None else None,
+                generation,
+                json.dumps(snapshot, default=_json_default),
+            ),
+        )
+        self._put_tags(region, snapshot["SnapshotId"], snapshot)
+
+    def _delete_image(self, region: str, image_id: str) -> None:
+        for table in ("images", "block_device_mappings"):
+            self._db.execute(
+                f"DELETE FROM {table} WHERE region = ? AND image_id = ?",
+                (region, image_id),
+            )
+        self._db.execute(
+            "DELETE FROM tags WHERE region = ? AND resource_id = ?", (region, image_id)
+        )
+
+    def _delete_snapshot(self, region: str, snapshot_id: str) -> None:
+        self._db.execute(
+            "DELETE FROM snapshots WHERE region = ? AND snapshot_id = ?",
+            (region, snapshot_id),
+        )
+        self._db.execute(
+            "DELETE FROM tags WHERE region = ? AND resource_id = ?",
+            (region, snapshot_id),
+        )
+
+    def forget_image(self, region: str, image_id: str) -> None:
+        """Drop an image that was deregistered."""
+        with self._lock, self._db:
+            self._delete_image(region, image_id)
+
+    def forget_snapshot(self, region: str, snapshot_id: str) -> None:
+        """Drop a snapshot that was deleted."""
+        with self._lock, self._db:
+            self._delete_snapshot(region, snapshot_id)
+
+    def images(
+        self,
+        region: str,
+        name: str | None = None,
+        public: bool | None = None,
+        snapshot_id: str | None = None,
+        include_disabled: bool = False,
+    ) -> list["ImageTypeDef"]:
+        """Return the images of *region*, oldest first.
+
+        *name* may contain the wildcards of EC2 filters.  Only images
+        that use *snapshot_id* are returned if it is given.  Like
+        DescribeImages, leaves out disabled images unless
+        *include_disabled*.
+        """
+        sql = "SELECT data FROM images WHERE region = ?"
+        params: list[Any] = [region]
+        if name is not None:
+            sql += " AND name GLOB ?"
+            params.append(_glob(name))
+        if public is not None:
+            sql += " AND public = ?"
+            params.append(public)
+        if snapshot_id is not None:
+            sql += " AND image_id IN (SELECT image_id FROM block_device_mappings WHERE region = ? AND snapshot_id = ?)"
+            params += [region, snapshot_id]
+        if not include_disabled:
+            sql += " AND state IS NOT 'disabled'"
+        sql += " ORDER BY creation_date, image_id"
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [cast("ImageTypeDef", json.loads(data)) for (data,) in rows]
+
+    def snapshots(
+        self,
+        region: str,
+        tags: Mapping[str, str] = {},
+        state: str | None = None,
+    ) -> list["SnapshotTypeDef"]:
+        """Return the snapshots of *region* with *tags* and in *state*.
+
+        The values of *tags* may contain the wildcards of EC2 filters.
+        """
+        sql = "SELECT data FROM snapshots WHERE region = ?"
+        params: list[Any] = [region]
+        for key, value in tags.items():
+            sql += " AND snapshot_id IN (SELECT resource_id FROM tags WHERE region = ? AND key = ? AND value GLOB ?)"
+            params += [region, key, _glob(value)]
+        if state is not None:
+            sql += " AND state = ?"
+            params.append(state)
+        sql += " ORDER BY start_time, snapshot_id"
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+        return [cast("SnapshotTypeDef", json.loads(data)) for (data,) in rows]
+
+    def referenced_snapshots(self, region: str) -> set[str]:
+        """Return the snapshots used by any image of *region*."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT DISTINCT snapshot_id FROM block_device_mappings WHERE region = ?",
+                (region,),
+            ).fetchall()
+        return {snapshot_id for (snapshot_id,) in rows}
+
+    def counts(self, region: str) -> tuple[int, int]:
+        """Return the number of images and snapshots of *region*."""
+        with self._lock:
+            (images,) = self._db.execute(
+                "SELECT count(*) FROM images WHERE region = ?", (region,)
+            ).fetchone()
+            (snapshots,) = self._db.execute(
+                "SELECT count(*) FROM snapshots WHERE region = ?", (region,)
+            ).fetchone()
+        return images, snapshots
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Refresh the inventory of images and snapshots in every region"
+    )
+    parser.add_argument(
+        "--inventory",
+        type=Path,
+        default=default_path(),
+        metavar="FILE",
+        help=f"Inventory database (default: {default_path()})",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="List every region completely instead of only what is new",
+    )
+    parser.add_argument(
+        "--best-effort-region",
+        help="Regions where failures are logged as warnings instead of errors",
+        action="append",
+        default=[],
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    executor = RegionExecutor(best_effort_regions=args.best_effort_region)
+    inventory = Inventory(args.inventory)
+
+    def refresh(region: str) -> tuple[int, int]:
+        inventory.refresh(executor.ec2(region), full=args.full or None)
+        return inventory.counts(region)
+
+    counts = executor.run(refresh, executor.regions(), "Refreshing the inventory")
+    for region, (images, snapshots) in counts.items():
+        log.info(f"{region}: {images} images, {snapshots} snapshots")
+    inventory.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Per-block metrics of EBS Direct uploads.
+
+Records where the time of an upload goes (reading, hashing, writing
+blocks), how often botocore had to retry, and how many bytes were sent
+or skipped.  The result can be written as a JSON report and as a
+Prometheus textfile for node_exporter's textfile collector.
+"""
+
+import bisect
+import json
+import os
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    import botocore.client
+
+from .concurrency import watch_attempts
+
+# Upper bounds in seconds, as in the Prometheus client's defaults plus a
+# few finer ones for per-block reads and hashes.
+BUCKETS = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+SKIP_REASONS = ("zero", "unchanged", "resumed", "not_visited")
+RETRY_OUTCOMES = ("throttled", "server", "client")
+
+
+class Histogram:
+    """Latency histogram with fixed buckets."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def quantile(self, q: float) -> float | None:
+        """Return the upper bound of the bucket holding quantile *q*."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def report(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum_seconds": self.sum,
+            "p50_seconds": self.quantile(0.5),
+            "p90_seconds": self.quantile(0.9),
+            "p99_seconds": self.quantile(0.99),
+            "buckets": {
+                str(bound): count for bound, count in zip(BUCKETS, self.counts)
+            },
+            "overflow": self.counts[-1],
+        }
+
+
+class UploadMetrics:
+    """Metrics of one snapshot upload; safe to update from worker threads."""
+
+    def __init__(self, snapshot_id: str, block_size: int) -> None:
+        self.snapshot_id = snapshot_id
+        self.block_size = block_size
+        self.read = Histogram()
+        self.hash = Histogram()
+        self.put = Histogram()
+        self.blocks_sent = 0
+        self.bytes_sent = 0
+        self.blocks_skipped = dict.fromkeys(SKIP_REASONS, 0)
+        self.retries = dict.fromkeys(RETRY_OUTCOMES, 0)
+        self.block_count = 0
+        # Set once the upload went through every block of the image.
+        self.visited_all = False
+        # Unset when the requests bypass the watched client.
+        self.retries_counted = True
+        # Descriptions of the upload, like the transfer client used.
+        self.info: dict[str, str] = {}
+        self.elapsed = 0.0
+        self.gauges: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def watch(self, client: "botocore.client.BaseClient", operation: str) -> None:
+        """Count failed attempts of *operation* by outcome."""
+        watch_attempts(client, operation, self._on_attempt)
+
+    def _on_attempt(self, outcome: str | None) -> None:
+        if outcome is not None:
+            with self._lock:
+                self.retries[outcome] += 1
+
+    def sent(self, nbytes: int) -> None:
+        with self._lock:
+            self.blocks_sent += 1
+            self.bytes_sent += nbytes
+
+    def skipped(self, reason: str, blocks: int = 1) -> None:
+        with self._lock:
+            self.blocks_skipped[reason] += blocks
+
+    def report(self) -> dict[str, Any]:
+        """Return the metrics as a JSON-serializable dict.
+
+        Once every block was visited, the blocks never looked at, such
+        as holes in sparse images, count as skipped zero blocks.  After
+        a failed upload they are counted as "not_visited" instead.
+        """
+        skipped = dict(self.blocks_skipped)
+        unvisited = max(
+            0, self.block_count - self.blocks_sent - sum(self.blocks_skipped.values())
+        )
+        skipped["zero" if self.visited_all else "not_visited"] += unvisited
+        elapsed = self.elapsed
+        return {
+            "snapshot_id": self.snapshot_id,
+            "block_size": self.block_size,
+            "block_count": self.block_count,
+            "elapsed_seconds": elapsed,
+            "mib_per_second": (
+                self.bytes_sent / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+            ),
+            "blocks_sent": self.blocks_sent,
+            "bytes_sent": self.bytes_sent,
+            "blocks_skipped": skipped,
+            "bytes_skipped": {k: v * self.block_size for k, v in skipped.items()},
+            # None rather than zeros if they could not be counted.
+            "retries": dict(self.retries) if self.retries_counted else None,
+            "read": self.read.report(),
+            "hash": self.hash.report(),
+            "put": self.put.report(),
+            **self.info,
+            **self.gauges,
+        }
+
+    def write(self, directory: Path) -> tuple[Path, Path]:
+        """Write ``<snapshot>.json`` and ``<snapshot>.prom`` to *directory*."""
+        report = self.report()
+        directory.mkdir(parents=True, exist_ok=True)
+        json_path = directory / f"{self.snapshot_id}.json"
+        prom_path = directory / f"{self.snapshot_id}.prom"
+        _write_atomic(json_path, json.dumps(report, indent=2) + "\n")
+        _write_atomic(prom_path, self._prometheus(report))
+        return json_path, prom_path
+
+    def _prometheus(self, report: dict[str, Any]) -> str:
+        label = f'snapshot_id="{self.snapshot_id}"'
+        lines: list[str] = []
+
+        def metric(name: str, kind: str, description: str) -> None:
+            lines.append(f"# HELP upload_ami_{name} {description}")
+            lines.append(f"# TYPE upload_ami_{name} {kind}")
+
+        metric("elapsed_seconds", "gauge", "Duration of the upload.")
+        lines.append(f"upload_ami_elapsed_seconds{{{label}}} {self.elapsed}")
+        metric("blocks_total", "gauge", "Blocks in the image.")
+        lines.append(f"upload_ami_blocks_total{{{label}}} {self.block_count}")
+        metric("sent_bytes_total", "counter", "Bytes written with PutSnapshotBlock.")
+        lines.append(f"upload_ami_sent_bytes_total{{{label}}} {self.bytes_sent}")
+        metric("skipped_bytes_total", "counter", "Bytes not written, by reason.")
+        for reason, nbytes in report["bytes_skipped"].items():
+            lines.append(
+                f'upload_ami_skipped_bytes_total{{{label},reason="{reason}"}} {nbytes}'
+            )
+        if self.info:
+            metric("info", "gauge", "Description of the upload in its labels.")
+            labels = "".join(f',{k}="{v}"' for k, v in self.info.items())
+            lines.append(f"upload_ami_info{{{label}{labels}}} 1")
+        if self.retries_counted:
+            metric("retries_total", "counter", "Failed PutSnapshotBlock attempts.")
+            for outcome, count in self.retries.items():
+                lines.append(
+                    f'upload_ami_retries_total{{{label},outcome="{outcome}"}} {count}'
+                )
+        for name, value in self.gauges.items():
+            metric(name, "gauge", name.replace("_", " ").capitalize() + ".")
+            lines.append(f"upload_ami_{name}{{{label}}} {value}")
+        for stage, histogram in (
+            ("read", self.read),
+            ("hash", self.hash),
+            ("put", self.put),
+        ):
+            name = f"block_{stage}_seconds"
+            metric(name, "histogram", f"Time to {stage} one block.")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(
+                    f'upload_ami_{name}_bucket{{{label},le="{bound}"}} {cumulative}'
+                )
+            lines.append(
+                f'upload_ami_{name}_bucket{{{label},le="+Inf"}} {histogram.count}'
+            )
+            lines.append(f"upload_ami_{name}_sum{{{label}}} {histogram.sum}")
+            lines.append(f"upload_ami_{name}_count{{{label}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
@@ -1,8 +1,12 @@
 import logging
-import boto3
-from mypy_boto3_ec2 import EC2Client
 import argparse
-import botocore.exceptions
+from typing import TYPE_CHECKING
+
+from .inventory import add_inventory_argument, open_inventory
+from .regions import RegionExecutor, map_concurrently
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.type_defs import ImageTypeDef
 
 
 def main() -> None:
@@ -21,20 +25,25 @@ def main() -> None:
         "--older-than",
         type=str,
     )
+    add_inventory_argument(parser)
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
-
-    regions = ec2.describe_regions()["Regions"]
-
-    for region in regions:
-        assert "RegionName" in region
-        ec2r = boto3.client("ec2", region_name=region["RegionName"])
-        logging.info(f"Nuking {region['RegionName']}")
-        images = ec2r.describe_images(
-            Owners=["self"], Filters=[{"Name": "name", "Values": [args.image_name]}]
-        )
-        for image in images["Images"]:
+    executor = RegionExecutor()
+    inventory = open_inventory(args)
+
+    def nuke(region: str) -> None:
+        ec2r = executor.ec2(region)
+        if inventory is None:
+            images = ec2r.describe_images(
+                Owners=["self"], Filters=[{"Name": "name", "Values": [args.image_name]}]
+            )["Images"]
+        else:
+            inventory.refresh(ec2r)
+            images = inventory.images(region, name=args.image_name)
+
+        def nuke_image(image: "ImageTypeDef") -> None:
+            import botocore.exceptions
+
             snapshot_id = image["BlockDeviceMappings"][0]["Ebs"]["SnapshotId"]
             logging.info(f"Deregistering {image['ImageId']}")
             try:
@@ -42,12 +51,22 @@ def main() -> None:
             except botocore.exceptions.ClientError as e:
                 if "DryRunOperation" not in str(e):
                     raise
+            else:
+                if inventory is not None:
+                    inventory.forget_image(region, image["ImageId"])
             logging.info(f"Deleting {snapshot_id}")
             try:
                 ec2r.delete_snapshot(SnapshotId=snapshot_id, DryRun=args.dry_run)
             except botocore.exceptions.ClientError as e:
                 if "DryRunOperation" not in str(e):
                     raise
+            else:
+                if inventory is not None:
+                    inventory.forget_snapshot(region, snapshot_id)
+
+        map_concurrently(nuke_image, images, executor.per_region)
+
+    executor.run(nuke, executor.regions(), "Nuking")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,249 @@
+"""Running the steps of an upload as a graph of dependent stages.
+
+Each stage is a function that runs once all stages it runs *after* have
+succeeded, so independent stages, like the copies to other regions and
+the post-processing of the image in the source region, overlap::
+
+    pipeline = Pipeline()
+    pipeline.add("snapshot", upload)
+    pipeline.add("image", lambda: register(pipeline.result("snapshot")),
+                 after=["snapshot"])
+    pipeline.run()
+
+Stages read the results of earlier stages with :meth:`Pipeline.result`.
+A stage whose dependencies failed is skipped, unless it was added with
+``always=True``; such a stage runs anyway and can fall back to something
+else, or raise :class:`StageSkipped` itself.  Failures of *optional*
+stages are only logged.
+
+The start and end of every stage are recorded, and
+:meth:`Pipeline.critical_path` names the chain of stages that bounded
+the wall time of the run.
+
+Given a :class:`.run_state.RunState`, the result of every stage that
+succeeds is recorded in it, and stages it already holds a result for
+are not run again; their recorded result is used instead.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Iterable
+
+if TYPE_CHECKING:
+    from .run_state import RunState
+
+log = logging.getLogger(__name__)
+
+
+class StageSkipped(Exception):
+    """A stage did not run because a stage it runs after failed."""
+
+
+@dataclass
+class _Stage:
+    name: str
+    run: Callable[[], Any]
+    after: tuple[str, ...]
+    optional: bool
+    always: bool
+    future: "Future[Any]" = field(default_factory=Future)
+    start: float | None = None
+    end: float | None = None
+    restored: bool = False
+
+    @property
+    def status(self) -> str:
+        if not self.future.done():
+            return "pending"
+        exc = self.future.exception()
+        if exc is None:
+            return "succeeded"
+        return "skipped" if isinstance(exc, StageSkipped) else "failed"
+
+
+class Pipeline:
+    """A graph of stages; see the module docstring."""
+
+    def __init__(self, state: "RunState | None" = None) -> None:
+        self.state = state
+        self._stages: dict[str, _Stage] = {}
+        self._started: float | None = None
+        self._finished: float | None = None
+
+    def add(
+        self,
+        name: str,
+        run: Callable[[], Any],
+        after: Iterable[str] = (),
+        optional: bool = False,
+        always: bool = False,
+    ) -> None:
+        """Add a stage that runs *run* after the stages named in *after*.
+
+        Stages can only run after stages added before them, so the graph
+        has no cycles.
+        """
+        if name in self._stages:
+            raise ValueError(f"duplicate stage {name}")
+        after = tuple(dict.fromkeys(after))
+        for dependency in after:
+            if dependency not in self._stages:
+                raise ValueError(f"{name} runs after unknown stage {dependency}")
+        self._stages[name] = _Stage(name, run, after, optional, always)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._stages
+
+    def result(self, name: str) -> Any:
+        """Return what stage *name* returned, or raise what it raised."""
+        return self._stages[name].future.result()
+
+    def succeeded(self, name: str) -> bool:
+        return self._stages[name].status == "succeeded"
+
+    def run(self, max_workers: int | None = None) -> None:
+        """Run all stages, at most *max_workers* at once.
+
+        Raises the first failure of a stage that is not optional, once
+        all stages have finished or been skipped.
+        """
+        stages = list(self._stages.values())
+        waiting = {stage.name: len(stage.after) for stage in stages}
+        dependents: dict[str, list[_Stage]] = {}
+        for stage in stages:
+            for dependency in stage.after:
+                dependents.setdefault(dependency, []).append(stage)
+        lock = threading.Lock()
+        self._started = time.monotonic()
+
+        with ThreadPoolExecutor(
+            max_workers=max_workers or max(len(stages), 1),
+            thread_name_prefix="stage",
+        ) as executor:
+
+            def finished(stage: _Stage) -> None:
+                ready = []
+                with lock:
+                    for dependent in dependents.get(stage.name, []):
+                        waiting[dependent.name] -= 1
+                        if waiting[dependent.name] == 0:
+                            ready.append(dependent)
+                for dependent in ready:
+                    start(dependent)
+
+            def start(stage: _Stage) -> None:
+                failed = [d for d in stage.after if not self.succeeded(d)]
+                # No fallbacks after a KeyboardInterrupt or SystemExit.
+                interrupted = any(
+                    not isinstance(self._stages[d].future.exception(), Exception)
+                    for d in failed
+                )
+                if failed and (interrupted or not stage.always):
+                    stage.future.set_exception(
+                        StageSkipped(
+                            f"{stage.name}: {', '.join(failed)} did not succeed"
+                        )
+                    )
+                    finished(stage)
+                else:
+                    executor.submit(execute, stage)
+
+            def execute(stage: _Stage) -> None:
+                stage.start = time.monotonic()
+                if self.state is not None and stage.name in self.state:
+                    log.info(f"{stage.name} already done in an earlier run")
+                    stage.end = stage.start
+                    stage.restored = True
+                    stage.future.set_result(self.state.get(stage.name))
+                    finished(stage)
+                    return
+                try:
+                    result = stage.run()
+                    if self.state is not None:
+                        self.state.record(stage.name, result)
+                except BaseException as exc:
+                    # Also KeyboardInterrupt and SystemExit, which would
+                    # otherwise leave the stages after this one waiting;
+                    # run() raises them once all stages are done.
+                    stage.end = time.monotonic()
+                    if isinstance(exc, StageSkipped):
+                        log.info(f"Skipped {stage.name}: {exc}")
+                    elif stage.optional:
+                        log.warning(
+                            f"{stage.name} failed (best-effort, ignoring): {exc}"
+                        )
+                    else:
+                        log.error(f"{stage.name} failed: {exc}")
+                    stage.future.set_exception(exc)
+                else:
+                    stage.end = time.monotonic()
+                    log.debug(f"{stage.name} took {stage.end - stage.start:.1f}s")
+                    stage.future.set_result(result)
+                finished(stage)
+
+            # Collected first, as finishing stages count down waiting.
+            roots = [stage for stage in stages if not stage.after]
+            for stage in roots:
+                start(stage)
+            wait([stage.future for stage in stages])
+        self._finished = time.monotonic()
+
+        errors = [
+            stage
+            for stage in stages
+            if not stage.optional and stage.status in ("failed", "skipped")
+        ]
+        # Prefer the failure that caused the others over a skip.
+        errors.sort(key=lambda s: (s.status == "skipped", s.end or 0.0))
+        if errors:
+            raise errors[0].future.exception()  # type: ignore[misc]
+
+    def critical_path(self) -> list[tuple[str, float]]:
+        """Return the stages that bounded the run, with their durations.
+
+        Starts from the stage that finished last and follows, at each
+        stage, the dependency that finished last.
+        """
+        ran = [s for s in self._stages.values() if s.end is not None]
+        if not ran:
+            return []
+        stage = max(ran, key=lambda s: s.end or 0.0)
+        path = [stage]
+        while True:
+            done = [self._stages[d] for d in stage.after]
+            done = [d for d in done if d.end is not None]
+            if not done:
+                break
+            stage = max(done, key=lambda s: s.end or 0.0)
+            path.append(stage)
+        return [(s.name, (s.end or 0.0) - (s.start or 0.0)) for s in reversed(path)]
+
+    def report(self) -> dict[str, Any]:
+        """Return the timing of the run and of each stage as a dict."""
+        started = self._started or 0.0
+        return {
+            "elapsed_seconds": (self._finished or started) - started,
+            "stages": {
+                stage.name: {
+                    "status": stage.status,
+                    "restored": stage.restored,
+                    "after": list(stage.after),
+                    "start_seconds": (
+                        None if stage.start is None else stage.start - started
+                    ),
+                    "seconds": (
+                        None
+                        if stage.start is None or stage.end is None
+                        else stage.end - stage.start
+                    ),
+                }
+                for stage in self._stages.values()
+            },
+            "critical_path": [
+                {"stage": name, "seconds": seconds}
+                for name, seconds in self.critical_path()
+            ],
+        }
@@ -0,0 +1,184 @@
+"""Running the housekeeping commands in all regions at once.
+
+The commands that act on every region used to visit them one after the
+other, so they took the sum of the regions' times.  With
+:class:`RegionExecutor` they take about as long as the slowest region::
+
+    executor = RegionExecutor(best_effort_regions=args.best_effort_region)
+    results = executor.run(
+        lambda region: describe(executor.ec2(region)), executor.regions(), "Describing"
+    )
+
+Up to *max_regions* regions run at once.  Every region gets its own
+clients, whose requests are rate limited to *rate* per second, so that
+running many regions and many requests per region at once does not get
+them throttled.  :func:`map_concurrently` runs the work within one
+region, e.g. deleting images, *per_region* at a time.
+
+Failures in *best_effort_regions* are logged as warnings and left out of
+the results.  Other failures are raised once all regions have finished,
+so that one failing region does not leave the others half done.  The
+time each region took is logged at the end.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Callable, Collection, Iterable, TypeVar, cast
+
+from . import clients
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2 import EC2Client
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# Regions worked on at once; there are about 30.
+MAX_REGIONS = 32
+# Requests within one region at once, e.g. deletions.
+PER_REGION_CONCURRENCY = 8
+# Requests per second per region and service, well below EC2's limits.
+REQUESTS_PER_SECOND = 20.0
+
+
+class RateLimiter:
+    """Token bucket allowing *rate* calls per second on average.
+
+    Bursts of up to *rate* calls pass at once.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            # Take the token now and wait for it, so waiting callers
+            # queue up in order instead of polling.
+            self._tokens -= 1
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def map_concurrently(
+    fn: Callable[[T], R], items: Iterable[T], concurrency: int = PER_REGION_CONCURRENCY
+) -> list[R]:
+    """Return ``[fn(item) for item in items]``, *concurrency* at a time.
+
+    Raises the first exception in the order of *items*, after all have
+    finished.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(fn, item) for item in items]
+    return [future.result() for future in futures]
+
+
+class RegionExecutor:
+    """Runs a task in many regions at once; see the module docstring."""
+
+    def __init__(
+        self,
+        best_effort_regions: Collection[str] = (),
+        max_regions: int = MAX_REGIONS,
+        per_region: int = PER_REGION_CONCURRENCY,
+        rate: float = REQUESTS_PER_SECOND,
+    ) -> None:
+        self.best_effort_regions = best_effort_regions
+        self.max_regions = max_regions
+        self.per_region = per_region
+        self.rate = rate
+        self._clients: dict[tuple[str, str | None], Any] = {}
+        self._lock = threading.Lock()
+
+    def client(self, service: str, region: str | None = None) -> Any:
+        """Return the rate-limited client for *service* in *region*."""
+        with self._lock:
+            client = self._clients.get((service, region))
+            if client is None:
+                # Not a shared client, so the limiter stays with this executor.
+                client = clients.create(service, region)
+                limiter = RateLimiter(self.rate)
+                client.meta.events.register(
+                    "before-send", lambda **kwargs: limiter.acquire()
+                )
+                self._clients[service, region] = client
+            return client
+
+    def ec2(self, region: str | None = None) -> "EC2Client":
+        return cast("EC2Client", self.client("ec2", region))
+
+    def regions(self) -> list[str]:
+        """Return the regions enabled for the account."""
+        return [
+            region["RegionName"]
+            for region in self.ec2().describe_regions()["Regions"]
+            if "RegionName" in region
+        ]
+
+    def run(
+        self, task: Callable[[str], R], regions: Iterable[str], action: str
+    ) -> dict[str, R]:
+        """Run *task* for each of *regions* and return its results.
+
+        *action*, like "Deleting deprecated images", names the task in
+        the log.
+        """
+        regions = list(regions)
+        timings: dict[str, tuple[float, str]] = {}
+        results: dict[str, R] = {}
+        errors: list[Exception] = []
+
+        def run_in(region: str) -> None:
+            log.info(f"{action} in {region}")
+            t0 = time.monotonic()
+            try:
+                result = task(region)
+            except Exception as e:
+                elapsed = time.monotonic() - t0
+                if region not in self.best_effort_regions:
+                    log.error(f"{action} in {region} failed: {e}")
+                    timings[region] = (elapsed, "failed")
+                    errors.append(e)
+                else:
+                    log.warning(
+                        f"{action} in {region} failed (best-effort, ignoring): {e}"
+                    )
+                    timings[region] = (elapsed, "failed, best-effort")
+                return
+            timings[region] = (time.monotonic() - t0, "ok")
+            results[region] = result
+
+        t0 = time.monotonic()
+        with ThreadPoolExecutor(
+            max_workers=max(min(self.max_regions, len(regions)), 1)
+        ) as executor:
+            futures = [executor.submit(run_in, region) for region in regions]
+        log.info(
+            f"{action} took {time.monotonic() - t0:.1f}s in {len(regions)} regions:\n"
+            + "\n".join(
+                f"  {region:20} {elapsed:7.1f}s  {status}"
+                for region, (elapsed, status) in sorted(
+                    timings.items(), key=lambda item: -item[1][0]
+                )
+            )
+        )
+        # Raises what run_in let through, like KeyboardInterrupt.
+        for future in futures:
+            future.result()
+        if errors:
+            raise errors[0]
+        # In the order of regions, as the loops this replaces returned them.
+        return {region: results[region] for region in regions if region in results}
@@ -1,21 +1,22 @@
 from ast import List
-from typing import Iterator
-import boto3
+from typing import TYPE_CHECKING, Iterator
 import logging
 
-from mypy_boto3_ec2 import EC2Client
-from mypy_boto3_service_quotas import ServiceQuotasClient
-from mypy_boto3_service_quotas.type_defs import (
-    ListServiceQuotasResponseTypeDef,
-    ServiceQuotaTypeDef,
-)
+from .regions import RegionExecutor
+
+if TYPE_CHECKING:
+    from mypy_boto3_service_quotas import ServiceQuotasClient
+    from mypy_boto3_service_quotas.type_defs import (
+        ListServiceQuotasResponseTypeDef,
+        ServiceQuotaTypeDef,
+    )
 
 
 def get_public_ami_service_quota(
-    servicequotas: ServiceQuotasClient,
-) -> ServiceQuotaTypeDef:
+    servicequotas: "ServiceQuotasClient",
+) -> "ServiceQuotaTypeDef":
     paginator = servicequotas.get_paginator("list_service_quotas")
-    searched: Iterator[ServiceQuotaTypeDef] = paginator.paginate(
+    searched: "Iterator[ServiceQuotaTypeDef]" = paginator.paginate(
         ServiceCode="ec2"
     ).search("Quotas[?QuotaName=='Public AMIs']")
     return next(searched)
@@ -28,21 +29,18 @@ def main() -> None:
     parser.add_argument("--desired-value", type=int, default=1000)
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
-    ec2: EC2Client = boto3.client("ec2")
-    regions = ec2.describe_regions()["Regions"]
-    for region in regions:
-        assert "RegionName" in region
-        servicequotas: ServiceQuotasClient = boto3.client(
-            "service-quotas", region_name=region["RegionName"]
-        )
+    executor = RegionExecutor()
+
+    def request_increase(region: str) -> None:
+        servicequotas: "ServiceQuotasClient" = executor.client("service-quotas", region)
         service_quota = get_public_ami_service_quota(servicequotas)
 
         assert "Value" in service_quota
-        logging.info(f"Quota for {region['RegionName']} is  {service_quota['Value']}")
+        logging.info(f"Quota for {region} is  {service_quota['Value']}")
         try:
             if service_quota["Value"] < args.desired_value:
                 logging.info(
-                    f"Requesting quota increase for {region['RegionName']} from  {service_quota['Value']} to {args.desired_value}"
+                    f"Requesting quota increase for {region} from  {service_quota['Value']} to {args.desired_value}"
                 )
                 servicequotas.request_service_quota_increase(
                     ServiceCode="ec2",
@@ -52,6 +50,8 @@ def main() -> None:
         except Exception as e:
             logging.warn(e)
 
+    executor.run(request_increase, executor.regions(), "Checking the public AMI quota")
+
 
 if __name__ == "__main__":
     main()
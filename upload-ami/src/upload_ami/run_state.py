@@ -0,0 +1,101 @@
+"""Outputs of the completed stages of an upload, kept between runs.
+
+A retried upload would otherwise ask AWS again for everything the
+previous attempt already did: whether the snapshot and images exist,
+which regions there are, and wait for each image once more.
+:class:`RunState` records the result of every stage of the
+:class:`.pipeline.Pipeline` of an upload as soon as it succeeds, in
+``<state dir>/runs/<key>.json``, where the key is derived from the
+image name and the :func:`.block_manifest.image_fingerprint` of the
+image file.  A re-run of the same image restores those results instead
+of running the stages again.  Rebuilding the image gives it a new
+fingerprint, so the state of the old build is ignored.
+
+What the state says about AWS can go stale, e.g. when an image was
+deleted between runs, so callers verify it before resuming.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any
+
+from .block_manifest import image_fingerprint
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+class RunState:
+    """The recorded stage results of one upload of one image.
+
+    Thread-safe; every :meth:`record` rewrites the file atomically, so
+    a killed run loses at most the stage it was recording.
+    """
+
+    def __init__(self, path: Path, image_name: str, fingerprint: str) -> None:
+        self.path = path
+        self.image_name = image_name
+        self.fingerprint = fingerprint
+        self.stages: dict[str, Any] = {}
+        self._lock = threading.Lock()
+        try:
+            data = json.loads(path.read_text())
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning(f"Ignoring unreadable run state {path}: {e}")
+            return
+        if (
+            data.get("version") == VERSION
+            and data.get("image_name") == image_name
+            and data.get("fingerprint") == fingerprint
+        ):
+            self.stages = data.get("stages", {})
+
+    @classmethod
+    def open(cls, state_dir: Path, image_name: str, image_file: Path) -> "RunState":
+        fingerprint = image_fingerprint(image_file)
+        key = hashlib.sha256(f"{image_name}\0{fingerprint}".encode()).hexdigest()
+        return cls(state_dir / "runs" / f"{key}.json", image_name, fingerprint)
+
+    def __contains__(self, stage: str) -> bool:
+        with self._lock:
+            return stage in self.stages
+
+    def get(self, stage: str) -> Any:
+        with self._lock:
+            return self.stages[stage]
+
+    def record(self, stage: str, result: Any) -> None:
+        """Record that *stage* succeeded with *result*, a JSON value."""
+        with self._lock:
+            self.stages[stage] = result
+            self._save()
+
+    def forget(self, *stages: str) -> None:
+        """Drop *stages*, e.g. because what they made no longer exists."""
+        with self._lock:
+            for stage in stages:
+                self.stages.pop(stage, None)
+            self._save()
+
+    def _save(self) -> None:
+        data = {
+            "version": VERSION,
+            "image_name": self.image_name,
+            "fingerprint": self.fingerprint,
+            "stages": self.stages,
+        }
+        # Losing the state only costs a re-run the remote checks.
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(data, indent=2) + "\n")
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning(f"Failed to save run state {self.path}: {e}")
@@ -1,36 +1,46 @@
-import boto3
-import botocore.exceptions
+from . import clients
 import json
 import time
 import argparse
 import logging
 
-from mypy_boto3_ec2 import EC2Client
-from mypy_boto3_ec2.type_defs import InstanceMarketOptionsRequestTypeDef
-from mypy_boto3_ec2.literals import InstanceTypeType
+from typing import TYPE_CHECKING
+
+from .waiters import (
+    INSTANCE_RUNNING,
+    INSTANCE_STATUS_OK,
+    INSTANCE_TERMINATED,
+    shared_waiter,
+)
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.type_defs import InstanceMarketOptionsRequestTypeDef
+    from mypy_boto3_ec2.literals import InstanceTypeType
 
 
 def smoke_test(image_id: str, run_id: str, cancel: bool, no_spot: bool) -> None:
-    ec2: EC2Client = boto3.client("ec2")
+    ec2 = clients.ec2()
 
     images = ec2.describe_images(Owners=["self"], ImageIds=[image_id])
     assert len(images["Images"]) == 1
     image = images["Images"][0]
     assert "Architecture" in image
     architecture = image["Architecture"]
-    instance_type: InstanceTypeType
+    instance_type: "InstanceTypeType"
     if architecture == "x86_64":
         instance_type = "t3.nano"
     elif architecture == "arm64":
         instance_type = "t4g.nano"
     else:
         raise Exception("Unknown architecture: " + architecture)
-    instance_market_options: InstanceMarketOptionsRequestTypeDef
+    instance_market_options: "InstanceMarketOptionsRequestTypeDef"
     if no_spot:
         instance_market_options = {}
     else:
         instance_market_options = {"MarketType": "spot"}
 
+    import botocore.exceptions
+
     logging.info("Starting instance")
     try:
         run_instances = ec2.run_instances(
@@ -56,15 +66,17 @@ def smoke_test(image_id: str, run_id: str, cancel: bool, no_spot: bool) -> None:
         return
 
     instance_id = instance["InstanceId"]
+    waiter = shared_waiter()
+    region = ec2.meta.region_name
 
     try:
         if cancel:
             return
         # This basically waits for DHCP to have finished; as it uses ARP to check if the instance is healthy
         logging.info(f"Waiting for instance {instance_id} to be running")
-        ec2.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+        waiter.submit(region, INSTANCE_RUNNING, instance_id).result()
         logging.info(f"Waiting for instance {instance_id} to be healthy")
-        ec2.get_waiter("instance_status_ok").wait(InstanceIds=[instance_id])
+        waiter.submit(region, INSTANCE_STATUS_OK, instance_id).result()
         tries = 5
         console_output = ec2.get_console_output(InstanceId=instance_id, Latest=True)
         output = console_output.get("Output")
@@ -83,7 +95,7 @@ def smoke_test(image_id: str, run_id: str, cancel: bool, no_spot: bool) -> None:
     finally:
         logging.info(f"Terminating instance {instance_id}")
         ec2.terminate_instances(InstanceIds=[instance_id])
-        ec2.get_waiter("instance_terminated").wait(InstanceIds=[instance_id])
+        waiter.submit(region, INSTANCE_TERMINATED, instance_id).result()
 
 
 def main() -> None:
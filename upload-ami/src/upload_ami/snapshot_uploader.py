@@ -1,29 +1,118 @@
-"""Upload raw disk images to EBS snapshots via EBS Direct APIs.
+"""Upload disk images to EBS snapshots via EBS Direct APIs.
 
 Uses PutSnapshotBlock to write 512 KiB blocks in parallel.  Retries
-are handled by boto3's adaptive retry mode.
+are handled by boto3's standard retry mode.  Images may be raw files,
+xz/zstd-compressed raw files, VHD or qcow2; see :mod:`.block_source`.
+
+Blocks that are all zeros are never sent: a new snapshot reads as zeros
+wherever no block was written.  Holes in sparse image files are found
+with SEEK_DATA/SEEK_HOLE so they are not even read.
+
+Incremental snapshots start from a parent snapshot and only write the
+blocks whose SHA-256 differs from the parent's block manifest.
+
+The block manifest of every uploaded image is also kept under the
+image's fingerprint, so later uploads of the same image, such as
+reruns or uploads to further regions, neither hash it again nor read
+blocks they will not write.
+
+With a state directory and a client token, acknowledged blocks are
+journaled so an interrupted upload resumes into the same pending
+snapshot instead of starting over.
+
+Unless a fixed number of workers is requested, the number of concurrent
+PutSnapshotBlock calls is adapted to the observed latency and throttling
+by an :class:`.concurrency.AimdController`.
+
+Per-block read, hash and write latencies, retries and bytes sent or
+skipped are collected in :class:`.metrics.UploadMetrics`.
+
+:func:`upload_snapshots` writes the same image to snapshots in several
+regions at once, reading and hashing every block only once.
 """
 
+from __future__ import annotations
+
 import base64
 import hashlib
+import itertools
 import logging
 import math
-import os
-import threading
+import random
 import time
 import uuid
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import TYPE_CHECKING, Collection, Iterator, Mapping, Sequence
+
+from . import clients
+from .block_journal import BlockJournal
+from .block_manifest import BlockManifest, ManifestError, image_fingerprint
+from .block_source import (
+    BLOCK_SIZE,
+    ZERO_BLOCK,
+    BlockSource,
+    BufferPool,
+    open_block_source,
+)
+from .concurrency import AimdController
+from .metrics import UploadMetrics
+from .waiters import SNAPSHOT_COMPLETED, shared_waiter
 
-import boto3
-import botocore.config
-from mypy_boto3_ebs.client import EBSClient
+if TYPE_CHECKING:
+    from mypy_boto3_ebs.client import EBSClient
 
 log = logging.getLogger(__name__)
 
-BLOCK_SIZE = 512 * 1024  # Fixed by EBS Direct API.
 GIB = 1024**3
 
+# Range and starting point of the adaptive number of concurrent uploads.
+# When uploading to several regions, MAX_WORKERS is shared between them.
+MIN_WORKERS = 4
+MAX_WORKERS = 128
+INITIAL_WORKERS = 16
+
+_ZERO_DIGEST = hashlib.sha256(ZERO_BLOCK).digest()
+
+
+class VerificationError(Exception):
+    """A completed snapshot does not hold the uploaded image."""
+
+
+@dataclass
+class _Target:
+    """A pending snapshot in one region that blocks are written to."""
+
+    region: str
+    client: EBSClient
+    controller: AimdController
+    snapshot_id: str
+    parent: BlockManifest | None
+    journal: BlockJournal | None
+    metrics: UploadMetrics
+    executor: ThreadPoolExecutor | None = None
+    failed: dict[int, BaseException] = field(default_factory=dict)
+
+    @property
+    def written(self) -> dict[int, bytes]:
+        """Blocks already written before this run, from the journal."""
+        return self.journal.entries if self.journal is not None else {}
+
+    def fail(self, block_index: int, exc: BaseException) -> None:
+        if not self.failed:
+            log.error(
+                "Writing %s failed at block %d: %s", self.snapshot_id, block_index, exc
+            )
+        self.failed[block_index] = exc
+
+    def error(self) -> RuntimeError:
+        first_idx = min(self.failed)
+        return RuntimeError(
+            f"{len(self.failed)} block(s) failed; "
+            f"first failure at block {first_idx}: {self.failed[first_idx]}"
+        )
+
 
 def upload_snapshot(
     path: str | Path,
@@ -33,29 +122,316 @@ def upload_snapshot(
     description: str | None = None,
     tags: dict[str, str] | None = None,
     client_token: str | None = None,
-    workers: int = 64,
+    workers: int | None = None,
     timeout_minutes: int = 60,
+    parent_snapshot_id: str | None = None,
+    state_dir: Path | None = None,
+    metrics_dir: Path | None = None,
+    verify: float = 0.0,
+    read_mode: str = "cached",
 ) -> str:
-    """Upload a raw disk image to a new EBS snapshot.
+    """Upload a disk image to a new EBS snapshot.
+
+    The image format is detected by :func:`.block_source.open_block_source`,
+    which also applies *read_mode*.
 
     Returns the snapshot ID on success.  On failure the incomplete
-    snapshot is deleted and the exception is re-raised.
+    snapshot is deleted and the exception is re-raised, unless the upload
+    is resumable (see below).
 
     If *client_token* is provided and a snapshot with that token already
     exists in completed state, returns immediately (idempotent retry).
     If *tags* are provided they are set atomically at snapshot creation.
+
+    If *state_dir* is given, a block manifest of the uploaded image is
+    stored there, both for the snapshot and for the image file; the
+    latter saves hashing the image again when it is uploaded again.  If
+    additionally *parent_snapshot_id* is given and its
+    manifest is found and matches the parent's blocks, the snapshot is
+    created incrementally on top of the parent and only changed blocks
+    are written.  Otherwise a full upload is done.
+
+    If both *state_dir* and *client_token* are given, every acknowledged
+    block is appended to a journal keyed by the token and the image's
+    fingerprint.  A failed upload then leaves the snapshot pending, and
+    calling again with the same token and image reuses it and writes
+    only the blocks missing from the journal.  EBS cancels the pending
+    snapshot if nothing is written to it for *timeout_minutes*.  The
+    snapshot's client token is then derived from both, so that an image
+    rebuilt under the same name gets a snapshot of its own rather than
+    the blocks of the earlier build.
+
+    If *workers* is None, the number of concurrent uploads adapts between
+    MIN_WORKERS and MAX_WORKERS; otherwise exactly *workers* are used.
+
+    If *metrics_dir* is given, a JSON report and a Prometheus textfile of
+    the upload's metrics are written there, also if the upload fails.
+
+    If *verify* is greater than zero, the completed snapshot is checked
+    against the image: ListSnapshotBlocks must report every non-zero
+    block, and that fraction of the reported blocks is read back with
+    GetSnapshotBlock, concurrently, and compared to the SHA-256 of the
+    local data.  1.0 verifies every block.  A snapshot that fails
+    verification is deleted and :class:`VerificationError` is raised.
     """
-    file_path = Path(path)
-    file_size = file_path.stat().st_size
-    block_count = math.ceil(file_size / BLOCK_SIZE)
-    if volume_size_gib is None:
-        volume_size_gib = max(math.ceil(file_size / GIB), 1)
+    snapshot_ids = upload_snapshots(
+        path,
+        regions=[region],
+        volume_size_gib=volume_size_gib,
+        description=description,
+        tags=tags,
+        client_token=client_token,
+        workers=workers,
+        timeout_minutes=timeout_minutes,
+        parent_snapshot_ids=(
+            {region: parent_snapshot_id} if parent_snapshot_id is not None else None
+        ),
+        state_dir=state_dir,
+        metrics_dir=metrics_dir,
+        verify=verify,
+        read_mode=read_mode,
+    )
+    return snapshot_ids[region]
+
+
+def upload_snapshots(
+    path: str | Path,
+    *,
+    regions: Sequence[str],
+    volume_size_gib: int | None = None,
+    description: str | None = None,
+    tags: dict[str, str] | None = None,
+    client_token: str | None = None,
+    workers: int | None = None,
+    timeout_minutes: int = 60,
+    parent_snapshot_ids: Mapping[str, str] | None = None,
+    state_dir: Path | None = None,
+    metrics_dir: Path | None = None,
+    best_effort_regions: Collection[str] = (),
+    verify: float = 0.0,
+    read_mode: str = "cached",
+) -> dict[str, str]:
+    """Upload a disk image to new EBS snapshots in several regions at once.
+
+    Every block is read and hashed once and then written to the pending
+    snapshots in all *regions* in parallel, each region with its own
+    client, connection pool and :class:`AimdController`.  A region that
+    fails stops receiving blocks while the others carry on.
+
+    Returns a dict from region to snapshot ID.  If a region that is not
+    in *best_effort_regions* fails, the error is raised after all other
+    regions finished; failures in best-effort regions are logged and the
+    region is left out of the result.
+
+    *parent_snapshot_ids* maps regions to the parent snapshot of an
+    incremental upload there.  Otherwise the arguments are as for
+    :func:`upload_snapshot`, per region.  If *workers* is None, each
+    region adapts between MIN_WORKERS and ``MAX_WORKERS / len(regions)``
+    concurrent uploads; otherwise each uses exactly *workers*.
+    """
+    image_manifest = None
+    fingerprint = None
+    if state_dir is not None:
+        fingerprint = image_fingerprint(path)
+        image_manifest = _image_manifest_path(state_dir, fingerprint)
+    with open_block_source(path, read_mode) as source:
+        return _upload_snapshots(
+            source,
+            regions=regions,
+            volume_size_gib=volume_size_gib,
+            description=description,
+            tags=tags,
+            client_token=client_token,
+            workers=workers,
+            timeout_minutes=timeout_minutes,
+            parent_snapshot_ids=parent_snapshot_ids or {},
+            state_dir=state_dir,
+            metrics_dir=metrics_dir,
+            best_effort_regions=best_effort_regions,
+            image_manifest=image_manifest,
+            fingerprint=fingerprint,
+            verify=verify,
+        )
+
 
-    client = _create_client(region, workers)
+def _upload_snapshots(
+    source: BlockSource,
+    *,
+    regions: Sequence[str],
+    volume_size_gib: int | None,
+    description: str | None,
+    tags: dict[str, str] | None,
+    client_token: str | None,
+    workers: int | None,
+    timeout_minutes: int,
+    parent_snapshot_ids: Mapping[str, str],
+    state_dir: Path | None,
+    metrics_dir: Path | None,
+    best_effort_regions: Collection[str],
+    image_manifest: Path | None,
+    fingerprint: str | None,
+    verify: float,
+) -> dict[str, str]:
     t0 = time.monotonic()
+    snapshot_ids: dict[str, str] = {}
+    targets: list[_Target] = []
+    errors: dict[str, BaseException] = {}
+
+    def start(region: str) -> str | _Target:
+        return _start_target(
+            source,
+            region,
+            volume_size_gib=volume_size_gib,
+            description=description,
+            tags=tags,
+            client_token=client_token,
+            workers=workers,
+            region_count=len(regions),
+            timeout_minutes=timeout_minutes,
+            parent_snapshot_id=parent_snapshot_ids.get(region),
+            state_dir=state_dir,
+            fingerprint=fingerprint,
+        )
+
+    with ThreadPoolExecutor(max_workers=min(len(regions), 32)) as executor:
+        started = {region: executor.submit(start, region) for region in regions}
+    for region, future in started.items():
+        exc = future.exception()
+        if exc is not None:
+            errors[region] = exc
+            continue
+        result = future.result()
+        if isinstance(result, str):
+            snapshot_ids[region] = result
+        else:
+            targets.append(result)
+
+    required = [r for r in errors if r not in best_effort_regions]
+    if required:
+        for target in targets:
+            _abandon_target(target, timeout_minutes)
+        _raise_errors(errors, required)
+
+    if targets:
+        manifest = None
+        if image_manifest is not None:
+            manifest = _load_image_manifest(image_manifest, source)
+        known = manifest is not None
+        if manifest is None:
+            manifest = BlockManifest(BLOCK_SIZE, source.block_count, source.size)
+        try:
+            _upload_blocks(source, targets, manifest, known)
+            if image_manifest is not None and not known:
+                if any(not t.failed for t in targets):
+                    manifest.save(image_manifest)
+        except BaseException as exc:
+            # Not a block failure, e.g. a corrupt compressed image.
+            for target in targets:
+                target.failed.setdefault(-1, exc)
+            raise
+        finally:
+            with ThreadPoolExecutor(max_workers=min(len(targets), 32)) as executor:
+                finished = {
+                    t.region: executor.submit(
+                        _finish_target,
+                        t,
+                        manifest,
+                        t0,
+                        timeout_minutes,
+                        state_dir,
+                        metrics_dir,
+                        verify,
+                    )
+                    for t in targets
+                }
+        for region, finish in finished.items():
+            error = finish.exception()
+            if error is not None:
+                errors[region] = error
+            else:
+                snapshot_ids[region] = finish.result()
+
+    for region, error in errors.items():
+        if region in best_effort_regions:
+            log.warning(
+                "Upload to %s failed (best-effort, ignoring): %s", region, error
+            )
+    _raise_errors(errors, [r for r in errors if r not in best_effort_regions])
+
+    elapsed = time.monotonic() - t0
+    throughput = (source.size / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
+    log.info(
+        "Completed %s: %.1fs, %.1f MiB/s",
+        ", ".join(snapshot_ids.values()),
+        elapsed,
+        throughput,
+    )
+    return snapshot_ids
+
+
+def _raise_errors(errors: Mapping[str, BaseException], regions: list[str]) -> None:
+    if len(regions) == 1:
+        raise errors[regions[0]]
+    if regions:
+        details = "; ".join(f"{r}: {errors[r]}" for r in regions)
+        raise RuntimeError(f"Upload failed in {len(regions)} regions: {details}")
+
+
+def _start_target(
+    source: BlockSource,
+    region: str,
+    *,
+    volume_size_gib: int | None,
+    description: str | None,
+    tags: dict[str, str] | None,
+    client_token: str | None,
+    workers: int | None,
+    region_count: int,
+    timeout_minutes: int,
+    parent_snapshot_id: str | None,
+    state_dir: Path | None,
+    fingerprint: str | None = None,
+) -> str | _Target:
+    """Start the snapshot for one region.
+
+    Returns the snapshot ID if it already completed (idempotent retry),
+    otherwise the target to write its blocks to.
+    """
+    journaled = (
+        state_dir is not None and client_token is not None and fingerprint is not None
+    )
+    if journaled:
+        assert client_token is not None and fingerprint is not None
+        client_token = _snapshot_token(client_token, fingerprint)
+    block_count = source.block_count
+    if volume_size_gib is None:
+        volume_size_gib = max(math.ceil(source.size / GIB), 1)
+
+    if workers is None:
+        maximum = max(MIN_WORKERS, MAX_WORKERS // region_count)
+        controller = AimdController(MIN_WORKERS, maximum, min(INITIAL_WORKERS, maximum))
+    else:
+        controller = AimdController(workers, workers)
+    client = _create_client(region, controller.maximum)
+
+    parent: BlockManifest | None = None
+    if parent_snapshot_id is not None and state_dir is not None:
+        parent = _load_parent_manifest(client, parent_snapshot_id, state_dir)
+    if parent is not None:
+        block_count = max(block_count, parent.block_count)
+        parent_size_gib = math.ceil(parent.image_size / GIB)
+        volume_size_gib = max(volume_size_gib, parent_size_gib)
+    else:
+        parent_snapshot_id = None
 
     snapshot_id, status = _start_snapshot(
-        client, volume_size_gib, description, timeout_minutes, tags, client_token
+        client,
+        volume_size_gib,
+        description,
+        timeout_minutes,
+        tags,
+        client_token,
+        parent_snapshot_id,
     )
 
     if status == "completed":
@@ -68,49 +444,258 @@ def upload_snapshot(
         )
 
     log.info(
-        "Started %s: %d blocks, %d GiB, %d workers",
+        "Started %s in %s: %d blocks, %d GiB, %d-%d workers, parent %s",
         snapshot_id,
+        region,
         block_count,
         volume_size_gib,
-        workers,
+        controller.minimum,
+        controller.maximum,
+        parent_snapshot_id,
     )
 
+    journal = None
+    if journaled:
+        assert state_dir is not None and client_token is not None
+        assert fingerprint is not None
+        journal = BlockJournal(
+            _journal_path(state_dir, client_token, region), snapshot_id, fingerprint
+        )
+        if journal.stale:
+            journal.remove()
+            _cleanup_snapshot(region, snapshot_id, force=True)
+            raise RuntimeError(
+                f"Pending snapshot {snapshot_id} holds blocks of another image; deleted it"
+            )
+        if journal.entries:
+            log.info(
+                "Resuming %s: %d blocks already written",
+                snapshot_id,
+                len(journal.entries),
+            )
+
+    controller.watch(client, "PutSnapshotBlock")
+    metrics = UploadMetrics(snapshot_id, BLOCK_SIZE)
+    metrics.block_count = block_count
+    metrics.watch(client, "PutSnapshotBlock")
+    return _Target(region, client, controller, snapshot_id, parent, journal, metrics)
+
+
+def _abandon_target(target: _Target, timeout_minutes: int) -> None:
+    """Leave a failed snapshot pending to resume it later, or delete it."""
+    if target.journal is not None:
+        target.journal.close()
+        log.info(
+            "Leaving %s pending; rerun within %d minutes to resume",
+            target.snapshot_id,
+            timeout_minutes,
+        )
+    else:
+        _cleanup_snapshot(target.region, target.snapshot_id)
+
+
+def _finish_target(
+    target: _Target,
+    manifest: BlockManifest,
+    t0: float,
+    timeout_minutes: int,
+    state_dir: Path | None,
+    metrics_dir: Path | None,
+    verify: float,
+) -> str:
+    """Complete a target's snapshot, or abandon it if writing it failed."""
+    snapshot_id = target.snapshot_id
+    controller = target.controller
+    metrics = target.metrics
     try:
-        _upload_blocks(
-            file_path,
+        if target.failed:
+            log.error(
+                "Upload failed after %.1fs for %s", time.monotonic() - t0, snapshot_id
+            )
+            _abandon_target(target, timeout_minutes)
+            raise target.error()
+        metrics.visited_all = True
+        changed_blocks = metrics.blocks_sent + len(target.written)
+        log.info(
+            "Settled on %d concurrent uploads for %s "
+            "(peak %d, %d throttled or failed requests)",
+            controller.limit,
             snapshot_id,
-            block_count,
-            file_size,
-            client,
-            workers,
+            controller.peak,
+            controller.congestion_events,
         )
-        status = _complete_snapshot(client, snapshot_id, block_count)
-        if status == "error":
-            raise RuntimeError(f"CompleteSnapshot returned error for {snapshot_id}")
-        if status != "completed":
-            _wait_for_snapshot(region, snapshot_id)
-    except Exception:
-        elapsed = time.monotonic() - t0
-        log.error("Upload failed after %.1fs for %s", elapsed, snapshot_id)
-        _cleanup_snapshot(region, snapshot_id)
-        raise
-
-    elapsed = time.monotonic() - t0
-    throughput = (file_size / (1024 * 1024)) / elapsed if elapsed > 0 else 0.0
-    log.info("Completed %s: %.1fs, %.1f MiB/s", snapshot_id, elapsed, throughput)
+        log.info(
+            "Uploaded %d of %d blocks for %s, skipped %d zero or unchanged blocks",
+            changed_blocks,
+            metrics.block_count,
+            snapshot_id,
+            metrics.block_count - changed_blocks,
+        )
+        try:
+            status = _complete_snapshot(target.client, snapshot_id, changed_blocks)
+            if status == "error":
+                raise RuntimeError(f"CompleteSnapshot returned error for {snapshot_id}")
+            if state_dir is not None:
+                manifest.save(_manifest_path(state_dir, snapshot_id))
+            if target.journal is not None:
+                target.journal.remove()
+            if status != "completed":
+                _wait_for_snapshot(target.region, snapshot_id)
+            if verify > 0:
+                _verify_snapshot(target, manifest, verify)
+        except Exception as exc:
+            log.error(
+                "Upload failed after %.1fs for %s", time.monotonic() - t0, snapshot_id
+            )
+            _cleanup_snapshot(
+                target.region,
+                snapshot_id,
+                force=isinstance(exc, VerificationError),
+            )
+            raise
+    finally:
+        metrics.elapsed = time.monotonic() - t0
+        metrics.gauges["concurrency_limit"] = controller.limit
+        metrics.gauges["concurrency_peak"] = controller.peak
+        _log_metrics(metrics)
+        if metrics_dir is not None:
+            try:
+                json_path, _ = metrics.write(metrics_dir)
+                log.info("Wrote upload metrics to %s", json_path)
+            except OSError as exc:
+                log.warning("Failed to write upload metrics: %s", exc)
     return snapshot_id
 
 
 def _create_client(region: str, max_connections: int) -> EBSClient:
-    """Create a boto3 EBS client with adaptive retry and a sized connection pool."""
-    cfg = botocore.config.Config(
-        retries={"mode": "adaptive"},
+    """Create an EBS client with standard retry and a sized connection pool.
+
+    Not adaptive retry: its client-side rate limiter would fight the
+    :class:`AimdController` over the request rate.
+    """
+    client: EBSClient = clients.create(
+        "ebs",
+        region,
+        retries={"mode": "standard"},
         connect_timeout=5,
         read_timeout=12,
         max_pool_connections=max_connections,
         tcp_keepalive=True,
     )
-    return boto3.client("ebs", region_name=region, config=cfg)
+    return client
+
+
+def _log_metrics(metrics: UploadMetrics) -> None:
+    """Log where the time of an upload went."""
+    for name, histogram in (
+        ("read", metrics.read),
+        ("hash", metrics.hash),
+        ("put", metrics.put),
+    ):
+        if histogram.count:
+            log.info(
+                "Block %s: %d calls, %.1fs total, p50 <= %ss, p99 <= %ss",
+                name,
+                histogram.count,
+                histogram.sum,
+                histogram.quantile(0.5),
+                histogram.quantile(0.99),
+            )
+    log.info(
+        "Sent %d bytes, skipped %s blocks, failed attempts %s",
+        metrics.bytes_sent,
+        metrics.report()["blocks_skipped"],
+        metrics.retries,
+    )
+
+
+def _manifest_path(state_dir: Path, snapshot_id: str) -> Path:
+    return state_dir / "manifests" / f"{snapshot_id}.bin"
+
+
+def _image_manifest_path(state_dir: Path, fingerprint: str) -> Path:
+    return state_dir / "images" / f"{fingerprint}.bin"
+
+
+def _load_image_manifest(path: Path, source: BlockSource) -> BlockManifest | None:
+    """Load the block manifest of the image being uploaded, if one is stored."""
+    try:
+        manifest = BlockManifest.load(path)
+    except FileNotFoundError:
+        return None
+    except ManifestError as exc:
+        log.warning("Ignoring image manifest: %s", exc)
+        return None
+    if (
+        manifest.block_size != BLOCK_SIZE
+        or manifest.block_count != source.block_count
+        or manifest.image_size != source.size
+    ):
+        log.warning("Ignoring image manifest %s: wrong size", path)
+        return None
+    log.info("Reusing block digests from %s", path)
+    return manifest
+
+
+def _snapshot_token(client_token: str, fingerprint: str) -> str:
+    """The client token of the snapshot of the image with *fingerprint*."""
+    return hashlib.sha256(f"{client_token}\0{fingerprint}".encode()).hexdigest()
+
+
+def _journal_path(state_dir: Path, client_token: str, region: str) -> Path:
+    return state_dir / "journals" / f"{client_token}.{region}.log"
+
+
+def _list_snapshot_blocks(client: EBSClient, snapshot_id: str) -> dict[int, str]:
+    """Return the indices and block tokens of all blocks stored in a snapshot."""
+    blocks: dict[int, str] = {}
+    kwargs: dict[str, object] = {"SnapshotId": snapshot_id, "MaxResults": 10000}
+    while True:
+        resp = client.list_snapshot_blocks(**kwargs)  # type: ignore[arg-type]
+        if resp["BlockSize"] != BLOCK_SIZE:
+            raise RuntimeError(
+                f"{snapshot_id} has unexpected block size {resp['BlockSize']}"
+            )
+        blocks.update(
+            (b["BlockIndex"], b["BlockToken"])
+            for b in resp["Blocks"]
+            if "BlockIndex" in b and "BlockToken" in b
+        )
+        if "NextToken" not in resp:
+            return blocks
+        kwargs["NextToken"] = resp["NextToken"]
+
+
+def _load_parent_manifest(
+    client: EBSClient, parent_snapshot_id: str, state_dir: Path
+) -> BlockManifest | None:
+    """Load the manifest of a parent snapshot for an incremental upload.
+
+    Returns None if there is no usable manifest, or if it does not list
+    exactly the blocks that ListSnapshotBlocks reports for the parent.
+    """
+    path = _manifest_path(state_dir, parent_snapshot_id)
+    try:
+        manifest = BlockManifest.load(path)
+    except FileNotFoundError:
+        log.warning("No manifest for %s, doing a full upload", parent_snapshot_id)
+        return None
+    except ManifestError as exc:
+        log.warning("Ignoring manifest for %s: %s", parent_snapshot_id, exc)
+        return None
+    if manifest.block_size != BLOCK_SIZE:
+        log.warning("Ignoring manifest for %s: wrong block size", parent_snapshot_id)
+        return None
+    if (
+        _list_snapshot_blocks(client, parent_snapshot_id).keys()
+        != manifest.data_blocks()
+    ):
+        log.warning(
+            "Manifest for %s does not match its blocks, doing a full upload",
+            parent_snapshot_id,
+        )
+        return None
+    return manifest
 
 
 def _start_snapshot(
@@ -120,6 +705,7 @@ def _start_snapshot(
     timeout_minutes: int,
     tags: dict[str, str] | None,
     client_token: str | None,
+    parent_snapshot_id: str | None = None,
 ) -> tuple[str, str]:
     """Start a snapshot, returning (snapshot_id, status).
 
@@ -134,51 +720,59 @@ def _start_snapshot(
     }
     if description is not None:
         kwargs["Description"] = description
+    if parent_snapshot_id is not None:
+        kwargs["ParentSnapshotId"] = parent_snapshot_id
     if tags:
         kwargs["Tags"] = [{"Key": k, "Value": v} for k, v in tags.items()]
     resp = client.start_snapshot(**kwargs)  # type: ignore[arg-type]
     return resp["SnapshotId"], resp["Status"]
 
 
-def _complete_snapshot(client: EBSClient, snapshot_id: str, block_count: int) -> str:
+def _complete_snapshot(client: EBSClient, snapshot_id: str, changed_blocks: int) -> str:
     """Complete the snapshot.
 
+    *changed_blocks* must be the number of blocks actually written.
     Returns the snapshot status from the CompleteSnapshot response.
-    Retries are handled by boto3's adaptive retry mode.
+    Retries are handled by boto3's standard retry mode.
     """
     resp = client.complete_snapshot(
-        SnapshotId=snapshot_id, ChangedBlocksCount=block_count
+        SnapshotId=snapshot_id, ChangedBlocksCount=changed_blocks
     )
     return resp["Status"]
 
 
 def _put_block(
-    client: EBSClient, snapshot_id: str, block_index: int, data: bytes
+    client: EBSClient,
+    snapshot_id: str,
+    block_index: int,
+    data: bytes | bytearray,
+    digest: bytes,
 ) -> None:
-    checksum = base64.b64encode(hashlib.sha256(data).digest()).decode("ascii")
+    checksum = base64.b64encode(digest).decode("ascii")
     client.put_snapshot_block(
         SnapshotId=snapshot_id,
         BlockIndex=block_index,
-        BlockData=data,
+        BlockData=data,  # type: ignore[arg-type]  # botocore accepts bytearray
         DataLength=len(data),
         Checksum=checksum,
         ChecksumAlgorithm="SHA256",
     )
 
 
-def _cleanup_snapshot(region: str, snapshot_id: str) -> None:
+def _cleanup_snapshot(region: str, snapshot_id: str, force: bool = False) -> None:
     """Check snapshot state and clean up if appropriate.
 
     If the snapshot reached 'completed' despite the error (e.g. waiter
-    timeout on a slow finalization), log a warning but do not delete it.
+    timeout on a slow finalization), log a warning but do not delete it,
+    unless *force* is set because its contents are known to be wrong.
     If it is in 'error' or still 'pending', delete it.
     """
     try:
-        ec2 = boto3.client("ec2", region_name=region)
+        ec2 = clients.ec2(region)
         resp = ec2.describe_snapshots(SnapshotIds=[snapshot_id])
         if resp["Snapshots"]:
             state = resp["Snapshots"][0].get("State", "")
-            if state == "completed":
+            if state == "completed" and not force:
                 log.warning(
                     "Snapshot %s is completed despite error; not deleting",
                     snapshot_id,
@@ -194,82 +788,315 @@ def _wait_for_snapshot(region: str, snapshot_id: str) -> None:
     """Wait for the snapshot to reach 'completed' state in EC2.
 
     CompleteSnapshot starts an async workflow; the EC2 snapshot may still
-    be 'pending' briefly.  Poll every 2 seconds for up to 60 seconds.
+    be 'pending' briefly.  Wait for up to 60 seconds, polling together
+    with the other regions' snapshots.
     """
-    ec2 = boto3.client("ec2", region_name=region)
-    ec2.get_waiter("snapshot_completed").wait(
-        SnapshotIds=[snapshot_id],
-        WaiterConfig={"Delay": 2, "MaxAttempts": 30},
-    )
+    shared_waiter().submit(region, SNAPSHOT_COMPLETED, snapshot_id, timeout=60).result()
+
+
+def _verify_snapshot(target: _Target, manifest: BlockManifest, sample: float) -> None:
+    """Check that a completed snapshot holds the image described by *manifest*.
 
+    Every non-zero block of the image must be listed by ListSnapshotBlocks.
+    The fraction *sample* of the listed blocks is then read back with
+    GetSnapshotBlock and its SHA-256 compared to the image's; listed
+    blocks that are zero in the image, e.g. zeros written over a parent's
+    data, must read back as zeros.  Reads run concurrently, bounded by
+    the target's :class:`AimdController`.
+    """
+    snapshot_id = target.snapshot_id
+    client = target.client
+    controller = target.controller
+    t0 = time.monotonic()
+    listed = _list_snapshot_blocks(client, snapshot_id)
+    missing = manifest.data_blocks() - listed.keys()
+    if missing:
+        raise VerificationError(
+            f"{snapshot_id} is missing {len(missing)} block(s), "
+            f"first at block {min(missing)}"
+        )
+    indices = sorted(listed)
+    if sample < 1.0:
+        indices = sorted(random.sample(indices, math.ceil(len(indices) * sample)))
 
-def _read_block(fd: int, block_index: int, file_size: int) -> bytes:
-    """Read one 512 KiB block via pread, zero-padding the last block."""
-    offset = block_index * BLOCK_SIZE
-    to_read = min(BLOCK_SIZE, file_size - offset)
-    data = os.pread(fd, to_read, offset)
-    if len(data) < to_read:
-        raise OSError(
-            f"Short read at block {block_index}: expected {to_read}, got {len(data)}"
+    def check(block_index: int) -> bool:
+        with controller.slot():
+            start = time.monotonic()
+            resp = client.get_snapshot_block(
+                SnapshotId=snapshot_id,
+                BlockIndex=block_index,
+                BlockToken=listed[block_index],
+            )
+            data = resp["BlockData"].read()
+            controller.on_success(time.monotonic() - start)
+        expected = manifest.digest(block_index) or _ZERO_DIGEST
+        return hashlib.sha256(data).digest() == expected
+
+    controller.watch(client, "GetSnapshotBlock")
+    with ThreadPoolExecutor(max_workers=controller.maximum) as executor:
+        results = dict(zip(indices, executor.map(check, indices)))
+    mismatched = [i for i, ok in results.items() if not ok]
+    elapsed = time.monotonic() - t0
+    nbytes = len(indices) * BLOCK_SIZE
+    throughput = nbytes / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    target.metrics.gauges["verified_blocks"] = len(indices)
+    target.metrics.gauges["verify_seconds"] = elapsed
+    target.metrics.gauges["verify_mib_per_second"] = throughput
+    if mismatched:
+        raise VerificationError(
+            f"{len(mismatched)} of {len(indices)} verified block(s) of "
+            f"{snapshot_id} differ from the image, first at block {mismatched[0]}"
         )
-    if len(data) < BLOCK_SIZE:
-        data += b"\x00" * (BLOCK_SIZE - len(data))
-    return data
+    log.info(
+        "Verified %d of %d blocks of %s in %.1fs, %.1f MiB/s",
+        len(indices),
+        len(listed),
+        snapshot_id,
+        elapsed,
+        throughput,
+    )
 
 
 def _upload_blocks(
-    path: Path,
-    snapshot_id: str,
-    block_count: int,
-    file_size: int,
-    client: EBSClient,
-    workers: int,
+    source: BlockSource,
+    targets: list[_Target],
+    manifest: BlockManifest,
+    known: bool = False,
 ) -> None:
-    """Upload all blocks in parallel. Retries are handled by boto3."""
-    fd = os.open(str(path), os.O_RDONLY)
+    """Upload all non-zero blocks to all targets in parallel.
+
+    Retries are handled by boto3.  Each block is read and hashed once and
+    recorded in *manifest*.  If *known*, *manifest* already holds the
+    digests of all blocks of the image: blocks are not hashed, and blocks
+    that no target needs are not even read.  With a parent manifest,
+    blocks that are unchanged from a target's parent are not written to that target, and
+    blocks where any parent has data are visited even if they are holes
+    in the image so that they can be overwritten with zeros.
+
+    Blocks already in a target's journal are not written to it again;
+    newly written blocks are appended to it.
+
+    At most as many blocks as the largest ``controller.limit`` of the
+    targets are in flight at any time, and each target writes at most its
+    own limit at once.  New blocks are submitted only as earlier ones
+    complete, and block data lives in a bounded :class:`BufferPool`, so
+    memory use does not grow with the image size.
+
+    A failure to write a block fails only that target, recorded in its
+    ``failed``; it is written no further blocks.  A failure to read a
+    block fails all targets.  Once every target has failed, queued blocks
+    are cancelled and this returns once the running uploads have drained.
+    """
+    # One more buffer than blocks in flight for the one a stream source
+    # is decompressing into.
+    buffers = BufferPool(max(t.controller.maximum for t in targets) + 1)
+    pending: dict[Future[None], int] = {}
+
+    parent_blocks: set[int] = set()
+    for target in targets:
+        if target.parent is not None:
+            parent_blocks |= target.parent.data_blocks()
+        if not known:
+            for i, digest in target.written.items():
+                if i >= manifest.block_count:
+                    continue
+                if digest == _ZERO_DIGEST:
+                    manifest.set_zero(i)
+                else:
+                    manifest.set_digest(i, digest)
+        target.metrics.skipped("resumed", len(target.written))
+
+    blocks: Iterator[tuple[int, bytes | bytearray | None]] = itertools.chain(
+        source.blocks(include=parent_blocks, pool=buffers),
+        # Blocks past the end of a shrunk image.
+        ((i, ZERO_BLOCK) for i in sorted(parent_blocks) if i >= source.block_count),
+    )
+
+    if len(targets) > 1:
+        for target in targets:
+            target.executor = ThreadPoolExecutor(
+                max_workers=target.controller.maximum,
+                thread_name_prefix=f"put-{target.region}",
+            )
     try:
-        failed: dict[int, BaseException] = {}
-        failed_lock = threading.Lock()
-
-        with ThreadPoolExecutor(max_workers=workers) as pool:
-            futures: dict[Future[None], int] = {}
-            for idx in range(block_count):
-                with failed_lock:
-                    if failed:
+        with ThreadPoolExecutor(
+            max_workers=max(t.controller.maximum for t in targets)
+        ) as pool:
+            exhausted = False
+            while True:
+                live = [t for t in targets if not t.failed]
+                window = max((t.controller.limit for t in live), default=0)
+                while not exhausted and len(pending) < window:
+                    t0 = time.monotonic()
+                    block = next(blocks, None)
+                    if block is None:
+                        exhausted = True
                         break
-                f = pool.submit(
-                    _upload_one_block,
-                    fd,
-                    snapshot_id,
-                    idx,
-                    file_size,
-                    client,
-                )
-                futures[f] = idx
+                    idx, data = block
+                    if isinstance(data, bytearray):
+                        # Decompressed by a stream source.
+                        for target in live:
+                            target.metrics.read.observe(time.monotonic() - t0)
+                    needed = [t for t in live if idx not in t.written]
+                    if known:
+                        needed = _targets_to_write(needed, idx, manifest.digest(idx))
+                    if not needed:
+                        if isinstance(data, bytearray):
+                            buffers.release(data)
+                        continue
+                    f = pool.submit(
+                        _upload_one_block,
+                        source,
+                        buffers,
+                        idx,
+                        data,
+                        needed,
+                        manifest,
+                        known,
+                    )
+                    pending[f] = idx
 
-            for f in as_completed(futures):
-                exc = f.exception()
-                if exc is not None:
-                    with failed_lock:
-                        failed[futures[f]] = exc
-    finally:
-        os.close(fd)
+                if not pending:
+                    break
 
-    if failed:
-        first_idx = min(failed)
-        raise RuntimeError(
-            f"{len(failed)} block(s) failed; "
-            f"first failure at block {first_idx}: {failed[first_idx]}"
-        )
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for f in done:
+                    idx = pending.pop(f)
+                    if f.cancelled():
+                        continue
+                    exc = f.exception()
+                    if exc is not None:
+                        for target in targets:
+                            target.fail(idx, exc)
+                if all(t.failed for t in targets):
+                    for other in pending:
+                        other.cancel()
+    finally:
+        for target in targets:
+            if target.executor is not None:
+                target.executor.shutdown()
+                target.executor = None
 
 
 def _upload_one_block(
-    fd: int,
-    snapshot_id: str,
+    source: BlockSource,
+    buffers: BufferPool,
     block_index: int,
-    file_size: int,
-    client: EBSClient,
+    data: bytes | bytearray | None,
+    targets: list[_Target],
+    manifest: BlockManifest,
+    known: bool,
 ) -> None:
-    """Upload a single block. Retries are handled by boto3."""
-    data = _read_block(fd, block_index, file_size)
-    _put_block(client, snapshot_id, block_index, data)
+    """Write a single block to every target it is not zero or unchanged in.
+
+    If *known*, *manifest* already has the block's digest and *targets*
+    are those to write it to.  Otherwise the block is hashed once for all
+    targets and recorded in *manifest*.  *data* is read from *source*
+    into a buffer from *buffers* unless the source already provided it;
+    pooled buffers are released once every target is done with the block.
+    Retries are handled by boto3.
+    """
+    buffer = data if isinstance(data, bytearray) else None
+    try:
+        if known:
+            digest = manifest.digest(block_index)
+            writes = targets
+        else:
+            if data is None:
+                buffer = data = _read_block(source, buffers, block_index, targets)
+            if data == ZERO_BLOCK:
+                if block_index < manifest.block_count:
+                    manifest.set_zero(block_index)
+                digest = None
+            else:
+                t0 = time.monotonic()
+                digest = hashlib.sha256(data).digest()
+                for target in targets:
+                    target.metrics.hash.observe(time.monotonic() - t0)
+                manifest.set_digest(block_index, digest)
+            writes = _targets_to_write(targets, block_index, digest)
+        if not writes:
+            return
+        if digest is None:
+            data = ZERO_BLOCK
+            digest = _ZERO_DIGEST
+        elif data is None:
+            buffer = data = _read_block(source, buffers, block_index, writes)
+        if len(writes) == 1:
+            _write_block(writes[0], block_index, data, digest)
+        else:
+            futures = []
+            for target in writes:
+                assert target.executor is not None
+                futures.append(
+                    target.executor.submit(
+                        _write_block, target, block_index, data, digest
+                    )
+                )
+            wait(futures)
+    finally:
+        if buffer is not None:
+            buffers.release(buffer)
+
+
+def _read_block(
+    source: BlockSource, buffers: BufferPool, block_index: int, targets: list[_Target]
+) -> bytearray:
+    """Read a block into a pooled buffer, which the caller must release."""
+    buffer = buffers.acquire()
+    try:
+        t0 = time.monotonic()
+        source.read_block_into(block_index, buffer)
+    except BaseException:
+        buffers.release(buffer)
+        raise
+    for target in targets:
+        target.metrics.read.observe(time.monotonic() - t0)
+    return buffer
+
+
+def _targets_to_write(
+    targets: list[_Target], block_index: int, digest: bytes | None
+) -> list[_Target]:
+    """Return the targets a block with *digest* must be written to.
+
+    *digest* is None for a zero block, which only needs writing where the
+    parent has data.  Skipped blocks are counted in the targets' metrics.
+    """
+    writes = []
+    for target in targets:
+        parent = target.parent
+        if digest is None and (parent is None or parent.is_zero(block_index)):
+            target.metrics.skipped("zero")
+        elif digest is not None and (
+            parent is not None and parent.digest(block_index) == digest
+        ):
+            target.metrics.skipped("unchanged")
+        else:
+            writes.append(target)
+    return writes
+
+
+def _write_block(
+    target: _Target, block_index: int, data: bytes | bytearray, digest: bytes
+) -> None:
+    """Write a block to one target, recording a failure in the target.
+
+    The latency of the write is reported to the target's controller and
+    metrics, and the block is journaled once acknowledged.
+    """
+    if target.failed:
+        return
+    try:
+        with target.controller.slot():
+            t0 = time.monotonic()
+            _put_block(target.client, target.snapshot_id, block_index, data, digest)
+            latency = time.monotonic() - t0
+    except Exception as exc:
+        target.fail(block_index, exc)
+        return
+    target.controller.on_success(latency)
+    target.metrics.put.observe(latency)
+    target.metrics.sent(len(data))
+    if target.journal is not None:
+        target.journal.record(block_index, digest)
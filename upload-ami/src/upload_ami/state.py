@@ -0,0 +1,10 @@
+"""Local state kept between runs of the upload tools."""
+
+import os
+from pathlib import Path
+
+
+def default_state_dir() -> Path:
+    """Return ``$XDG_CACHE_HOME/upload-ami``, defaulting to ``~/.cache``."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return Path(cache_home).expanduser() / "upload-ami"
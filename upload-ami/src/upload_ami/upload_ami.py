@@ -1,23 +1,38 @@
+from __future__ import annotations
+
 import json
 import hashlib
 import logging
+import math
+import re
+import threading
+import time
 from pathlib import Path
-from typing import Iterable, Literal, TypedDict
-import boto3
-import boto3.ec2
-import boto3.ec2.createtags
-import botocore
-import botocore.exceptions
+from typing import TYPE_CHECKING, Iterable, Literal, TypedDict
 import datetime
-
-from mypy_boto3_ec2.client import EC2Client
-from mypy_boto3_ec2.literals import BootModeValuesType
-from mypy_boto3_ec2.type_defs import RegionTypeDef, RegisterImageRequestTypeDef
-from mypy_boto3_s3.client import S3Client
+import functools
 
 from concurrent.futures import ThreadPoolExecutor
 
-from .snapshot_uploader import upload_snapshot
+from . import clients
+from .block_source import READ_MODES
+from .copy_plan import COPY_CONCURRENCY, plan_copies
+from .metrics import UploadMetrics
+from .pipeline import Pipeline, StageSkipped
+from .run_state import RunState
+from .smoke_test import smoke_test as run_smoke_test
+from .snapshot_uploader import upload_snapshot, upload_snapshots
+from .state import default_state_dir
+from .waiters import IMAGE_AVAILABLE, SNAPSHOT_IMPORTED, shared_waiter
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.client import EC2Client
+    from mypy_boto3_ec2.literals import BootModeValuesType
+    from mypy_boto3_ec2.type_defs import (
+        ImportSnapshotTaskTypeDef,
+        RegisterImageRequestTypeDef,
+    )
+    from mypy_boto3_s3.client import S3Client
 
 
 class ImageInfo(TypedDict):
@@ -28,21 +43,103 @@ class ImageInfo(TypedDict):
     format: str
 
 
+# Defaults for multipart uploads of images to S3.
+S3_PART_SIZE_MIB = 64
+S3_CONCURRENCY = 16
+
+
 def upload_to_s3_if_not_exists(
-    s3: S3Client, bucket: str, image_name: str, file_path: Path
+    s3: S3Client,
+    bucket: str,
+    image_name: str,
+    file_path: Path,
+    part_size_mib: int = S3_PART_SIZE_MIB,
+    concurrency: int = S3_CONCURRENCY,
+    metrics: UploadMetrics | None = None,
 ) -> None:
     """
     Upload file to S3 if it doesn't exist yet
 
+    The file is uploaded in parts of part_size_mib, concurrency of them at
+    a time, each with its own CRC32 checksum. The CRT transfer client is
+    used where awscrt is available and recent enough for s3transfer; it
+    picks its own concurrency. If metrics is given, the upload's
+    bytes, parts and duration are recorded in it, along with the transfer
+    client used. The CRT client sends its requests itself rather than
+    through s3, so its retries are not counted.
+
     This function is idempotent.
     """
+    import botocore.exceptions
+
     try:
         logging.info(f"Checking if s3://{bucket}/{image_name} exists")
         s3.head_object(Bucket=bucket, Key=image_name)
     except botocore.exceptions.ClientError:
+        from boto3.s3.transfer import (
+            S3Transfer,
+            TransferConfig,
+            create_transfer_manager,
+        )
+        from botocore.compat import HAS_CRT
+        from s3transfer.manager import TransferManager
+
         logging.info(f"Uploading {file_path} to s3://{bucket}/{image_name}")
-        s3.upload_file(str(file_path), bucket, image_name)
-        s3.get_waiter("object_exists").wait(Bucket=bucket, Key=image_name)
+        part_size = part_size_mib * 1024 * 1024
+
+        def config(client: str) -> TransferConfig:
+            return TransferConfig(
+                multipart_threshold=part_size,
+                multipart_chunksize=part_size,
+                max_concurrency=concurrency,
+                preferred_transfer_client=client,
+            )
+
+        # Created here rather than by s3.upload_file to find out which
+        # client boto3 settled on.
+        try:
+            manager = create_transfer_manager(
+                s3, config("crt" if HAS_CRT else "classic")
+            )
+        except botocore.exceptions.MissingDependencyException as e:
+            # awscrt is older than s3transfer supports.
+            logging.info(f"Falling back to the classic transfer client: {e}")
+            manager = create_transfer_manager(s3, config("classic"))
+        classic = isinstance(manager, TransferManager)
+        logging.info(f"Using the {'classic' if classic else 'CRT'} transfer client")
+        if metrics is not None:
+            metrics.info["transfer_client"] = "classic" if classic else "crt"
+            if classic:
+                metrics.watch(s3, "UploadPart")
+            else:
+                metrics.retries_counted = False
+        t0 = time.monotonic()
+        # upload_file returns once the upload is complete, and S3 reads
+        # after writes are strongly consistent, so no need to wait for
+        # the object to exist.
+        with S3Transfer(manager=manager) as transfer:
+            transfer.upload_file(
+                str(file_path),
+                bucket,
+                image_name,
+                extra_args={"ChecksumAlgorithm": "CRC32"},
+            )
+        elapsed = time.monotonic() - t0
+        size = file_path.stat().st_size
+        throughput = size / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+        logging.info(
+            f"Uploaded {size} bytes to s3://{bucket}/{image_name} "
+            f"in {elapsed:.1f}s, {throughput:.1f} MiB/s"
+        )
+        if metrics is not None:
+            parts = max(math.ceil(size / part_size), 1)
+            metrics.block_count = parts
+            metrics.blocks_sent = parts
+            metrics.bytes_sent = size
+            metrics.elapsed = elapsed
+            # The CRT client picks its own concurrency.
+            if classic:
+                metrics.gauges["concurrency_limit"] = concurrency
 
 
 def import_snapshot_if_not_exist(
@@ -53,12 +150,19 @@ def import_snapshot_if_not_exist(
     image_file: Path,
     image_format: str,
     import_role_name: str,
+    part_size_mib: int = S3_PART_SIZE_MIB,
+    concurrency: int = S3_CONCURRENCY,
+    metrics_dir: Path | None = None,
 ) -> str:
     """
     Import snapshot from S3 and wait for it to finish
 
     This function is idempotent by using the image_name as the client token
 
+    part_size_mib and concurrency tune the upload to S3. If metrics_dir is
+    set, the upload's metrics are written there under the id of the
+    imported snapshot, like those of EBS Direct uploads.
+
     Returns the snapshot id
     """
 
@@ -71,7 +175,16 @@ def import_snapshot_if_not_exist(
         assert "SnapshotId" in snapshots["Snapshots"][0]
         snapshot_id = snapshots["Snapshots"][0]["SnapshotId"]
     else:
-        upload_to_s3_if_not_exists(s3, s3_bucket, image_name, image_file)
+        metrics = UploadMetrics(image_name, part_size_mib * 1024 * 1024)
+        upload_to_s3_if_not_exists(
+            s3,
+            s3_bucket,
+            image_name,
+            image_file,
+            part_size_mib,
+            concurrency,
+            metrics,
+        )
 
         logging.info(f"Importing s3://{s3_bucket}/{image_name} to EC2")
         client_token_hash = hashlib.sha256(image_name.encode())
@@ -98,19 +211,16 @@ def import_snapshot_if_not_exist(
             ClientToken=client_token,
             RoleName=import_role_name,
         )
-        ec2.get_waiter("snapshot_imported").wait(
-            ImportTaskIds=[snapshot_import_task["ImportTaskId"]],
-            WaiterConfig={
-                "Delay": 15,  # Same as the default for this waiter
-                "MaxAttempts": 400,  # Default is 40 (10min) 400 is 100 minutes
-            },
-        )
-
-        snapshot_import_tasks = ec2.describe_import_snapshot_tasks(
-            ImportTaskIds=[snapshot_import_task["ImportTaskId"]]
+        snapshot_import_task_2: ImportSnapshotTaskTypeDef = (
+            shared_waiter()
+            .submit(
+                ec2.meta.region_name,
+                SNAPSHOT_IMPORTED,
+                snapshot_import_task["ImportTaskId"],
+                timeout=100 * 60,  # Default is 10 minutes
+            )
+            .result()
         )
-        assert len(snapshot_import_tasks["ImportSnapshotTasks"]) != 0
-        snapshot_import_task_2 = snapshot_import_tasks["ImportSnapshotTasks"][0]
         assert "SnapshotTaskDetail" in snapshot_import_task_2
         assert "SnapshotId" in snapshot_import_task_2["SnapshotTaskDetail"]
         snapshot_id = snapshot_import_task_2["SnapshotTaskDetail"]["SnapshotId"]
@@ -121,33 +231,88 @@ def import_snapshot_if_not_exist(
                 {"Key": "ManagedBy", "Value": "NixOS/amis"},
             ],
         )
+        if metrics_dir is not None and metrics.bytes_sent:
+            metrics.snapshot_id = snapshot_id
+            try:
+                json_path, _ = metrics.write(metrics_dir)
+                logging.info(f"Wrote upload metrics to {json_path}")
+            except OSError as e:
+                logging.warning(f"Failed to write upload metrics: {e}")
     s3.delete_object(Bucket=s3_bucket, Key=image_name)
     return snapshot_id
 
 
+def find_previous_snapshot(
+    ec2: EC2Client, name_filter: str, image_name: str
+) -> str | None:
+    """
+    Find the newest completed snapshot whose Name tag matches name_filter
+
+    The snapshot of image_name itself is never returned.
+    """
+    previous_id = None
+    previous_time = None
+    pages = ec2.get_paginator("describe_snapshots").paginate(
+        OwnerIds=["self"],
+        Filters=[
+            {"Name": "tag:Name", "Values": [name_filter]},
+            {"Name": "tag:ManagedBy", "Values": ["NixOS/amis"]},
+            {"Name": "status", "Values": ["completed"]},
+        ],
+    )
+    for page in pages:
+        for snapshot in page["Snapshots"]:
+            assert "SnapshotId" in snapshot
+            assert "StartTime" in snapshot
+            tags = {t.get("Key"): t.get("Value") for t in snapshot.get("Tags", [])}
+            if tags.get("Name") == image_name:
+                continue
+            if previous_time is None or snapshot["StartTime"] > previous_time:
+                previous_id = snapshot["SnapshotId"]
+                previous_time = snapshot["StartTime"]
+    return previous_id
+
+
 def import_snapshot_ebs_direct(
     ec2: EC2Client,
     image_name: str,
     image_file: Path,
     region: str,
+    state_dir: Path | None = None,
+    parent_name_filter: str | None = None,
+    metrics_dir: Path | None = None,
+    verify: float = 0.0,
+    read_mode: str = "cached",
 ) -> str:
     """
-    Upload a raw disk image directly to an EBS snapshot via the EBS Direct APIs.
+    Upload a disk image directly to an EBS snapshot via the EBS Direct APIs.
+
+    Raw (optionally xz or zstd compressed), VHD and qcow2 images are
+    read natively, so no conversion step is needed.
 
     Idempotent: returns the existing snapshot ID if one with the same
     name tag already exists.
+
+    If parent_name_filter is set, the newest snapshot matching it is used
+    as the parent of an incremental upload, provided state_dir holds its
+    block manifest.
+
+    If metrics_dir is set, upload metrics are written there as JSON and
+    as a Prometheus textfile.
+
+    If verify is greater than zero, that fraction of the snapshot's
+    blocks is read back and compared to the image after the upload.
+
+    read_mode selects how raw images are read, one of READ_MODES.
     """
-    snapshots = ec2.describe_snapshots(
-        OwnerIds=["self"],
-        Filters=[
-            {"Name": "tag:Name", "Values": [image_name]},
-            {"Name": "status", "Values": ["completed"]},
-        ],
-    )
-    if len(snapshots["Snapshots"]) != 0:
-        assert len(snapshots["Snapshots"]) == 1
-        assert "SnapshotId" in snapshots["Snapshots"][0]
-        return snapshots["Snapshots"][0]["SnapshotId"]
+    snapshot_id = find_completed_snapshot(ec2, image_name)
+    if snapshot_id is not None:
+        return snapshot_id
+
+    parent_snapshot_id = None
+    if parent_name_filter is not None:
+        parent_snapshot_id = find_previous_snapshot(ec2, parent_name_filter, image_name)
+        logging.info(f"Previous snapshot for {image_name}: {parent_snapshot_id}")
 
     client_token = hashlib.sha256(image_name.encode()).hexdigest()
     return upload_snapshot(
@@ -156,7 +321,108 @@ def import_snapshot_ebs_direct(
         description=image_name,
         tags={"Name": image_name, "ManagedBy": "NixOS/amis"},
         client_token=client_token,
+        parent_snapshot_id=parent_snapshot_id,
+        state_dir=state_dir,
+        metrics_dir=metrics_dir,
+        verify=verify,
+        read_mode=read_mode,
+    )
+
+
+def find_completed_snapshot(ec2: EC2Client, image_name: str) -> str | None:
+    """
+    Find the completed snapshot whose Name tag is image_name
+    """
+    snapshots = ec2.describe_snapshots(
+        OwnerIds=["self"],
+        Filters=[
+            {"Name": "tag:Name", "Values": [image_name]},
+            {"Name": "status", "Values": ["completed"]},
+        ],
     )
+    if len(snapshots["Snapshots"]) == 0:
+        return None
+    assert len(snapshots["Snapshots"]) == 1
+    assert "SnapshotId" in snapshots["Snapshots"][0]
+    return snapshots["Snapshots"][0]["SnapshotId"]
+
+
+def import_snapshots_ebs_direct(
+    image_name: str,
+    image_file: Path,
+    regions: list[str],
+    state_dir: Path | None = None,
+    parent_name_filter: str | None = None,
+    metrics_dir: Path | None = None,
+    best_effort_regions: list[str] = [],
+    verify: float = 0.0,
+    read_mode: str = "cached",
+) -> dict[str, str]:
+    """
+    Upload a disk image to EBS snapshots in several regions at once.
+
+    Each block is read and hashed once and written to every region in
+    parallel. Returns the snapshot id for each region; regions in
+    best_effort_regions that fail are left out.
+
+    Idempotent per region like import_snapshot_ebs_direct.
+    """
+
+    def prepare(region: str) -> tuple[str, str | None, str | None] | None:
+        try:
+            ec2r = clients.ec2(region)
+            snapshot_id = find_completed_snapshot(ec2r, image_name)
+            parent_snapshot_id = None
+            if snapshot_id is None and parent_name_filter is not None:
+                parent_snapshot_id = find_previous_snapshot(
+                    ec2r, parent_name_filter, image_name
+                )
+                logging.info(
+                    f"Previous snapshot for {image_name} in {region}: {parent_snapshot_id}"
+                )
+            return region, snapshot_id, parent_snapshot_id
+        except Exception as e:
+            if region not in best_effort_regions:
+                logging.error(f"Preparing upload to {region} failed: {e}")
+                raise
+            logging.warning(
+                f"Preparing upload to {region} failed (best-effort, ignoring): {e}"
+            )
+            return None
+
+    snapshot_ids: dict[str, str] = {}
+    parent_snapshot_ids: dict[str, str] = {}
+    upload_regions = []
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        for result in executor.map(prepare, regions):
+            if result is None:
+                continue
+            region, snapshot_id, parent_snapshot_id = result
+            if snapshot_id is not None:
+                snapshot_ids[region] = snapshot_id
+                continue
+            upload_regions.append(region)
+            if parent_snapshot_id is not None:
+                parent_snapshot_ids[region] = parent_snapshot_id
+
+    if upload_regions:
+        client_token = hashlib.sha256(image_name.encode()).hexdigest()
+        snapshot_ids.update(
+            upload_snapshots(
+                image_file,
+                regions=upload_regions,
+                description=image_name,
+                tags={"Name": image_name, "ManagedBy": "NixOS/amis"},
+                client_token=client_token,
+                parent_snapshot_ids=parent_snapshot_ids,
+                state_dir=state_dir,
+                metrics_dir=metrics_dir,
+                best_effort_regions=best_effort_regions,
+                verify=verify,
+                read_mode=read_mode,
+            )
+        )
+    return snapshot_ids
 
 
 def register_image_if_not_exists(
@@ -164,11 +430,10 @@ def register_image_if_not_exists(
     image_name: str,
     image_info: ImageInfo,
     snapshot_id: str,
-    public: bool,
     enable_tpm: bool,
 ) -> str:
     """
-    Register image if it doesn't exist yet
+    Register image if it doesn't exist yet and wait for it to be available
 
     This function is idempotent because image_name is unique
     """
@@ -230,59 +495,74 @@ def register_image_if_not_exists(
         register_image = ec2.register_image(**register_image_kwargs)
         image_id = register_image["ImageId"]
 
-    ec2.get_waiter("image_available").wait(ImageIds=[image_id])
+    shared_waiter().submit(ec2.meta.region_name, IMAGE_AVAILABLE, image_id).result()
+    return image_id
+
+
+def deprecate_image(ec2: EC2Client, image_id: str) -> None:
+    """
+    Deprecate the image 90 days from now
+    """
     deprecate_at = (datetime.datetime.now() + datetime.timedelta(days=90)).strftime(
         "%Y-%m-%dT%H:%M:%SZ"
     )
     logging.info(f"Deprecating {image_id} at {deprecate_at}")
     ec2.enable_image_deprecation(ImageId=image_id, DeprecateAt=deprecate_at)
-    if public:
-        logging.info(f"Making {image_id} public")
-        ec2.modify_image_attribute(
-            ImageId=image_id,
-            Attribute="launchPermission",
-            LaunchPermission={"Add": [{"Group": "all"}]},
-        )
-    return image_id
 
 
-def copy_image_to_regions(
+def make_image_public(ec2: EC2Client, image_id: str) -> None:
+    logging.info(f"Making {image_id} public")
+    ec2.modify_image_attribute(
+        ImageId=image_id,
+        Attribute="launchPermission",
+        LaunchPermission={"Add": [{"Group": "all"}]},
+    )
+
+
+def copy_image(
     image_id: str,
     image_name: str,
     source_region: str,
-    target_regions: Iterable[RegionTypeDef],
-    public: bool,
-    best_effort_regions: list[str] = [],
-) -> dict[str, str]:
+    from_region: str,
+    target_region_name: str,
+    slots: threading.Semaphore,
+) -> str:
     """
-    Copy image to all target regions
+    Copy image from from_region to target_region and wait for it to be available
 
-    Copies to all regions in parallel and waits for all of them to finish
+    At most as many copies as slots allows run at once; source_region,
+    where the image was first registered, is recorded in a tag.
 
-    This function is idempotent because image_id is unique and we use it
-    as the client_token for the copy_image task
-    """
-
-    def copy_image(
-        image_id: str, image_name: str, source_region: str, target_region_name: str
-    ) -> tuple[str, str]:
-        """
-        Copy image to target_region
+    This function is idempotent because the image name is unique and
+    image_id is unique and we use it as the client_token for the
+    copy_image task. Images that already exist in the target region
+    are reused.
 
-        This function is idempotent because image_id is unique and we use it as
-        the client_token for the copy_image task.
+    TODO: How long can we rely on the client_token? E.g. what happens if I rerun this
+    script a few months later?
 
-        TODO: How long can we rely on the client_token? E.g. what happens if I rerun this
-        script a few months later?
+    """
+    ec2r = clients.ec2(target_region_name)
+    existing = ec2r.describe_images(
+        Owners=["self"], Filters=[{"Name": "name", "Values": [image_name]}]
+    )["Images"]
+    if existing:
+        assert "ImageId" in existing[0]
+        new_image_id = existing[0]["ImageId"]
+        logging.info(f"Image {new_image_id} already exists in {target_region_name}")
+        shared_waiter().submit(
+            target_region_name, IMAGE_AVAILABLE, new_image_id
+        ).result()
+        return new_image_id
 
-        """
-        ec2r: EC2Client = boto3.client("ec2", region_name=target_region_name)
+    # The copy counts against from_region's limit until it is done.
+    with slots:
         logging.info(
-            f"Copying image {image_id} from {source_region} to {target_region_name}"
+            f"Copying image {image_id} from {from_region} to {target_region_name}"
         )
         copy_image = ec2r.copy_image(
             SourceImageId=image_id,
-            SourceRegion=source_region,
+            SourceRegion=from_region,
             Name=image_name,
             ClientToken=image_id,
             TagSpecifications=[
@@ -304,50 +584,198 @@ def copy_image_to_regions(
                 },
             ],
         )
-        ec2r.get_waiter("image_available").wait(ImageIds=[copy_image["ImageId"]])
+        new_image_id = copy_image["ImageId"]
+        shared_waiter().submit(
+            target_region_name, IMAGE_AVAILABLE, new_image_id
+        ).result()
+    logging.info(
+        f"Finished image {image_id} from {from_region} to {target_region_name} {new_image_id}"
+    )
+    return new_image_id
+
+
+def add_copy_stages(
+    pipeline: Pipeline,
+    image_name: str,
+    source_region: str,
+    target_regions: Iterable[str],
+    best_effort_regions: list[str] = [],
+    copy_concurrency: int = COPY_CONCURRENCY,
+) -> None:
+    """
+    Add an image:REGION stage copying the image of image:SOURCE_REGION
+    to each target region
+
+    Copies are planned by plan_copies: far-away regions may be
+    copied from a hub region near them instead of from the source region,
+    and at most copy_concurrency copies run from any one region at once.
+    If a hub's copy fails, its regions are copied from the source region.
+    """
+    plan = plan_copies(
+        source_region, target_regions, copy_concurrency, best_effort_regions
+    )
+    hubs = {parent for parent in plan.values() if parent != source_region}
+    if hubs:
         logging.info(
-            f"Finished image {image_id} from {source_region} to {target_region_name} {copy_image['ImageId']}"
+            "Copying via hubs: "
+            + "; ".join(
+                f"{hub} -> {', '.join(r for r, p in plan.items() if p == hub)}"
+                for hub in sorted(hubs)
+            )
         )
-        deprecate_at = (datetime.datetime.now() + datetime.timedelta(days=90)).strftime(
-            "%Y-%m-%dT%H:%M:%SZ"
+    slots = {
+        region: threading.Semaphore(copy_concurrency)
+        for region in [source_region, *hubs]
+    }
+    source_stage = f"image:{source_region}"
+
+    def copy_to(region_name: str) -> str:
+        if not pipeline.succeeded(source_stage):
+            raise StageSkipped(f"there is no image in {source_region}")
+        from_region = plan[region_name]
+        from_image_id = image_id = pipeline.result(source_stage)
+        if from_region != source_region:
+            if pipeline.succeeded(f"image:{from_region}"):
+                from_image_id = pipeline.result(f"image:{from_region}")
+            else:
+                logging.warning(
+                    f"Copying {region_name} from {source_region} instead of {from_region}"
+                )
+                from_region = source_region
+                from_image_id = image_id
+        return copy_image(
+            from_image_id,
+            image_name,
+            source_region,
+            from_region,
+            region_name,
+            slots[from_region],
         )
-        logging.info(f"Deprecating {copy_image['ImageId']} at {deprecate_at}")
-        ec2r.enable_image_deprecation(
-            ImageId=copy_image["ImageId"], DeprecateAt=deprecate_at
+
+    # Hubs first, as stages can only run after stages added before them.
+    for region_name in sorted(plan, key=lambda r: r not in hubs):
+        pipeline.add(
+            f"image:{region_name}",
+            functools.partial(copy_to, region_name),
+            after=[source_stage, f"image:{plan[region_name]}"],
+            optional=region_name in best_effort_regions,
+            always=True,
         )
-        if public:
-            logging.info(f"Making {copy_image['ImageId']} public")
-            ec2r.modify_image_attribute(
-                ImageId=copy_image["ImageId"],
-                Attribute="launchPermission",
-                LaunchPermission={"Add": [{"Group": "all"}]},
-            )
-        return (target_region_name, copy_image["ImageId"])
 
-    with ThreadPoolExecutor(max_workers=32) as executor:
 
-        def _copy_image(target_region: RegionTypeDef) -> tuple[str, str] | None:
-            assert "RegionName" in target_region
-            region_name = target_region["RegionName"]
-            try:
-                return copy_image(image_id, image_name, source_region, region_name)
-            except Exception as e:
-                if region_name not in best_effort_regions:
-                    logging.error(f"Copying to {region_name} failed: {e}")
-                    raise
-                logging.warning(
-                    f"Copying to {region_name} failed (best-effort, ignoring): {e}"
-                )
-                return None
+def add_finish_stages(
+    pipeline: Pipeline, region: str, public: bool, optional: bool = False
+) -> None:
+    """
+    Add stages deprecating the image of image:REGION and, if public,
+    making it public
 
-        image_ids = dict(
-            result
-            for result in executor.map(_copy_image, target_regions)
-            if result is not None
+    Both only need the image, so they run at the same time and
+    alongside copies from it.
+    """
+    image_stage = f"image:{region}"
+    pipeline.add(
+        f"deprecate:{region}",
+        lambda: deprecate_image(clients.ec2(region), pipeline.result(image_stage)),
+        after=[image_stage],
+        optional=optional,
+    )
+    if public:
+        pipeline.add(
+            f"publish:{region}",
+            lambda: make_image_public(
+                clients.ec2(region), pipeline.result(image_stage)
+            ),
+            after=[image_stage],
+            optional=optional,
         )
 
-    image_ids[source_region] = image_id
-    return image_ids
+
+def destination_regions(
+    ec2: EC2Client, dest_regions: list[str], state: RunState | None
+) -> list[str]:
+    """
+    Return the regions to copy to: dest_regions, or all regions if empty,
+    except the source region
+
+    Remembered in state, as long as the source region and dest_regions
+    stay the same.
+    """
+    key = {"source": ec2.meta.region_name, "dest_regions": sorted(dest_regions)}
+    if state is not None and "regions" in state:
+        recorded = state.get("regions")
+        if recorded["key"] == key:
+            regions: list[str] = recorded["regions"]
+            return regions
+    regions = [
+        region["RegionName"]
+        for region in ec2.describe_regions()["Regions"]
+        if "RegionName" in region
+        and region["RegionName"] != ec2.meta.region_name
+        and (dest_regions == [] or region["RegionName"] in dest_regions)
+    ]
+    if state is not None:
+        state.record("regions", {"key": key, "regions": regions})
+    return regions
+
+
+def verify_run_state(state: RunState, regions: list[str], fan_out: bool) -> None:
+    """
+    Forget the stages of state whose images or snapshots no longer exist
+
+    Checks each region with one call: its image if it has been made,
+    including whether it is still deprecated and public, or else the
+    snapshot to make it from. Only if an image is gone is its snapshot
+    checked as well.
+    """
+
+    source_region = regions[0]
+    snapshot_stage = "snapshots" if fan_out else "snapshot"
+
+    def verify(region: str) -> list[str]:
+        ec2r = clients.ec2(region)
+        stale = []
+        if f"image:{region}" in state:
+            image_id = state.get(f"image:{region}")
+            images = ec2r.describe_images(
+                Owners=["self"], Filters=[{"Name": "image-id", "Values": [image_id]}]
+            )["Images"]
+            if images and images[0].get("State") == "available":
+                if "DeprecationTime" not in images[0]:
+                    stale.append(f"deprecate:{region}")
+                if not images[0].get("Public"):
+                    stale.append(f"publish:{region}")
+                return stale
+            logging.info(f"Image {image_id} in {region} is gone, making it again")
+            stale = [f"image:{region}", f"deprecate:{region}", f"publish:{region}"]
+            if region == source_region:
+                stale.append("smoke-test")
+            if region != source_region and not fan_out:
+                return stale
+        if snapshot_stage not in state:
+            return stale
+        snapshot_ids = state.get(snapshot_stage)
+        snapshot_id = snapshot_ids.get(region) if fan_out else snapshot_ids
+        if snapshot_id is None:
+            # A best-effort region that failed last time; try it again.
+            return stale + [snapshot_stage]
+        snapshots = ec2r.describe_snapshots(
+            OwnerIds=["self"],
+            Filters=[{"Name": "snapshot-id", "Values": [snapshot_id]}],
+        )["Snapshots"]
+        if not snapshots or snapshots[0].get("State") != "completed":
+            logging.info(f"Snapshot {snapshot_id} in {region} is gone, making it again")
+            return stale + [snapshot_stage]
+        return stale
+
+    # Copies have no snapshot stage of their own.
+    checked = [
+        r for r in regions if fan_out or r == source_region or f"image:{r}" in state
+    ]
+    with ThreadPoolExecutor(max_workers=max(len(checked), 1)) as executor:
+        stale = [stage for stages in executor.map(verify, checked) for stage in stages]
+    if stale:
+        state.forget(*stale)
 
 
 def upload_ami(
@@ -362,59 +790,203 @@ def upload_ami(
     import_role_name: str,
     ebs_direct: bool,
     best_effort_regions: list[str] = [],
+    incremental: bool = False,
+    state_dir: Path | None = None,
+    metrics_dir: Path | None = None,
+    fan_out: bool = False,
+    verify: float = 0.0,
+    read_mode: str = "cached",
+    s3_part_size_mib: int = S3_PART_SIZE_MIB,
+    s3_concurrency: int = S3_CONCURRENCY,
+    copy_concurrency: int = COPY_CONCURRENCY,
+    smoke_test: bool = False,
+    resume: bool = True,
 ) -> dict[str, str]:
     """
     Upload NixOS AMI to AWS and return the image ids for each region
 
+    The steps run as stages of a Pipeline, each as soon as the stages it
+    needs are done: the copies to other regions overlap with deprecating
+    the image, making it public and smoke testing it in the source
+    region. The critical path of the stages is logged and, with
+    metrics_dir, written there as pipeline-NAME.json.
+
+    With fan_out (requires ebs_direct and copy_to_regions) the image is
+    uploaded to all regions at once and registered in each, instead of
+    being copied from the source region.
+
+    With smoke_test an instance is booted from the image in the source
+    region.
+
+    With state_dir, the results of the stages are recorded in a RunState,
+    and a re-run of the same image build only checks, with one call per
+    region, that what the earlier runs made still exists, and carries on
+    with the unfinished stages. Unless resume is set, earlier runs are
+    ignored.
+
     This function is idempotent because all the functions it calls are idempotent.
     """
 
-    ec2: EC2Client = boto3.client("ec2")
-    s3: S3Client = boto3.client("s3")
+    ec2 = clients.ec2()
+    s3 = clients.s3()
 
     image_file = Path(image_info["file"])
     label = image_info["label"]
     system = image_info["system"]
     image_name = prefix + label + "-" + system + ("." + run_id if run_id else "")
 
+    state = None
+    if state_dir is not None:
+        state = RunState.open(state_dir, image_name, image_file)
+        if not resume:
+            state.forget(*list(state.stages))
+
+    dest_region_names: list[str] = []
+    if copy_to_regions:
+        dest_region_names = destination_regions(ec2, dest_regions, state)
+        # Ready by the time the image is copied or registered there.
+        clients.prewarm("ec2", dest_region_names)
+
     image_format = image_info.get("format") or "VHD"
-    if ebs_direct:
-        snapshot_id = import_snapshot_ebs_direct(
-            ec2, image_name, image_file, ec2.meta.region_name
-        )
-    else:
+    parent_name_filter = None
+    release = re.match(r"\d+\.\d+", label)
+    if incremental and release is not None:
+        parent_name_filter = prefix + release.group() + "*-" + system + "*"
+
+    if fan_out:
+        assert (
+            ebs_direct and copy_to_regions
+        ), "--fan-out requires --ebs-direct and --copy-to-regions"
+    elif not ebs_direct:
         assert (
             s3_bucket is not None
         ), "--s3-bucket is required unless --ebs-direct is set"
-        snapshot_id = import_snapshot_if_not_exist(
-            s3, ec2, s3_bucket, image_name, image_file, image_format, import_role_name
-        )
 
-    image_id = register_image_if_not_exists(
-        ec2, image_name, image_info, snapshot_id, public, enable_tpm
-    )
+    source_region = ec2.meta.region_name
+    regions = [source_region] + dest_region_names
+    if state is not None and state.stages:
+        verify_run_state(state, regions, fan_out)
+    pipeline = Pipeline(state)
 
-    image_ids: dict[str, str] = {}
-    image_ids[ec2.meta.region_name] = image_id
-
-    if copy_to_regions:
-        regions = filter(
-            lambda x: x.get("RegionName") != ec2.meta.region_name
-            and (True if dest_regions == [] else x.get("RegionName") in dest_regions),
-            ec2.describe_regions()["Regions"],
-        )
-        image_ids.update(
-            copy_image_to_regions(
-                image_id,
+    if fan_out:
+        pipeline.add(
+            "snapshots",
+            lambda: import_snapshots_ebs_direct(
                 image_name,
-                ec2.meta.region_name,
+                image_file,
                 regions,
-                public,
+                state_dir,
+                parent_name_filter,
+                metrics_dir,
                 best_effort_regions,
+                verify,
+                read_mode,
+            ),
+        )
+
+        def register_in(region: str) -> str:
+            snapshot_ids = pipeline.result("snapshots")
+            if region not in snapshot_ids:
+                raise StageSkipped(f"there is no snapshot in {region}")
+            return register_image_if_not_exists(
+                clients.ec2(region),
+                image_name,
+                image_info,
+                snapshot_ids[region],
+                enable_tpm,
+            )
+
+        for region in regions:
+            pipeline.add(
+                f"image:{region}",
+                functools.partial(register_in, region),
+                after=["snapshots"],
+                optional=region in best_effort_regions,
+            )
+    else:
+
+        def snapshot() -> str:
+            if ebs_direct:
+                return import_snapshot_ebs_direct(
+                    ec2,
+                    image_name,
+                    image_file,
+                    source_region,
+                    state_dir,
+                    parent_name_filter,
+                    metrics_dir,
+                    verify,
+                    read_mode,
+                )
+            assert s3_bucket is not None
+            return import_snapshot_if_not_exist(
+                s3,
+                ec2,
+                s3_bucket,
+                image_name,
+                image_file,
+                image_format,
+                import_role_name,
+                s3_part_size_mib,
+                s3_concurrency,
+                metrics_dir,
             )
+
+        pipeline.add("snapshot", snapshot)
+        pipeline.add(
+            f"image:{source_region}",
+            lambda: register_image_if_not_exists(
+                ec2, image_name, image_info, pipeline.result("snapshot"), enable_tpm
+            ),
+            after=["snapshot"],
+        )
+        add_copy_stages(
+            pipeline,
+            image_name,
+            source_region,
+            dest_region_names,
+            best_effort_regions,
+            copy_concurrency,
         )
 
-    return image_ids
+    for region in regions:
+        add_finish_stages(pipeline, region, public, region in best_effort_regions)
+    if smoke_test:
+        pipeline.add(
+            "smoke-test",
+            lambda: run_smoke_test(
+                pipeline.result(f"image:{source_region}"), run_id, False, True
+            ),
+            after=[f"image:{source_region}"],
+        )
+
+    try:
+        pipeline.run()
+    finally:
+        logging.info(
+            "Critical path: "
+            + ", ".join(f"{name} {s:.1f}s" for name, s in pipeline.critical_path())
+        )
+        if metrics_dir is not None:
+            try:
+                metrics_dir.mkdir(parents=True, exist_ok=True)
+                report_path = (
+                    metrics_dir / f"pipeline-{image_name.replace('/', '-')}.json"
+                )
+                report_path.write_text(json.dumps(pipeline.report(), indent=2) + "\n")
+            except OSError as e:
+                logging.warning(f"Failed to write pipeline report: {e}")
+
+    # Best-effort regions where a stage failed are left out.
+    return {
+        region: pipeline.result(f"image:{region}")
+        for region in regions
+        if all(
+            pipeline.succeeded(f"{stage}:{region}")
+            for stage in ("image", "deprecate", "publish")
+            if f"{stage}:{region}" in pipeline
+        )
+    }
 
 
 def main() -> None:
@@ -423,15 +995,83 @@ def main() -> None:
     parser = argparse.ArgumentParser(description="Upload NixOS AMI to AWS")
     parser.add_argument("--image-info", help="Path to image info", required=True)
     parser.add_argument("--s3-bucket", help="S3 bucket to upload to")
+    parser.add_argument(
+        "--s3-part-size-mib",
+        type=int,
+        default=S3_PART_SIZE_MIB,
+        help="Part size of multipart uploads to S3",
+    )
+    parser.add_argument(
+        "--s3-concurrency",
+        type=int,
+        default=S3_CONCURRENCY,
+        help="Number of parts uploaded to S3 at once",
+    )
     parser.add_argument(
         "--ebs-direct",
         action="store_true",
-        help="Upload via EBS Direct APIs instead of importing from S3",
+        help="Upload via EBS Direct APIs instead of importing from S3. Images may "
+        "be raw, VHD, qcow2, or raw compressed with xz or zstd. A zstd image "
+        "whose frames do not record their size, as zstd writes when reading "
+        "from a pipe, is decompressed twice: once to find its size, then to "
+        "upload it",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="With --ebs-direct, only upload blocks that changed since the previous snapshot of the same release and system",
+    )
+    parser.add_argument(
+        "--state-dir",
+        type=Path,
+        nargs="?",
+        const=default_state_dir(),
+        metavar="DIR",
+        help=f"Keep local upload state in DIR (default: {default_state_dir()}): block manifests for --incremental, the progress of the run, and, for --ebs-direct, journals that leave a failed upload's snapshot pending so a rerun resumes it. Without it, a failed upload deletes its snapshot",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        type=Path,
+        help="Write upload metrics as JSON and Prometheus textfile to this directory",
+    )
+    parser.add_argument(
+        "--fan-out",
+        action="store_true",
+        help="With --ebs-direct and --copy-to-regions, upload to all regions in parallel and register the image in each instead of copying it",
+    )
+    parser.add_argument(
+        "--verify",
+        type=float,
+        default=0.0,
+        metavar="FRACTION",
+        help="With --ebs-direct, read back this fraction of the uploaded blocks and compare them to the image (1 for all)",
+    )
+    parser.add_argument(
+        "--read-mode",
+        choices=READ_MODES,
+        default="cached",
+        help="With --ebs-direct, how to read raw images: through the page cache, with readahead hints and dropping read blocks from it, or with O_DIRECT",
+    )
+    parser.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Redo all steps instead of carrying on from the state an earlier run of the same image left in --state-dir",
     )
     parser.add_argument("--debug", action="store_true")
     parser.add_argument("--cleanup", action="store_true")
     parser.add_argument("--copy-to-regions", action="store_true")
+    parser.add_argument(
+        "--copy-concurrency",
+        type=int,
+        default=COPY_CONCURRENCY,
+        help="Maximum number of copies from one region at once; far-away regions may then be copied from a hub region near them",
+    )
     parser.add_argument("--public", action="store_true")
+    parser.add_argument(
+        "--smoke-test",
+        action="store_true",
+        help="Boot an on-demand instance from the image in the source region while it is copied to other regions",
+    )
     parser.add_argument(
         "--prefix", required=True, help="Prefix to prepend to image name"
     )
@@ -462,6 +1102,10 @@ def main() -> None:
     )
 
     args = parser.parse_args()
+    if args.incremental and not args.ebs_direct:
+        parser.error("--incremental needs --ebs-direct")
+    if args.incremental and args.state_dir is None:
+        parser.error("--incremental needs the block manifests in --state-dir")
 
     level = logging.DEBUG if args.debug else logging.INFO
     logging.basicConfig(level=level)
@@ -482,6 +1126,17 @@ def main() -> None:
         args.import_role_name,
         args.ebs_direct,
         args.best_effort_region,
+        args.incremental,
+        args.state_dir,
+        args.metrics_dir,
+        args.fan_out,
+        args.verify,
+        args.read_mode,
+        args.s3_part_size_mib,
+        args.s3_concurrency,
+        args.copy_concurrency,
+        args.smoke_test,
+        not args.no_resume,
     )
     print(json.dumps(image_ids))
 
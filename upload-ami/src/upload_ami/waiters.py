@@ -0,0 +1,349 @@
+"""Batched polling of EC2 resources until they reach a state.
+
+botocore's waiters poll one request per resource at a fixed interval.
+:class:`BatchWaiter` instead polls all resources of the same kind in a
+region with one Describe call, so waiting for an image in every region
+or for many snapshots costs one request per region and poll::
+
+    waiter = shared_waiter()
+    futures = [waiter.submit(r, IMAGE_AVAILABLE, i) for r, i in images.items()]
+    for future in futures:
+        future.result()
+
+Polling starts at *min_delay* and backs off by *backoff* up to
+*max_delay* while no resource becomes ready, so resources that become
+ready soon are noticed within seconds without hammering the API for
+slow ones.  Throttled polls back off further.  Resources EC2 does not
+know yet, e.g. just after they were created, count as pending.  The futures resolve to the
+resource's description from the last poll.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Iterator
+
+from . import clients
+
+if TYPE_CHECKING:
+    from mypy_boto3_ec2.client import EC2Client
+
+log = logging.getLogger(__name__)
+
+IMAGE_AVAILABLE = "image_available"
+SNAPSHOT_COMPLETED = "snapshot_completed"
+SNAPSHOT_IMPORTED = "snapshot_imported"
+INSTANCE_RUNNING = "instance_running"
+INSTANCE_STATUS_OK = "instance_status_ok"
+INSTANCE_TERMINATED = "instance_terminated"
+
+# IDs per Describe call.
+_BATCH_SIZE = 100
+
+
+class WaitError(Exception):
+    """A resource reached a state from which it will not become ready."""
+
+
+@dataclass(frozen=True)
+class _Kind:
+    """How to poll one kind of resource.
+
+    *describe* yields ``(id, description)`` for those of the given IDs
+    that exist.  *check* returns True once a resource is ready, False if
+    it never will be, and None while it is still pending.
+    """
+
+    describe: Callable[["EC2Client", list[str]], Iterable[tuple[str, Any]]]
+    check: Callable[[Any], bool | None]
+    timeout: float
+
+
+def _describe_images(ec2: "EC2Client", ids: list[str]) -> Iterator[tuple[str, Any]]:
+    # Filters rather than ImageIds, so that images EC2 does not know yet
+    # are left out instead of failing the whole call.
+    resp = ec2.describe_images(
+        Owners=["self"], Filters=[{"Name": "image-id", "Values": ids}]
+    )
+    for image in resp["Images"]:
+        yield image.get("ImageId", ""), image
+
+
+def _describe_snapshots(ec2: "EC2Client", ids: list[str]) -> Iterator[tuple[str, Any]]:
+    pages = ec2.get_paginator("describe_snapshots").paginate(
+        OwnerIds=["self"], Filters=[{"Name": "snapshot-id", "Values": ids}]
+    )
+    for page in pages:
+        for snapshot in page["Snapshots"]:
+            yield snapshot.get("SnapshotId", ""), snapshot
+
+
+def _describe_import_tasks(
+    ec2: "EC2Client", ids: list[str]
+) -> Iterator[tuple[str, Any]]:
+    resp = ec2.describe_import_snapshot_tasks(ImportTaskIds=ids)
+    for task in resp["ImportSnapshotTasks"]:
+        yield task.get("ImportTaskId", ""), task
+
+
+def _describe_instances(ec2: "EC2Client", ids: list[str]) -> Iterator[tuple[str, Any]]:
+    pages = ec2.get_paginator("describe_instances").paginate(
+        Filters=[{"Name": "instance-id", "Values": ids}]
+    )
+    for page in pages:
+        for reservation in page["Reservations"]:
+            for instance in reservation.get("Instances", []):
+                yield instance.get("InstanceId", ""), instance
+
+
+def _describe_instance_status(
+    ec2: "EC2Client", ids: list[str]
+) -> Iterator[tuple[str, Any]]:
+    pages = ec2.get_paginator("describe_instance_status").paginate(
+        InstanceIds=ids, IncludeAllInstances=True
+    )
+    for page in pages:
+        for status in page["InstanceStatuses"]:
+            yield status.get("InstanceId", ""), status
+
+
+def _state(ready: str, failed: Iterable[str]) -> Callable[[str | None], bool | None]:
+    failed = frozenset(failed)
+
+    def check(state: str | None) -> bool | None:
+        if state == ready:
+            return True
+        if state in failed:
+            return False
+        return None
+
+    return check
+
+
+_image_state = _state("available", ("failed", "error", "invalid", "deregistered"))
+_snapshot_state = _state("completed", ("error",))
+_import_state = _state("completed", ("error", "deleting", "deleted"))
+_running_state = _state("running", ("shutting-down", "terminated", "stopping"))
+_terminated_state = _state("terminated", ())
+
+_KINDS = {
+    IMAGE_AVAILABLE: _Kind(
+        _describe_images, lambda image: _image_state(image.get("State")), 600
+    ),
+    SNAPSHOT_COMPLETED: _Kind(
+        _describe_snapshots,
+        lambda snapshot: _snapshot_state(snapshot.get("State")),
+        600,
+    ),
+    SNAPSHOT_IMPORTED: _Kind(
+        _describe_import_tasks,
+        lambda task: _import_state(task.get("SnapshotTaskDetail", {}).get("Status")),
+        600,
+    ),
+    INSTANCE_RUNNING: _Kind(
+        _describe_instances,
+        lambda instance: _running_state(instance.get("State", {}).get("Name")),
+        600,
+    ),
+    INSTANCE_STATUS_OK: _Kind(
+        _describe_instance_status,
+        lambda status: (
+            False
+            if status.get("InstanceState", {}).get("Name") == "terminated"
+            else status.get("InstanceStatus", {}).get("Status") == "ok" or None
+        ),
+        600,
+    ),
+    INSTANCE_TERMINATED: _Kind(
+        _describe_instances,
+        lambda instance: _terminated_state(instance.get("State", {}).get("Name")),
+        600,
+    ),
+}
+
+
+@dataclass
+class _Waiting:
+    future: "Future[Any]"
+    deadline: float
+
+
+@dataclass
+class _Group:
+    """The resources of one kind in one region, polled by one thread."""
+
+    region: str
+    kind: str
+    waiting: dict[str, list[_Waiting]] = field(default_factory=dict)
+    delay: float = 0.0
+    running: bool = False
+
+
+class BatchWaiter:
+    """Waits for EC2 resources with one poll per region and resource kind.
+
+    Safe to use from any thread; see the module docstring.
+    """
+
+    def __init__(
+        self,
+        min_delay: float = 2.0,
+        max_delay: float = 15.0,
+        backoff: float = 1.5,
+    ) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self._groups: dict[tuple[str, str], _Group] = {}
+        self._cond = threading.Condition()
+
+    def submit(
+        self,
+        region: str,
+        kind: str,
+        resource_id: str,
+        timeout: float | None = None,
+    ) -> "Future[Any]":
+        """Return a future that resolves once *resource_id* is ready.
+
+        *kind* is one of the constants of this module, named after the
+        botocore waiter it replaces.  The future fails with
+        :class:`WaitError` if the resource fails, or with TimeoutError
+        after *timeout* seconds, by default the botocore waiter's.
+        """
+        spec = _KINDS[kind]
+        future: "Future[Any]" = Future()
+        deadline = time.monotonic() + (spec.timeout if timeout is None else timeout)
+        with self._cond:
+            group = self._groups.setdefault((region, kind), _Group(region, kind))
+            group.waiting.setdefault(resource_id, []).append(_Waiting(future, deadline))
+            group.delay = self.min_delay
+            if not group.running:
+                group.running = True
+                threading.Thread(
+                    target=self._run,
+                    args=(group,),
+                    name=f"waiter-{kind}-{region}",
+                    daemon=True,
+                ).start()
+            self._cond.notify_all()
+        return future
+
+    def wait(
+        self,
+        region: str,
+        kind: str,
+        resource_ids: Iterable[str],
+        timeout: float | None = None,
+    ) -> list[Any]:
+        """Wait for all *resource_ids*; return their descriptions in order."""
+        futures = [self.submit(region, kind, i, timeout) for i in resource_ids]
+        return [future.result() for future in futures]
+
+    def _run(self, group: _Group) -> None:
+        import botocore.exceptions
+
+        spec = _KINDS[group.kind]
+        ec2 = clients.ec2(group.region)
+        last_poll = time.monotonic()
+        while True:
+            with self._cond:
+                while True:
+                    if not group.waiting:
+                        group.running = False
+                        return
+                    remaining = last_poll + group.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                ids = list(group.waiting)
+            last_poll = time.monotonic()
+            throttled = False
+            try:
+                found: dict[str, Any] = {}
+                for i in range(0, len(ids), _BATCH_SIZE):
+                    found.update(spec.describe(ec2, ids[i : i + _BATCH_SIZE]))
+            except botocore.exceptions.ClientError as exc:
+                code = exc.response.get("Error", {}).get("Code", "")
+                if "Throttl" in code or code == "RequestLimitExceeded":
+                    log.warning("Polling %s in %s throttled", group.kind, group.region)
+                    throttled = True
+                    with self._cond:
+                        group.delay = min(group.delay * 2, self.max_delay * 2)
+                elif not code.endswith("NotFound"):
+                    self._fail_all(group, exc)
+                    continue
+                # Resources EC2 does not know yet are still pending.
+                found = {}
+            except Exception as exc:
+                self._fail_all(group, exc)
+                continue
+            self._resolve(group, spec, found, throttled)
+
+    def _resolve(
+        self, group: _Group, spec: _Kind, found: dict[str, Any], throttled: bool
+    ) -> None:
+        """Settle the resources in *found* and those past their deadline.
+
+        The next poll comes sooner if one settled and later if none did;
+        after a *throttled* poll, _run has already backed off further.
+        """
+        now = time.monotonic()
+        done: list[tuple[_Waiting, Any, BaseException | None]] = []
+        with self._cond:
+            changed = False
+            for resource_id, waiting in list(group.waiting.items()):
+                description = found.get(resource_id)
+                ready = spec.check(description) if description is not None else None
+                if ready is not None:
+                    error: BaseException | None = None
+                    if not ready:
+                        error = WaitError(
+                            f"{resource_id} in {group.region} failed waiting for "
+                            f"{group.kind}: {description}"
+                        )
+                    done.extend((w, description, error) for w in waiting)
+                    del group.waiting[resource_id]
+                    changed = True
+                    continue
+                expired = [w for w in waiting if w.deadline <= now]
+                for w in expired:
+                    waiting.remove(w)
+                    timeout = TimeoutError(
+                        f"Timed out waiting for {resource_id} in {group.region} "
+                        f"to reach {group.kind}"
+                    )
+                    done.append((w, description, timeout))
+                if not waiting:
+                    del group.waiting[resource_id]
+            if changed:
+                group.delay = self.min_delay
+            elif not throttled:
+                group.delay = min(group.delay * self.backoff, self.max_delay)
+        for w, description, exc in done:
+            if exc is not None:
+                w.future.set_exception(exc)
+            else:
+                w.future.set_result(description)
+
+    def _fail_all(self, group: _Group, exc: BaseException) -> None:
+        with self._cond:
+            waiting = [w for ws in group.waiting.values() for w in ws]
+            group.waiting.clear()
+        for w in waiting:
+            w.future.set_exception(exc)
+
+
+_shared: BatchWaiter | None = None
+_shared_lock = threading.Lock()
+
+
+def shared_waiter() -> BatchWaiter:
+    """Return the process-wide :class:`BatchWaiter`."""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = BatchWaiter()
+        return _shared
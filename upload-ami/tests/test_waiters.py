@@ -0,0 +1,43 @@
+import threading
+import time
+import unittest
+from typing import Any
+from unittest import mock
+
+import botocore.exceptions
+
+from upload_ami.waiters import IMAGE_AVAILABLE, BatchWaiter
+
+
+class ThrottledEc2:
+    """Throttles the first DescribeImages, then reports the image available."""
+
+    def __init__(self) -> None:
+        self.calls: list[float] = []
+        self.polled_twice = threading.Event()
+
+    def describe_images(self, **kwargs: Any) -> dict[str, Any]:
+        self.calls.append(time.monotonic())
+        if len(self.calls) == 1:
+            raise botocore.exceptions.ClientError(
+                {"Error": {"Code": "RequestLimitExceeded"}}, "DescribeImages"
+            )
+        self.polled_twice.set()
+        image_id = kwargs["Filters"][0]["Values"][0]
+        return {"Images": [{"ImageId": image_id, "State": "available"}]}
+
+
+class BatchWaiterTest(unittest.TestCase):
+    def test_throttled_poll_backs_off_beyond_max_delay(self) -> None:
+        ec2 = ThrottledEc2()
+        waiter = BatchWaiter(min_delay=0.1, max_delay=0.1)
+        with mock.patch("upload_ami.waiters.clients.ec2", return_value=ec2):
+            future = waiter.submit("us-east-1", IMAGE_AVAILABLE, "ami-1", timeout=10)
+            self.assertTrue(ec2.polled_twice.wait(5))
+            self.assertEqual(future.result(5)["State"], "available")
+        # The throttled poll doubles the delay past max_delay.
+        self.assertGreaterEqual(ec2.calls[1] - ec2.calls[0], 0.19)
+
+
+if __name__ == "__main__":
+    unittest.main()